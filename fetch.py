@@ -5,11 +5,34 @@ import sys
 import threading
 import time
 
+from ggmap.readwrite import TaxidStore
+
 
 LOGFILE_PREFIX = 'log_taxid_'
 RESFILE_PREFIX = 'result_taxid_'
 LOGFILE_SUFFIX = '.txt'
+STORE_FILENAME = './taxids.sqlite'
 exitFlag = 0
+_store = None
+_store_lock = threading.Lock()
+
+
+def _get_store():
+    """ Opens the accession store once and imports log and result files.
+
+    Log and result files of earlier runs are imported only if they are new or
+    changed since their last import. Like the files, the store does not
+    distinguish accession types.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TaxidStore(STORE_FILENAME)
+            for prefix in [LOGFILE_PREFIX, RESFILE_PREFIX]:
+                for logfile in sorted(glob.glob("./%s*%s" % (
+                        prefix, LOGFILE_SUFFIX))):
+                    _store.add_file(logfile, type='')
+        return _store
 
 
 class thread_fetch(threading.Thread):
@@ -116,6 +139,7 @@ def write_accession_taxids(dict, filehandle=None, verbose=True):
     for accession, taxid in dict.items():
         filehandle.write("\t".join([accession, str(taxid)]) + "\n")
     filehandle.flush()
+    _get_store().insert(dict)
 
     return filehandle
 
@@ -135,17 +159,9 @@ def read_accesion_taxids(filename, dict={}):
 
 def _get_taxids_cache(accessions, verbose=True):
     if len(accessions) > 0:
-        cache = {}
         if verbose:
             print('searching cache: ', file=sys.stderr, end="")
-        for logfile in glob.glob("./%s*%s" % (LOGFILE_PREFIX, LOGFILE_SUFFIX)):
-            read_accesion_taxids(logfile, cache)
-        for logfile in glob.glob("./%s*%s" % (RESFILE_PREFIX, LOGFILE_SUFFIX)):
-            read_accesion_taxids(logfile, cache)
-        results = {}
-        for id in accessions:
-            if id in cache:
-                results[id] = cache[id]
+        results = _get_store().lookup(accessions)
         if verbose:
             print('found %i of %i accessions.' % (
                     len(results), len(accessions)),
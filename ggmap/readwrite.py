@@ -1,53 +1,617 @@
-def _read_ncbitaxonomy_file(filename):
-    """ A generic function to read an NCBI taxonomy file, which is delimited
-    by '\t|\t?'.
+import os
+import io
+import csv
+import gzip
+import bz2
+import lzma
+import tarfile
+import glob
+import hashlib
+import tempfile
+import sqlite3
+import threading
+from array import array
+from collections.abc import Mapping, MutableMapping
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+
+# directory into which binary caches of parsed reference files are written
+DIR_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'ggmap')
+
+# buffer size in bytes for reading input files
+BUFFER_SIZE = 1 << 20
+
+# magic bytes of compressed files and functions to open them
+COMPRESSIONS = [(b'\x1f\x8b', gzip.open),
+                (b'BZh', bz2.open),
+                (b'\xfd7zXZ\x00', lzma.open)]
+
+
+class TaxidMap(MutableMapping):
+    """ A dict-compatible mapping onto a dense taxID array.
+
+    NCBI taxIDs are small, positive integers. Instead of a Python dict, we
+    hold e.g. the parent of every node in a NumPy array indexed by taxID.
+    Positions that do not correspond to a taxID hold -1. Like a dict, entries
+    can be set and deleted, but keys and values must be non-negative ints.
+    A read-only array, e.g. a memory mapped cache, is copied on the first
+    modification, i.e. caches are never altered.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        Dense integer array. array[taxid] is the value for taxid, or -1 if
+        taxid is not a key.
+    """
+    def __init__(self, array):
+        self.array = array
+        self._len = int(np.count_nonzero(array >= 0))
+
+    @classmethod
+    def from_dict(cls, entries):
+        """ Converts a dict of non-negative int keys and values."""
+        taxids = np.full(max(list(entries.keys()) + list(entries.values()) +
+                             [0]) + 1, -1, dtype=np.int32)
+        taxids[list(entries.keys())] = list(entries.values())
+        return cls(taxids)
+
+    def __getitem__(self, key):
+        try:
+            value = self.array[key] if key >= 0 else -1
+        except (IndexError, TypeError):
+            raise KeyError(key)
+        if value < 0:
+            raise KeyError(key)
+        return int(value)
+
+    def __contains__(self, key):
+        try:
+            return (key >= 0) and (self.array[key] >= 0)
+        except (IndexError, TypeError):
+            return False
+
+    def _writable(self, size):
+        """ Makes array writable and at least size entries long."""
+        if len(self.array) < size:
+            grown = np.full(size, -1, dtype=self.array.dtype)
+            grown[:len(self.array)] = self.array
+            self.array = grown
+        elif not self.array.flags.writeable:
+            self.array = np.array(self.array)
+
+    def __setitem__(self, key, value):
+        if not (isinstance(key, (int, np.integer)) and
+                isinstance(value, (int, np.integer)) and
+                (key >= 0) and (value >= 0)):
+            raise ValueError("TaxidMap only holds non-negative int keys and "
+                             "values, not (%r, %r)." % (key, value))
+        if value > np.iinfo(self.array.dtype).max:
+            self.array = self.array.astype(np.int64)
+        self._writable(key + 1)
+        if self.array[key] < 0:
+            self._len += 1
+        self.array[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._writable(0)
+        self.array[key] = -1
+        self._len -= 1
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.array >= 0).tolist())
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '%s(%i entries)' % (self.__class__.__name__, self._len)
+
+
+class _ArchiveMember(io.RawIOBase):
+    """ Raw stream of a tar member that closes the archive with itself.
+    """
+    def __init__(self, archive, member):
+        self._archive = archive
+        self._member = archive.extractfile(member)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._member.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            self._member.close()
+            self._archive.close()
+        super().close()
+
+
+def _split_archive(filename):
+    """ Splits a path into an existing file and a member path inside of it.
 
     Parameters
     ----------
     filename : str
-        Path to a file from an NCBI taxonomy dump.
+        Path to a file, or to a member of a tar archive, e.g.
+        'taxdump.tar.gz/nodes.dmp'.
+
+    Returns
+    -------
+    (str, str): the path of the existing file and the path of the member in
+    it, or None if filename is not an archive member.
+
+    Raises
+    ------
+    IOError
+        If neither the file nor an archive containing it exists.
+    """
+    path, member = filename, []
+    while path and not os.path.exists(path):
+        path, tail = os.path.split(path)
+        member.insert(0, tail)
+    if not member:
+        return filename, None
+    if path and os.path.isfile(path):
+        return path, '/'.join(member)
+    raise IOError('Cannot read file "%s"' % filename)
+
+
+def _get_decompressor(filename):
+    """ Returns the function to open a compressed file, or None."""
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for prefix, opener in COMPRESSIONS:
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+
+def _open(filename, mode='r'):
+    """ Opens an input file for reading, transparently decompressing it.
+
+    gzip, bz2 and xz compression is detected by the file's magic bytes, not
+    its name. Members of (compressed) tar archives are addressed by appending
+    their path to the archive's path, e.g. 'taxdump.tar.gz/nodes.dmp', and
+    are streamed without extracting the archive.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file or archive member.
+    mode : str
+        'r' for text or 'rb' for binary mode.
+
+    Returns
+    -------
+    A file object with a read buffer of BUFFER_SIZE bytes.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read or the member is not in the archive.
+    """
+    path, member = _split_archive(filename)
+    try:
+        if member is not None:
+            archive = tarfile.open(path, mode='r|*', bufsize=BUFFER_SIZE)
+            for info in archive:
+                if os.path.normpath(info.name) == os.path.normpath(member):
+                    stream = io.BufferedReader(_ArchiveMember(archive, info),
+                                               buffer_size=BUFFER_SIZE)
+                    break
+            else:
+                archive.close()
+                raise IOError('Cannot read file "%s"' % filename)
+        else:
+            opener = _get_decompressor(path)
+            if opener is None:
+                return open(path, mode, buffering=BUFFER_SIZE)
+            stream = io.BufferedReader(opener(path, 'rb'),
+                                       buffer_size=BUFFER_SIZE)
+    except (tarfile.TarError, OSError):
+        raise IOError('Cannot read file "%s"' % filename)
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream)
+
+
+def _get_byte_ranges(filename, num_chunks, header=False):
+    """ Splits a file into newline aligned byte ranges of similar size.
+
+    Parameters
+    ----------
+    filename : str
+        Path to an uncompressed file.
+    num_chunks : int
+        Maximal number of ranges.
+    header : bool
+        Default: False. If True, the first line is not part of any range.
+
+    Returns
+    -------
+    A list of (start, end) byte offsets, covering the file in order.
+    """
+    with open(filename, 'rb') as f:
+        if header:
+            f.readline()
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        bounds = [start]
+        for i in range(1, num_chunks):
+            f.seek(max(bounds[-1], start + (size - start) * i // num_chunks))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+        bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _parse_byte_range(args):
+    """ Parses one byte range of a file, see parse_parallel."""
+    filename, start, end, parse = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return parse(io.TextIOWrapper(io.BytesIO(data)))
+
+
+# minimal number of bytes per chunk for parse_parallel
+PARALLEL_CHUNK_SIZE = 1 << 24
+
+
+def parse_parallel(filename, parse, processes=1, header=False):
+    """ Parses a line based file in newline aligned chunks in parallel.
+
+    The file is split into byte ranges, which are parsed by a pool of worker
+    processes. Partial results are returned in file order, such that merging
+    them in order gives the same result as parsing the whole file at once.
+    Compressed files and archive members cannot be split and are parsed as
+    one chunk, as are files smaller than PARALLEL_CHUNK_SIZE.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file.
+    parse : function
+        Parses an iterable of lines into a partial result. It must be
+        picklable, e.g. a module level function or a partial of it.
+    processes : int
+        Default: 1. Number of worker processes.
+    header : bool
+        Default: False. If True, the first line is skipped.
+
+    Returns
+    -------
+    A list of partial results of parse, in file order.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    """
+    path, member = _split_archive(filename)
+    ranges = []
+    if (processes > 1) and (member is None) and \
+       (_get_decompressor(path) is None):
+        num_chunks = min(processes * 4,
+                         os.path.getsize(path) // PARALLEL_CHUNK_SIZE)
+        if num_chunks > 1:
+            ranges = _get_byte_ranges(path, num_chunks, header)
+
+    if len(ranges) < 2:
+        with _open(filename) as f:
+            if header:
+                f.readline()
+            return [parse(f)]
+    with Pool(processes) as pool:
+        return pool.map(_parse_byte_range,
+                        [(path, start, end, parse) for start, end in ranges],
+                        chunksize=1)
+
+
+def _get_cache_filename(filename, tag, dir_cache=None):
+    """ Returns the name of the binary cache file for a parsed input file.
+
+    The name encodes size and modification time of the input file, or of the
+    archive containing it, such that a cache automatically becomes stale if
+    the input file changes.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the input file.
+    tag : str
+        Distinguishes several caches derived from the same input file.
+    dir_cache : str
+        Directory holding the cache files. Default: DIR_CACHE.
+
+    Returns
+    -------
+    (str, str): the cache filename and a glob pattern matching all caches for
+    the same input file and tag, regardless of size and modification time.
+    """
+    if dir_cache is None:
+        dir_cache = DIR_CACHE
+    filename = os.path.abspath(filename)
+    stat = os.stat(_split_archive(filename)[0])
+    prefix = '%s.%s.%s' % (
+        os.path.basename(filename),
+        hashlib.md5(filename.encode('utf-8')).hexdigest()[:8],
+        tag)
+    return (os.path.join(dir_cache, '%s.%i-%i.npy' % (
+                prefix, stat.st_size, stat.st_mtime_ns)),
+            os.path.join(dir_cache, glob.escape(prefix) + '.*.npy'))
+
+
+def _load_cache(filename, tag, dir_cache=None):
+    """ Memory maps a binary cache for filename, if it exists and is current.
+
+    Returns
+    -------
+    numpy.ndarray or None, if there is no valid cache.
+    """
+    try:
+        file_cache, _ = _get_cache_filename(filename, tag, dir_cache)
+        return np.load(file_cache, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+
+
+def _store_cache(filename, tag, array, dir_cache=None):
+    """ Writes array as binary cache for filename and removes stale caches.
+
+    Failing to write the cache, e.g. due to missing permissions, is not an
+    error, since the cache only speeds up future loads.
+    """
+    try:
+        file_cache, pattern = _get_cache_filename(filename, tag, dir_cache)
+        for file_stale in glob.glob(pattern):
+            os.remove(file_stale)
+        os.makedirs(os.path.dirname(file_cache), exist_ok=True)
+        # write to a temporary file first, such that concurrent readers never
+        # see a partially written cache
+        fh, file_tmp = tempfile.mkstemp(dir=os.path.dirname(file_cache),
+                                        suffix='.tmp')
+        with os.fdopen(fh, 'wb') as f:
+            np.save(f, array)
+        os.replace(file_tmp, file_cache)
+    except (IOError, OSError):
+        pass
+
+
+def _last_occurrences(keys):
+    """ Positions of the last occurrence of every distinct key.
+
+    Like for a dict, later entries in a file overwrite earlier ones with the
+    same key.
+    """
+    _, last = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - last
+
+
+# table of contents of binary files written by _write_sections
+_SECTION_DTYPE = np.dtype([('name', 'S32'), ('dtype', 'S8'),
+                           ('offset', '<u8'), ('count', '<u8')])
+
+
+def _write_sections(filename, magic, sections):
+    """ Writes named, one dimensional arrays into one binary file.
+
+    The file starts with the 8 byte magic, followed by the number of sections
+    and a table of contents with name, dtype, byte offset and length of each
+    array. Array data are aligned to 8 bytes, such that _read_sections can
+    memory map them without copying.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file that shall be created.
+    magic : bytes
+        8 bytes identifying the file format.
+    sections : list of (str, numpy.ndarray)
+        Names and arrays to be written.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be written.
+    """
+    toc = np.zeros(len(sections), dtype=_SECTION_DTYPE)
+    offset = 16 + toc.nbytes
+    for i, (name, values) in enumerate(sections):
+        values = np.ascontiguousarray(values)
+        offset += -offset % 8
+        toc[i] = (name.encode('ascii'), values.dtype.str.encode('ascii'),
+                  offset, values.size)
+        offset += values.nbytes
+    try:
+        with open(filename, 'wb') as f:
+            f.write(magic)
+            f.write(np.uint64(len(sections)).tobytes())
+            f.write(toc.tobytes())
+            for (name, values), entry in zip(sections, toc):
+                f.write(b'\0' * (int(entry['offset']) - f.tell()))
+                f.write(np.ascontiguousarray(values).tobytes())
+    except IOError:
+        raise IOError('Cannot write to file "%s"' % filename)
+
+
+def _read_sections(filename, magic):
+    """ Memory maps all arrays of a file written by _write_sections.
 
     Returns
     -------
-    A dict. Key = first field of file, Value = second field of file.
+    A dict of section names and read-only numpy.ndarrays.
 
     Raises
     ------
     IOError
         If the file cannot be read.
+    ValueError
+        If the file does not start with magic.
+    """
+    try:
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+    except (IOError, ValueError):
+        raise IOError('Cannot read file "%s"' % filename)
+    if data[:8].tobytes() != magic:
+        raise ValueError("wrong file format.")
+    num_sections = int(data[8:16].view('<u8')[0])
+    toc = data[16:16 + num_sections * _SECTION_DTYPE.itemsize].view(
+        _SECTION_DTYPE)
+    sections = {}
+    for entry in toc:
+        dtype = np.dtype(entry['dtype'].decode('ascii'))
+        start = int(entry['offset'])
+        sections[entry['name'].decode('ascii')] = data[
+            start:start + int(entry['count']) * dtype.itemsize].view(dtype)
+    return sections
+
+
+def _is_binary_file(filename, magic):
+    """ Checks if filename starts with the given magic bytes."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except IOError:
+        return False
+
+
+def _parse_ncbitaxonomy_columns(lines, columns=(0, 2)):
+    """ Parses two columns of NCBI taxonomy lines into int64 arrays.
+
+    Fields of NCBI taxonomy files are delimited by '\\t|\\t', i.e. splitting
+    by tabs yields the first field at position 0 and the second at position 2.
+    This allows using pandas' fast C parser instead of parsing line by line.
+
+    Raises
+    ------
     ValueError
         If IDs of entries cannot be converted into int.
     """
-    entries = {}
     try:
-        file = open(filename, 'r')
-        for line in file:
-            fields = list(map(str.strip, line.split('|')))
-            try:
-                entries[int(fields[0])] = int(fields[1])
-            except ValueError:
-                file.close()
-                raise ValueError("cannot convert entry IDs (%s, %s) to int."
-                                 % (fields[0], fields[1]))
+        entries = pd.read_csv(lines, sep='\t', header=None,
+                              usecols=list(columns), quoting=csv.QUOTE_NONE,
+                              dtype=str, na_filter=False)
+    except pd.errors.EmptyDataError:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
-        file.close()
-        return entries
+    try:
+        return tuple(entries[column].astype(np.int64).values
+                     for column in columns)
+    except ValueError:
+        for key, value in zip(entries[columns[0]], entries[columns[1]]):
+            if not (key.isdigit() and value.isdigit()):
+                break
+        raise ValueError("cannot convert entry IDs (%s, %s) to int."
+                         % (key, value))
+
+
+def _read_ncbitaxonomy_array(filename, processes=1):
+    """ Parses an NCBI taxonomy file into a dense array.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a file from an NCBI taxonomy dump.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
+
+    Returns
+    -------
+    A numpy.ndarray, where array[first field] = second field, or -1 for
+    positions that do not occur as first field in the file.
 
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    ValueError
+        If IDs of entries cannot be converted into int.
+    """
+    try:
+        chunks = parse_parallel(filename, _parse_ncbitaxonomy_columns,
+                                processes)
     except IOError:
         raise IOError('Cannot read file "%s"' % filename)
+    keys = np.concatenate([keys for keys, _ in chunks])
+    values = np.concatenate([values for _, values in chunks])
 
+    last = _last_occurrences(keys)
+    taxids = np.full(max(keys.max(initial=0), values.max(initial=0)) + 1, -1,
+                     dtype=np.int32)
+    taxids[keys[last]] = values[last]
+    return taxids
 
-def read_ncbi_nodes(filename):
+
+def _read_ncbitaxonomy_file(filename, cache=False, dir_cache=None,
+                            processes=1):
+    """ A generic function to read an NCBI taxonomy file, which is delimited
+    by '\t|\t?'.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a file from an NCBI taxonomy dump.
+    cache : bool
+        Default: False. If True, store parsed results in a binary cache file
+        and memory map it on later calls, as long as size and modification
+        time of filename do not change.
+    dir_cache : str
+        Directory for cache files. Default: DIR_CACHE.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
+
+    Returns
+    -------
+    A dict-like TaxidMap. Key = first field of file, Value = second field of
+    file. The underlying dense array is available as attribute 'array'.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    ValueError
+        If IDs of entries cannot be converted into int.
+    """
+    _split_archive(filename)
+
+    taxids = None
+    if cache:
+        taxids = _load_cache(filename, 'taxids', dir_cache)
+    if taxids is None:
+        taxids = _read_ncbitaxonomy_array(filename, processes)
+        if cache:
+            _store_cache(filename, 'taxids', taxids, dir_cache)
+
+    return TaxidMap(taxids)
+
+
+def read_ncbi_nodes(filename, cache=False, dir_cache=None, processes=1):
     """ Reads NCBI's nodes.dmp file and returns a dict of nodes and parents.
 
     Parameters
     ----------
     filename : str
         Path to the filename 'nodes.dmp' of NCBI's taxonomy.
+    cache : bool
+        Default: False. If True, use a binary cache to speed up subsequent
+        reads.
+    dir_cache : str
+        Directory for cache files. Default: DIR_CACHE.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
 
     Returns
     -------
-    A dict, where keys are node IDs and their values are parent node IDs.
+    A dict-like TaxidMap, where keys are node IDs and their values are parent
+    node IDs.
 
     Raises
     ------
@@ -56,20 +620,28 @@ def read_ncbi_nodes(filename):
     ValueError
         If IDs of nodes or parent nodes cannot be converted into int.
     """
-    return _read_ncbitaxonomy_file(filename)
+    return _read_ncbitaxonomy_file(filename, cache, dir_cache, processes)
 
 
-def read_ncbi_merged(filename):
+def read_ncbi_merged(filename, cache=False, dir_cache=None, processes=1):
     """ Reads NCBI's merged.dmp file and returns a dict of old and merged IDs.
 
     Parameters
     ----------
     filename : str
         Path to the filename 'merged.dmp' of NCBI's taxonomy.
+    cache : bool
+        Default: False. If True, use a binary cache to speed up subsequent
+        reads.
+    dir_cache : str
+        Directory for cache files. Default: DIR_CACHE.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
 
     Returns
     -------
-    A dict, where keys are old IDs and their values are the new merged IDs.
+    A dict-like TaxidMap, where keys are old IDs and their values are the new
+    merged IDs.
 
     Raises
     ------
@@ -78,7 +650,168 @@ def read_ncbi_merged(filename):
     ValueError
         If IDs of old or merged nodes cannot be converted into int.
     """
-    return _read_ncbitaxonomy_file(filename)
+    return _read_ncbitaxonomy_file(filename, cache, dir_cache, processes)
+
+
+def read_ncbi_ranks(filename, cache=False, dir_cache=None):
+    """ Reads the taxonomic rank of every node from NCBI's nodes.dmp file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the filename 'nodes.dmp' of NCBI's taxonomy.
+    cache : bool
+        Default: False. If True, use a binary cache to speed up subsequent
+        reads.
+    dir_cache : str
+        Directory for cache files. Default: DIR_CACHE.
+
+    Returns
+    -------
+    A tuple (numpy.ndarray, list of str). The array holds a rank code for
+    every taxID, or -1 if the taxID is not a node. The list holds the rank
+    name for each code, e.g. 'species'.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    ValueError
+        If IDs of nodes cannot be converted into int.
+    """
+    _split_archive(filename)
+
+    if cache:
+        codes = _load_cache(filename, 'ranks', dir_cache)
+        names = _load_cache(filename, 'ranknames', dir_cache)
+        if (codes is not None) and (names is not None):
+            return codes, list(names)
+
+    try:
+        with _open(filename) as f:
+            entries = pd.read_csv(f, sep='\t', header=None, usecols=[0, 4],
+                                  quoting=csv.QUOTE_NONE, dtype=str,
+                                  na_filter=False)
+        keys = entries[0].astype(np.int64).values
+    except pd.errors.EmptyDataError:
+        return np.full(1, -1, dtype=np.int8), []
+    except IOError:
+        raise IOError('Cannot read file "%s"' % filename)
+    except ValueError:
+        raise ValueError("cannot convert node IDs to int.")
+
+    rank_codes, names = pd.factorize(entries[4].fillna(''))
+    codes = np.full(keys.max(initial=0) + 1, -1, dtype=np.int8)
+    last = _last_occurrences(keys)
+    codes[keys[last]] = rank_codes[last]
+    names = list(names)
+
+    if cache:
+        _store_cache(filename, 'ranks', codes, dir_cache)
+        _store_cache(filename, 'ranknames', np.array(names, dtype=str),
+                     dir_cache)
+
+    return codes, names
+
+
+# accession types of MetaPhlAn marker genes, in the order of their type codes
+MARKER_TYPES = ['gi', 'GeneID', 'NC']
+
+
+def read_metaphlan_markers_table(filename):
+    """ Reads the MetaPhlAn markers_info.txt file into a columnar table.
+
+    The file is parsed in a single pass. Clade names are interned, i.e. every
+    distinct clade is stored once and rows only refer to it by code.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the filename 'markers_info' of MetaPhlAn.
+
+    Returns
+    -------
+    A pandas.DataFrame with one row per distinct marker gene and the columns
+    'clade' (categorical), 'type' (categorical, one of MARKER_TYPES) and
+    'accession'. Integer codes of both categorical columns are available via
+    .cat.codes.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    ValueError
+        If a marker gene line does not name its clade.
+    """
+    clade_codes = {}
+    clades = array('i')
+    types = array('b')
+    accessions = []
+    try:
+        file = _open(filename)
+    except IOError:
+        raise IOError('Cannot read file "%s"' % filename)
+    with file:
+        for line in file:
+            if line.startswith('gi|'):
+                type_code, start, sep = 0, 3, '|'
+            elif line.startswith('GeneID:'):
+                type_code, start, sep = 1, 7, ':'
+            elif line.startswith('NC_'):
+                type_code, start, sep = 2, 0, '\t'
+            else:
+                continue
+
+            end_field = line.find('\t')
+            if end_field < 0:
+                end_field = len(line)
+            end = line.find(sep, start, end_field)
+            accession = line[start:end if end >= 0 else end_field]
+
+            start_clade = line.find("clade': '", end_field)
+            if start_clade < 0:
+                raise ValueError("No clade for marker '%s' in file '%s'." %
+                                 (accession, filename))
+            start_clade += len("clade': '")
+            clade = line[start_clade:line.find("'", start_clade)]
+
+            code = clade_codes.get(clade)
+            if code is None:
+                code = clade_codes[clade] = len(clade_codes)
+            clades.append(code)
+            types.append(type_code)
+            accessions.append(accession)
+
+    markers = pd.DataFrame({
+        'clade': pd.Categorical.from_codes(
+            np.frombuffer(clades, dtype=np.int32),
+            categories=list(clade_codes)),
+        'type': pd.Categorical.from_codes(
+            np.frombuffer(types, dtype=np.int8), categories=MARKER_TYPES),
+        'accession': accessions})
+    return markers.drop_duplicates().reset_index(drop=True)
+
+
+def metaphlan_markers_to_dict(markers):
+    """ Converts a table of MetaPhlAn markers into nested dicts of sets.
+
+    Parameters
+    ----------
+    markers : pandas.DataFrame
+        Marker genes, as returned by read_metaphlan_markers_table.
+
+    Returns
+    -------
+    A dict with an entry for each 'clade'. Their values are dicts themselves,
+    with keys that refer to one of the three sequence sources. And their values
+    are sets of marker gene IDs. For example:
+    's__Escherichia_phage_vB_EcoP_G7C': {'GeneID': {'11117645', '11117646'}}
+    """
+    clades = {}
+    for (clade, type_ids), accessions in markers.groupby(
+            ['clade', 'type'], observed=True, sort=False)['accession']:
+        clades.setdefault(clade, {})[type_ids] = set(accessions)
+    return clades
 
 
 def read_metaphlan_markers_info(filename):
@@ -106,43 +839,209 @@ def read_metaphlan_markers_info(filename):
     IOError
         If the file cannot be read.
     """
-    clades = {}
-    try:
-        file = open(filename, 'r')
-        for line in file:
-            if line.startswith('gi|'):
-                type_ids = 'gi'
-                accession = (line.split('\t')[0]).split('|')[1]
-            elif line.startswith('GeneID:'):
-                type_ids = 'GeneID'
-                accession = (line.split('\t')[0]).split(':')[1]
-            elif line.startswith('NC_'):
-                type_ids = 'NC'
-                accession = line.split('\t')[0]
-            else:
-                type_ids = None
-                accession = None
+    return metaphlan_markers_to_dict(read_metaphlan_markers_table(filename))
 
-            if (type_ids is not None) and (accession is not None):
-                clade = line.split("clade': '")[1].split("'")[0]
-                if clade not in clades:
-                    clades[clade] = {}
-                if type_ids not in clades[clade]:
-                    clades[clade][type_ids] = {}
-                clades[clade][type_ids][accession] = True
 
-        for clade in clades:
-            for type_id in clades[clade]:
-                clades[clade][type_id] = set(clades[clade][type_id].keys())
+# first bytes of every SQLite database file
+MAGIC_SQLITE = b'SQLite format 3\x00'
 
-        file.close()
-        return clades
 
-    except IOError:
-        raise IOError('Cannot read file "%s"' % filename)
+class TaxidStore(object):
+    """ A persistent, indexed store of sequence accessions and their taxIDs.
+
+    Accessions are kept in a SQLite database in WAL mode, i.e. several
+    threads or processes can look up accessions while one of them inserts
+    new results. Each thread uses its own connection.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the database file. It is created if it does not exist.
+    timeout : float
+        Default: 60. Seconds to wait for a concurrent writer.
+    """
+    # maximal number of accessions per lookup query
+    CHUNK_SIZE = 500
+
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS taxids ('
+                         'type TEXT NOT NULL, accession TEXT NOT NULL, '
+                         'taxid INTEGER NOT NULL, '
+                         'PRIMARY KEY (type, accession)) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS taxids_accession '
+                         'ON taxids (accession)')
+            conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'filename TEXT PRIMARY KEY, size INTEGER, '
+                         'mtime INTEGER)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            try:
+                conn = sqlite3.connect(self.filename, timeout=self.timeout)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            except sqlite3.Error:
+                raise IOError('Cannot read file "%s"' % self.filename)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """ Closes the connection of the calling thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def insert(self, taxids, type=''):
+        """ Adds or overwrites accessions in one transaction.
+
+        Parameters
+        ----------
+        taxids : dict accession -> taxID
+            Accessions and their taxIDs, -1 for withdrawn accessions.
+        type : str
+            Type of the accessions, e.g. "gi", "GeneID" or "NC".
+        """
+        conn = self._connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO taxids VALUES (?, ?, ?)',
+                             ((type, str(accession), int(taxid))
+                              for accession, taxid in taxids.items()))
+
+    def lookup(self, accessions, type=None):
+        """ Returns the taxIDs of all known accessions.
+
+        Parameters
+        ----------
+        accessions : iterable of str
+            The accessions to look up.
+        type : str
+            Restrict lookups to accessions of this type. Default: None, i.e.
+            accessions of all types are found.
+
+        Returns
+        -------
+        A dict accession -> taxID for all accessions in the store.
+        """
+        accessions = list(map(str, accessions))
+        conn = self._connection()
+        results = {}
+        for i in range(0, len(accessions), self.CHUNK_SIZE):
+            chunk = accessions[i:i + self.CHUNK_SIZE]
+            query = ('SELECT accession, taxid FROM taxids WHERE accession IN '
+                     '(%s)' % ','.join('?' * len(chunk)))
+            if type is not None:
+                query += ' AND type = ?'
+                chunk = chunk + [type]
+            results.update(conn.execute(query, chunk))
+        return results
+
+    def add_file(self, filename, type=None):
+        """ Imports a taxID list or a log file of fetch.py into the store.
+
+        Files that have been imported before and did not change since are
+        skipped.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the file. Its first line is a header.
+        type : str
+            If None, the file has three tab separated columns like for
+            read_taxid_list. Otherwise, it has two columns accession and
+            taxID and all accessions are of the given type.
+
+        Returns
+        -------
+        True, if the file has been imported, False if it was skipped.
+
+        Raises
+        ------
+        IOError
+            If the file cannot be read.
+        ValueError
+            If a line has the wrong number of fields.
+        """
+        stat = os.stat(_split_archive(filename)[0])
+        key = os.path.abspath(filename)
+        conn = self._connection()
+        if conn.execute('SELECT 1 FROM files WHERE filename = ? AND size = ? '
+                        'AND mtime = ?',
+                        (key, stat.st_size, stat.st_mtime_ns)).fetchone():
+            return False
+
+        entries = []
+        try:
+            with _open(filename) as f:
+                f.readline()  # header
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if type is not None:
+                        fields.insert(0, type)
+                    if len(fields) != 3:
+                        raise ValueError("Error parsing line '%s' of file "
+                                         "'%s'" % (line, filename))
+                    entries.append((fields[0], fields[1], int(fields[2])))
+        except IOError:
+            raise IOError('Cannot read file "%s"' % filename)
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO taxids VALUES (?, ?, ?)',
+                             entries)
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                         (key, stat.st_size, stat.st_mtime_ns))
+        return True
+
+    def to_dict(self, dict=None):
+        """ Exports the store in the format of read_taxid_list."""
+        if dict is None:
+            dict = {}
+        for type, accession, taxid in self._connection().execute(
+                'SELECT type, accession, taxid FROM taxids'):
+            if type not in dict:
+                dict[type] = {}
+            dict[type][accession] = taxid
+        return dict
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM taxids').fetchone()[0]
+
+
+def _parse_taxid_list(lines, filename):
+    """ Parses lines of a taxID list file, see read_taxid_list."""
+    taxids = {}
+    for line in lines:
+        try:
+            type, accession, taxid = line.rstrip().split("\t")
+            if type not in taxids:
+                taxids[type] = {}
+            taxids[type][accession] = int(taxid)
+        except ValueError:
+            raise ValueError("Error parsing line '%s' of file '%s'" %
+                             (line, filename))
+    return taxids
 
 
-def read_taxid_list(filename, dict=None):
+def _merge_nested_dicts(chunks, dict=None):
+    """ Merges dicts of dicts in order, later entries overwrite earlier ones.
+    """
+    if dict is None:
+        dict = {}
+    for chunk in chunks:
+        for key, values in chunk.items():
+            if key not in dict:
+                dict[key] = {}
+            dict[key].update(values)
+    return dict
+
+
+def read_taxid_list(filename, dict=None, processes=1):
     """ Read a taxID list file.
 
     A taxID list file consists of three tab separated columns: 1. ID type,
@@ -151,11 +1050,14 @@ def read_taxid_list(filename, dict=None):
 
     Parameters
     ----------
-    filename : str
-        Path to the file containing the taxID list.
+    filename : str or TaxidStore
+        Path to the file containing the taxID list. A TaxidStore or the path
+        of its database is exported instead.
     dict : dict
         Optional. Provide an existing dictionary into which parsed results
         should be added. Useful if the taxID list consists of several files.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
 
     Returns
     -------
@@ -170,35 +1072,48 @@ def read_taxid_list(filename, dict=None):
     ValueError
         If a line does not contain of exactly three tab delimited fields.
     """
-    if dict is None:
-        dict = {}
+    if isinstance(filename, TaxidStore):
+        return filename.to_dict(dict)
+    if _is_binary_file(filename, MAGIC_SQLITE):
+        store = TaxidStore(filename)
+        try:
+            return store.to_dict(dict)
+        finally:
+            store.close()
+
     try:
-        f = open(filename, 'r')
-        f.readline()  # header
-        for line in f:
-            try:
-                type, accession, taxid = line.rstrip().split("\t")
-                if type not in dict:
-                    dict[type] = {}
-                dict[type][accession] = int(taxid)
-            except ValueError:
-                f.close()
-                raise ValueError("Error parsing line '%s' of file '%s'" %
-                                 (line, filename))
-
-        f.close()
-        return dict
+        chunks = parse_parallel(filename,
+                                partial(_parse_taxid_list, filename=filename),
+                                processes, header=True)
     except IOError:
         raise IOError('Cannot read file "%s"' % filename)
+    return _merge_nested_dicts(chunks, dict)
+
+
+def _parse_gg_accessions(lines):
+    """ Parses lines of a GreenGenes accession list, see read_gg_accessions.
+    """
+    accessions = {}
+    for line in lines:
+        try:
+            gg_id, accession_type, accession = line.rstrip().split("\t")
+            if accession_type not in accessions:
+                accessions[accession_type] = {}
+            accessions[accession_type][int(gg_id)] = accession
+        except ValueError:
+            raise ValueError("Wrong number of tab seperated columns.")
+    return accessions
 
 
-def read_gg_accessions(filename):
+def read_gg_accessions(filename, processes=1):
     """ Reads a GreenGenes accession list.
 
     Parameters
     ----------
     filename: str
         Path to the file containing GreenGenes accessions.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
 
     Returns
     -------
@@ -210,26 +1125,87 @@ def read_gg_accessions(filename):
     IOError
         If the file cannot be read.
     """
-    accessions = {}
     try:
-        file = open(filename, 'r')
-        file.readline()  # header
-        for line in file:
-            try:
-                gg_id, accession_type, accession = line.rstrip().split("\t")
-                if accession_type not in accessions.keys():
-                    accessions[accession_type] = {}
-                accessions[accession_type][int(gg_id)] = accession
-            except ValueError:
-                file.close()
-                raise ValueError("Wrong number of tab seperated columns.")
-        file.close()
-        return accessions
+        chunks = parse_parallel(filename, _parse_gg_accessions, processes,
+                                header=True)
+    except IOError:
+        raise IOError('Cannot read file "%s"' % filename)
+    return _merge_nested_dicts(chunks)
+
+
+def index_gg_accessions(accessions):
+    """ Inverts a GreenGenes accession list for lookups by GreenGenes ID.
+
+    Parameters
+    ----------
+    accessions : dict of dicts
+        GreenGenes accession list, as returned by read_gg_accessions.
+
+    Returns
+    -------
+    A dict with GreenGenes IDs as keys and lists of (accession type,
+    accession) tuples as values.
+    """
+    index = {}
+    for ctype in accessions:
+        for gg_id, accession in accessions[ctype].items():
+            if gg_id in index:
+                index[gg_id].append((ctype, accession))
+            else:
+                index[gg_id] = [(ctype, accession)]
+    return index
+
+
+def iter_gg_otu_map(filename, accessions, index=None):
+    """ Streams a GreenGenes OTU map, one representative at a time.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file containing GreenGenes OTU map.
+    accessions : dict of dicts
+        GreenGenes accession list, as returned by read_gg_accessions.
+    index : dict
+        Optional. The inverted accession list, as returned by
+        index_gg_accessions. Pass it to avoid re-indexing accessions when
+        reading several OTU maps. If given, accessions is ignored.
+
+    Yields
+    ------
+    Tuples (OTU representative, dict), where the dict holds for every
+    accession type the set of accessions of all OTU members.
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    ValueError
+        If the file is not an OTU map.
+    """
+    if index is None:
+        index = index_gg_accessions(accessions)
+    try:
+        file = _open(filename)
     except IOError:
         raise IOError('Cannot read file "%s"' % filename)
+    with file:
+        for line in file:
+            try:
+                otu_members = list(map(int, line.rstrip().split("\t")[1:]))
+                otu_repr = otu_members[0]
+            except (ValueError, IndexError):
+                raise ValueError("wrong file format.")
+            otu = {}
+            for member in otu_members:
+                for ctype, accession in index.get(member, ()):
+                    if ctype in otu:
+                        otu[ctype].add(accession)
+                    else:
+                        otu[ctype] = {accession}
+            yield otu_repr, otu
 
 
-def read_gg_otu_map(filename, accessions):
+def read_gg_otu_map(filename, accessions, index=None):
     """ Reads a GreenGenes OTU map.
 
     Parameters
@@ -238,40 +1214,110 @@ def read_gg_otu_map(filename, accessions):
         Path to the file containing GreenGenes OTU map.
     accessions :
         GreenGenes accession list
+    index : dict
+        Optional. The inverted accession list, as returned by
+        index_gg_accessions. If given, accessions is ignored.
 
     Returns
     -------
-    ...
+    A dict with OTU representatives as keys. Values are dicts, holding for
+    every accession type the set of accessions of all OTU members.
 
     Raises
     ------
     IOError
         If the file cannot be read.
+    ValueError
+        If the file is not an OTU map.
     """
-    otus = {}
-    try:
-        file = open(filename, 'r')
-        for line in file:
-            fields = line.rstrip().split("\t")
-            otu_repr = int(fields[1])
-            otus[otu_repr] = {}
-            otu_members = list(map(int, fields[1:]))
-            for otu in otu_members:
-                for ctype in accessions:
-                    if otu in accessions[ctype]:
-                        if ctype not in otus[otu_repr]:
-                            otus[otu_repr][ctype] = set()
-                        otus[otu_repr][ctype].add(accessions[ctype][otu])
-        file.close()
-        return otus
-    except IOError:
-        raise IOError('Cannot read file "%s"' % filename)
-    except ValueError:
-        file.close()
-        raise ValueError("wrong file format.")
+    return dict(iter_gg_otu_map(filename, accessions, index))
+
+
+# first bytes of compiled clade to OTUs map files
+MAGIC_CLADE2OTUS = b'GGMAPC2O'
+
+
+class Clade2OTUsMap(Mapping):
+    """ A read-only, dict-compatible view onto a compiled clade to OTUs map.
+
+    Clade names are stored as one sorted, UTF-8 encoded string table. OTUs
+    of clade i are otus[indptr[i]:indptr[i+1]]. Lookups bisect the string
+    table and the set of OTUs of a clade is only built when it is accessed,
+    i.e. loading a memory mapped map does not parse anything.
+
+    Parameters
+    ----------
+    names : numpy.ndarray of uint8
+        Concatenated, UTF-8 encoded, sorted clade names.
+    name_offsets : numpy.ndarray of int64
+        Clade i is names[name_offsets[i]:name_offsets[i+1]].
+    indptr : numpy.ndarray of int64
+        Offsets of the clade's OTUs into otus.
+    otus : numpy.ndarray of int32
+        GreenGenes OTU IDs of all clades.
+    """
+    def __init__(self, names, name_offsets, indptr, otus):
+        self.names = names
+        self.name_offsets = name_offsets
+        self.indptr = indptr
+        self.otus = otus
+
+    @classmethod
+    def from_dict(cls, map_clade2otu):
+        """ Compiles a dict clades -> set(OTUs)."""
+        clades = sorted(map_clade2otu)
+        encoded = [clade.encode('utf-8') for clade in clades]
+        name_offsets = np.zeros(len(clades) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+        indptr = np.zeros(len(clades) + 1, dtype=np.int64)
+        np.cumsum([len(map_clade2otu[clade]) for clade in clades],
+                  out=indptr[1:])
+        otus = np.fromiter((otu for clade in clades
+                            for otu in sorted(map_clade2otu[clade])),
+                           dtype=np.int32, count=indptr[-1])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                   name_offsets, indptr, otus)
+
+    def _name(self, i):
+        return self.names[self.name_offsets[i]:
+                          self.name_offsets[i+1]].tobytes()
+
+    def index(self, clade):
+        """ Returns the position of clade or -1 if clade is not in the map."""
+        if not isinstance(clade, str):
+            return -1
+        key = clade.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._name(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self, clade):
+        i = self.index(clade)
+        if i < 0:
+            raise KeyError(clade)
+        return set(self.otus[self.indptr[i]:self.indptr[i+1]].tolist())
+
+    def __contains__(self, clade):
+        return self.index(clade) >= 0
+
+    def __iter__(self):
+        return (self._name(i).decode('utf-8') for i in range(len(self)))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __repr__(self):
+        return '%s(%i clades)' % (self.__class__.__name__, len(self))
 
 
-def write_clade2otus_map(filename, map_clade2otu):
+def write_clade2otus_map(filename, map_clade2otu, binary=False):
     """ Write MetaPhlAn clades to GreenGenes OTUs map to a file.
 
     Parameters
@@ -281,12 +1327,25 @@ def write_clade2otus_map(filename, map_clade2otu):
     map_clade2otu : dict
         The dict holding the information which MetaPhlAn clade maps to which
         set of GreenGenes OTUs.
+    binary : bool
+        Default: False. If True, write the compiled binary format, which
+        read_clade2otus_map memory maps instead of parsing it.
 
     Raises
     ------
     IOError
         If the file cannot be written.
     """
+    if binary:
+        if not isinstance(map_clade2otu, Clade2OTUsMap):
+            map_clade2otu = Clade2OTUsMap.from_dict(map_clade2otu)
+        _write_sections(filename, MAGIC_CLADE2OTUS,
+                        [('names', map_clade2otu.names),
+                         ('name_offsets', map_clade2otu.name_offsets),
+                         ('indptr', map_clade2otu.indptr),
+                         ('otus', map_clade2otu.otus)])
+        return
+
     try:
         fh = open(filename, 'w')
         fh.write('#MetaPhlAn clade\tmatching GreenGenes OTUs\n')
@@ -305,21 +1364,27 @@ def read_clade2otus_map(filename):
     Parameters
     ----------
     filename : str
-        Path to the file from which should be read.
+        Path to the file from which should be read. Files written with
+        write_clade2otus_map(..., binary=True) are detected automatically.
 
     Returns
     -------
     The dict holding the information which MetaPhlAn clade maps to which set of
-    GreenGenes OTUs.
+    GreenGenes OTUs. For binary files, a memory mapped Clade2OTUsMap.
 
     Raises
     ------
     IOError
         If the file cannot be read.
     """
+    if _is_binary_file(filename, MAGIC_CLADE2OTUS):
+        sections = _read_sections(filename, MAGIC_CLADE2OTUS)
+        return Clade2OTUsMap(sections['names'], sections['name_offsets'],
+                             sections['indptr'], sections['otus'])
+
     try:
         map_clade2otu = {}
-        fh = open(filename, 'r')
+        fh = _open(filename)
         for line in fh.readlines():
             if not line.startswith('#'):
                 fields = line.rstrip().split('\t')
@@ -339,7 +1404,9 @@ def read_metaphlan_profile(filename):
     The file is quite reundant, because it stores abundance for each node of
     the spanned tree, instead of only for the tips.
     We report only tips, which might be truncated from the suffix
-    '_unclassified' to match the MetaPhlAn clades.
+    '_unclassified' to match the MetaPhlAn clades. A lineage is a tip, if it
+    is not the ancestor, i.e. a '|' delimited prefix, of any other lineage.
+    Tips are found in one pass over the file, independent of line order.
 
     Parameters
     ----------
@@ -355,21 +1422,58 @@ def read_metaphlan_profile(filename):
     IOError
         If the file cannot be read.
     """
-    tree = {}
+    lineages = []
+    inner = set()
     try:
-        file = open(filename, 'r')
+        file = _open(filename)
         file.readline()  # header
         for line in file:
             linStr, abundance = line.rstrip().split('\t')
-            for t in tree:
-                if t in linStr:
-                    del tree[t]
-                    break
+            lineages.append((linStr, abundance))
+            # remember all proper prefixes, i.e. ancestors, of this lineage
+            pos = linStr.find('|')
+            while pos >= 0:
+                inner.add(linStr[:pos])
+                pos = linStr.find('|', pos + 1)
+        file.close()
+    except IOError:
+        raise IOError('Cannot read file "%s"' % filename)
+
+    # tips are those lineages that are not ancestor of any other lineage
+    tree = {}
+    for linStr, abundance in lineages:
+        if linStr not in inner:
             if linStr.endswith('_unclassified'):
                 linStr = linStr[:-len('_unclassified')]
             tree[linStr] = float(abundance)
+    return tree
 
-        file.close()
-        return tree
-    except IOError:
-        raise IOError('Cannot read file "%s"' % filename)
+
+def read_metaphlan_profiles(filenames, processes=1):
+    """ Read many MetaPhlAn profile files.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Paths to the files from which should be read.
+    processes : int
+        Default: 1. Number of worker processes reading profiles in parallel.
+
+    Returns
+    -------
+    A dict with filenames as keys, in the order of filenames, and profiles as
+    returned by read_metaphlan_profile as values.
+
+    Raises
+    ------
+    IOError
+        If one of the files cannot be read.
+    """
+    if processes > 1:
+        with Pool(processes) as pool:
+            profiles = pool.map(read_metaphlan_profile, filenames,
+                                chunksize=max(1, len(filenames) //
+                                              (processes * 4)))
+    else:
+        profiles = list(map(read_metaphlan_profile, filenames))
+    return dict(zip(filenames, profiles))
@@ -17,18 +17,35 @@ from skbio.tree import TreeNode, NoLengthError, MissingNodeError
 
 from ggmap.snippets import (mutate_sequence, biom2pandas, cache,
                             collapseCounts, pandas2biom)
+from ggmap.readwrite import parse_parallel
 from ggmap import settings
 
 settings.init()
 
 
-def read_otumap(file_otumap):
+def _parse_otumap(lines):
+    """Parses lines of a GreenGenes OTU map, see read_otumap."""
+    otus = dict()
+    seqs = dict()
+    for line in lines:
+        fields = line.rstrip().split("\t")
+        reprID = str(fields[1])
+        seqids = list(map(str, fields[2:]))
+        otus[reprID] = seqids
+        for seqid in seqids + [reprID]:
+            seqs[seqid] = reprID
+    return (otus, seqs)
+
+
+def read_otumap(file_otumap, processes=1):
     """Reads a GreenGenes OTU map.
 
     Parameters
     ----------
     file_otumap : file
         Filename of GreenGenes OTU map to parse.
+    processes : int
+        Default: 1. Number of processes parsing chunks of the file.
 
     Returns
     -------
@@ -43,29 +60,25 @@ def read_otumap(file_otumap):
         If the file cannot be read.
     """
     try:
-        # read OTU map line by line
-        otus = dict()
-        seqs = dict()
-        f = open(file_otumap, 'r')
-        for line in f:
-            fields = line.rstrip().split("\t")
-            reprID = str(fields[1])
-            seqids = list(map(str, fields[2:]))
-            otus[reprID] = seqids
-            for seqid in seqids + [reprID]:
-                seqs[seqid] = reprID
-        f.close()
-
-        # convert to pd.Series
-        otus = pd.Series(otus)
-        otus.index.name = 'representative'
-        otus.name = 'non-representatives'
-
-        seqs = pd.Series(seqs)
-        return (otus, seqs)
+        chunks = parse_parallel(file_otumap, _parse_otumap, processes)
     except IOError:
         raise IOError('Cannot read file "%s"' % file_otumap)
 
+    # merge chunks in file order, such that later lines win
+    otus = dict()
+    seqs = dict()
+    for chunk_otus, chunk_seqs in chunks:
+        otus.update(chunk_otus)
+        seqs.update(chunk_seqs)
+
+    # convert to pd.Series
+    otus = pd.Series(otus)
+    otus.index.name = 'representative'
+    otus.name = 'non-representatives'
+
+    seqs = pd.Series(seqs)
+    return (otus, seqs)
+
 
 @cache
 def load_sequences_pynast(file_pynast_alignment, file_otumap,
@@ -558,9 +571,9 @@ def check_qiita_studies(dir_base):
                         (_type, file_biom, _type, study, prep))
 
                 # check biom contents
-                counts = biom2pandas(file_biom)
+                features, samples = biom2pandas(file_biom, ids_only=True)
                 obs_alphabet = set([str(c).upper()
-                                    for idx in counts.index
+                                    for idx in features
                                     for c in set(idx)])
                 description = None
                 if _type == 'closedref':
@@ -573,8 +586,8 @@ def check_qiita_studies(dir_base):
                     raise ValueError(('Not all feature IDs are purely %s in '
                                       'study %s, %s: "%s') % (
                                      description, study, prep, file_biom))
-                if metadata.loc[counts.columns, :].shape[0] <\
-                   len(counts.columns):
+                if metadata.loc[samples, :].shape[0] <\
+                   len(samples):
                     raise ValueError(("Not all samples of %s of study %s are "
                                       "in the metadata file!") % (prep, study))
     return True
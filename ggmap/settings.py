@@ -21,6 +21,8 @@ DEFAULTS = {'condaenv_qiime1': {'default': 'qiime_env',
             'list_ranks': {'default': ['Kingdom', 'Phylum', 'Class', 'Order',
                                        'Family', 'Genus', 'Species'],
                            'variable_name': 'RANKS'},
+            'mb_biom_cache': {'default': 1024,
+                              'variable_name': 'BIOM_CACHE_MB'},
             }
 
 
@@ -57,6 +59,8 @@ def init(err=sys.stderr):
     EXEC_TIME = config['fp_binary_time']
     global RANKS
     RANKS = config['list_ranks']
+    global BIOM_CACHE_MB
+    BIOM_CACHE_MB = config['mb_biom_cache']
 
     # if settings file does not exist, create one with current values as a
     # primer for user edits
@@ -1,5 +1,6 @@
 import pandas as pd
 import biom
+import h5py
 from biom.util import biom_open
 from mpl_toolkits.basemap import Basemap
 from itertools import repeat, chain
@@ -7,6 +8,7 @@ import numpy as np
 import matplotlib.patches as mpatches
 from matplotlib.font_manager import FontProperties
 import os
+import glob
 import seaborn as sns
 import matplotlib.pyplot as plt
 import subprocess
@@ -15,19 +17,375 @@ import time
 from itertools import combinations
 from skbio.stats.distance import permanova
 from scipy.stats import mannwhitneyu
+from scipy.sparse import csr_matrix, csc_matrix
 import networkx as nx
 import warnings
 import matplotlib.cbook
 import random
 from tempfile import mkstemp
 import pickle
+from collections import OrderedDict
 from ggmap import settings
+from ggmap.readwrite import (DIR_CACHE, _get_cache_filename, _write_sections,
+                             _read_sections, _is_binary_file)
+from ggmap.tree import _Labels
 
 
 settings.init()
 
 
-def biom2pandas(file_biom, withTaxonomy=False, astype=int):
+# first bytes of binary BIOM sidecar files, see _load_biom
+MAGIC_BIOM = b'GGMAPBIO'
+
+# first bytes of HDF5 files, i.e. BIOM files of format version 2
+MAGIC_HDF5 = b'\x89HDF\r\n\x1a\n'
+
+# BIOM tables parsed by this process, least recently used first
+_BIOM_CACHE = OrderedDict()
+
+
+class _ParsedBiom(object):
+    """ Values, IDs and lineages of a BIOM table, as stored in the file.
+
+    Parameters
+    ----------
+    data : scipy.sparse.csr_matrix
+        Values of the table. Rows are observations, columns are samples.
+    observation_ids : numpy.ndarray
+        IDs of the observations, e.g. OTUs or deblur-sequences.
+    sample_ids : numpy.ndarray
+        IDs of the samples.
+    lineages : pandas.Series or str
+        ; separated lineage of each observation, or the reason why the file
+        does not provide lineages.
+    """
+    def __init__(self, data, observation_ids, sample_ids, lineages):
+        self.data = data
+        self.observation_ids = observation_ids
+        self.sample_ids = sample_ids
+        self.lineages = lineages
+
+    @property
+    def nbytes(self):
+        """ Approximate memory footprint in bytes."""
+        nbytes = self.data.data.nbytes + self.data.indices.nbytes + \
+            self.data.indptr.nbytes
+        for ids in [self.observation_ids, self.sample_ids]:
+            nbytes += pd.Index(ids).memory_usage(deep=True)
+        if isinstance(self.lineages, pd.Series):
+            nbytes += self.lineages.memory_usage(deep=True, index=False)
+        return nbytes
+
+    def subset(self, features=None, samples=None):
+        """ Restricts the table to the given features and samples.
+
+        IDs that are not in the table are ignored. None keeps all features or
+        samples, respectively.
+        """
+        if (features is None) and (samples is None):
+            return self
+        data, lineages = self.data, self.lineages
+        observation_ids, sample_ids = self.observation_ids, self.sample_ids
+        positions = _positions(observation_ids, features)
+        if positions is not None:
+            data = data[positions]
+            observation_ids = observation_ids[positions]
+            if isinstance(lineages, pd.Series):
+                lineages = lineages.iloc[positions]
+        positions = _positions(sample_ids, samples)
+        if positions is not None:
+            data = data[:, positions]
+            sample_ids = sample_ids[positions]
+        return _ParsedBiom(data, observation_ids, sample_ids, lineages)
+
+
+def _positions(ids, selection):
+    """ Sorted positions of those ids that are in selection.
+
+    Returns
+    -------
+    numpy.ndarray or None, if selection is None.
+    """
+    if selection is None:
+        return None
+    return np.flatnonzero(pd.Index(ids).isin(list(selection)))
+
+
+def _parse_biom(file_biom):
+    """ Parses a BIOM file into a _ParsedBiom."""
+    table = biom.load_table(file_biom)
+    try:
+        md = table.metadata_to_dataframe('observation')
+        levels = [col for col in md.columns if col.startswith('taxonomy_')]
+        if levels == []:
+            lineages = 'No taxonomy information found in biom file.'
+        else:
+            lineages = md[levels[0]].str.cat(
+                [md[level] for level in levels[1:]], sep=';').rename(None)
+    except KeyError:
+        lineages = 'Biom file does not have any observation metadata!'
+    return _ParsedBiom(table.matrix_data.tocsr(),
+                       table.ids(axis='observation'),
+                       table.ids(axis='sample'), lineages)
+
+
+def _read_hdf5_ids(h5grp):
+    """ Reads the IDs of one axis of a BIOM HDF5 file."""
+    return np.array([i.decode('utf-8') if isinstance(i, bytes) else i
+                     for i in h5grp['ids'][:]], dtype=object)
+
+
+def _read_hdf5_slices(h5grp, positions):
+    """ Reads selected rows of a compressed sparse matrix in a HDF5 file.
+
+    Only the parts of the data and indices datasets that belong to the given
+    rows, or columns for the compressed sparse column matrix of the sample
+    axis, are read. Consecutive positions are read with one request.
+
+    Parameters
+    ----------
+    h5grp : h5py.Group
+        The 'matrix' group of one axis of a BIOM HDF5 file.
+    positions : numpy.ndarray
+        Sorted positions of the rows to be read.
+
+    Returns
+    -------
+    (data, indices, indptr) of the selected rows.
+    """
+    indptr = h5grp['indptr'][:]
+    starts, ends = indptr[positions], indptr[positions + 1]
+    subset_indptr = np.zeros(len(positions) + 1, dtype=np.int64)
+    np.cumsum(ends - starts, out=subset_indptr[1:])
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    data, indices = [], []
+    for first, last in zip(np.r_[0, breaks], np.r_[breaks, len(positions)]):
+        if first < last:
+            data.append(h5grp['data'][starts[first]:ends[last - 1]])
+            indices.append(h5grp['indices'][starts[first]:ends[last - 1]])
+    if data == []:
+        return (np.zeros(0, dtype=h5grp['data'].dtype),
+                np.zeros(0, dtype=h5grp['indices'].dtype), subset_indptr)
+    return np.concatenate(data), np.concatenate(indices), subset_indptr
+
+
+def _parse_biom_subset(file_biom, features=None, samples=None):
+    """ Reads selected features and samples of a BIOM HDF5 file.
+
+    Contrary to biom.Table.from_hdf5, features or samples without counts in
+    the selection are kept, i.e. the result equals the selection from the
+    complete table.
+
+    Returns
+    -------
+    _ParsedBiom
+    """
+    with h5py.File(file_biom, 'r') as f:
+        observation_ids = _read_hdf5_ids(f['observation'])
+        sample_ids = _read_hdf5_ids(f['sample'])
+        pos_features = _positions(observation_ids, features)
+        pos_samples = _positions(sample_ids, samples)
+        if pos_samples is not None:
+            data = csc_matrix(
+                _read_hdf5_slices(f['sample/matrix'], pos_samples),
+                shape=(len(observation_ids), len(pos_samples))).tocsr()
+            sample_ids = sample_ids[pos_samples]
+            if pos_features is not None:
+                data = data[pos_features]
+        else:
+            data = csr_matrix(
+                _read_hdf5_slices(f['observation/matrix'], pos_features),
+                shape=(len(pos_features), len(sample_ids)))
+        if pos_features is not None:
+            observation_ids = observation_ids[pos_features]
+
+        metadata = f['observation/metadata']
+        if len(metadata) == 0:
+            lineages = 'Biom file does not have any observation metadata!'
+        else:
+            lineages = 'No taxonomy information found in biom file.'
+            if 'taxonomy' in metadata:
+                ranks = metadata['taxonomy'][:]
+                ranks = ranks.reshape(ranks.shape[0], -1)
+                # like biom.Table.from_hdf5, drop empty ranks and pad shorter
+                # lineages to the longest one of the complete table, such
+                # that lineages are joined exactly as in _parse_biom
+                md = pd.DataFrame(
+                    [[r.decode('utf-8') if isinstance(r, bytes) else r
+                      for r in row if r]
+                     for row in ranks])
+                if pos_features is not None:
+                    md = md.iloc[pos_features]
+                if md.shape[1] > 0:
+                    lineages = pd.Series(
+                        md[0].str.cat([md[level] for level in md.columns[1:]],
+                                      sep=';').values,
+                        index=observation_ids, dtype=object)
+    return _ParsedBiom(data, observation_ids, sample_ids, lineages)
+
+
+def _write_biom_sidecar(file_sidecar, parsed):
+    """ Writes a _ParsedBiom into a binary file, see _read_biom_sidecar."""
+    sections = [('data', parsed.data.data),
+                ('indices', parsed.data.indices),
+                ('indptr', parsed.data.indptr),
+                ('shape', np.array(parsed.data.shape, dtype=np.int64))]
+    labels = [('observation_ids', list(parsed.observation_ids)),
+              ('sample_ids', list(parsed.sample_ids))]
+    if isinstance(parsed.lineages, pd.Series):
+        labels.append(('lineages', [None if pd.isnull(lineage) else lineage
+                                    for lineage in parsed.lineages]))
+    else:
+        sections.append(('error', np.frombuffer(
+            parsed.lineages.encode('utf-8'), dtype=np.uint8)))
+    for name, values in labels:
+        encoded = _Labels.from_list(values)
+        sections.extend([(name + '.data', encoded.data),
+                         (name + '.offsets', encoded.offsets),
+                         (name + '.kinds', encoded.kinds)])
+    _write_sections(file_sidecar, MAGIC_BIOM, sections)
+
+
+def _read_biom_sidecar(file_sidecar):
+    """ Memory maps the values of a BIOM table from a binary sidecar.
+
+    Returns
+    -------
+    _ParsedBiom, holding the memory mapped values of the table.
+    """
+    sections = _read_sections(file_sidecar, MAGIC_BIOM)
+
+    def _labels(name):
+        return _Labels(sections[name + '.data'], sections[name + '.offsets'],
+                       sections[name + '.kinds']).tolist()
+
+    data = csr_matrix((sections['data'], sections['indices'],
+                       sections['indptr']),
+                      shape=tuple(sections['shape'].tolist()))
+    observation_ids = np.array(_labels('observation_ids'), dtype=object)
+    if 'error' in sections:
+        lineages = sections['error'].tobytes().decode('utf-8')
+    else:
+        lineages = pd.Series(_labels('lineages'), index=observation_ids,
+                             dtype=object)
+    return _ParsedBiom(data, observation_ids,
+                       np.array(_labels('sample_ids'), dtype=object),
+                       lineages)
+
+
+def _biom_cache_key(file_biom):
+    """ Path, size and modification time of a BIOM file."""
+    file_biom = os.path.abspath(file_biom)
+    stat = os.stat(file_biom)
+    return (file_biom, stat.st_size, stat.st_mtime_ns)
+
+
+def _load_biom(file_biom, cache=False, sidecar=False, features=None,
+               samples=None):
+    """ Parses a BIOM file, or obtains it from the cache tiers.
+
+    BIOM tables are cached in memory, under a total budget of
+    settings.BIOM_CACHE_MB megabytes of which the least recently used tables
+    are evicted first. Optionally, parsed tables are also written into a
+    binary sidecar file, which later processes memory map instead of parsing
+    the BIOM file again. Both tiers are keyed by path, size and modification
+    time of the BIOM file, i.e. changing the file invalidates its caches.
+
+    Parameters
+    ----------
+    file_biom : str
+        The path to the biom file.
+    cache : bool
+        Default: False. Use and fill the in memory cache.
+    sidecar : bool or str
+        Default: False. If True, use and write a binary sidecar in
+        readwrite.DIR_CACHE. A str names a different directory for the
+        sidecar.
+    features : iterable
+        Default: None, i.e. all features. Restrict the table to these
+        features.
+    samples : iterable
+        Default: None, i.e. all samples. Restrict the table to these samples.
+
+    Returns
+    -------
+    _ParsedBiom, which must not be modified since it might be shared.
+
+    Notes
+    -----
+    With a cache tier in use, the complete table is loaded and cached, and
+    restricted in memory, such that repeated selections from the same file
+    are served from the cache. Without cache and sidecar, only the selected
+    parts of BIOM HDF5 files are read.
+    """
+    key = _biom_cache_key(file_biom)
+    file_biom = key[0]
+    if cache and key in _BIOM_CACHE:
+        _BIOM_CACHE.move_to_end(key)
+        return _BIOM_CACHE[key].subset(features, samples)
+
+    parsed = None
+    if sidecar:
+        dir_cache = DIR_CACHE if sidecar is True else sidecar
+        file_sidecar, pattern = _get_cache_filename(file_biom, 'biom',
+                                                    dir_cache)
+        if _is_binary_file(file_sidecar, MAGIC_BIOM):
+            parsed = _read_biom_sidecar(file_sidecar)
+    if parsed is None:
+        if (not cache) and (not sidecar) and \
+                ((features is not None) or (samples is not None)) and \
+                _is_binary_file(file_biom, MAGIC_HDF5):
+            return _parse_biom_subset(file_biom, features, samples)
+        parsed = _parse_biom(file_biom)
+        if sidecar:
+            # failing to write the sidecar, e.g. due to missing permissions,
+            # is not an error, since it only speeds up future loads
+            try:
+                for file_stale in glob.glob(pattern):
+                    os.remove(file_stale)
+                os.makedirs(dir_cache, exist_ok=True)
+                fh, file_tmp = mkstemp(dir=dir_cache, suffix='.tmp')
+                os.close(fh)
+                _write_biom_sidecar(file_tmp, parsed)
+                os.replace(file_tmp, file_sidecar)
+            except (IOError, OSError):
+                pass
+
+    if cache:
+        # forget older versions of the same file
+        for stale in [k for k in _BIOM_CACHE if k[0] == file_biom]:
+            del _BIOM_CACHE[stale]
+        budget = settings.BIOM_CACHE_MB * (1 << 20)
+        if parsed.nbytes <= budget:
+            _BIOM_CACHE[key] = parsed
+            total = sum(p.nbytes for p in _BIOM_CACHE.values())
+            while total > budget:
+                total -= _BIOM_CACHE.popitem(last=False)[1].nbytes
+    return parsed.subset(features, samples)
+
+
+def _load_biom_ids(file_biom, cache=False, sidecar=False):
+    """ Feature and sample IDs of a BIOM file, without reading its counts.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray): feature and sample IDs.
+    """
+    key = _biom_cache_key(file_biom)
+    if cache and key in _BIOM_CACHE:
+        parsed = _BIOM_CACHE[key]
+    elif _is_binary_file(file_biom, MAGIC_HDF5):
+        with h5py.File(file_biom, 'r') as f:
+            return (_read_hdf5_ids(f['observation']),
+                    _read_hdf5_ids(f['sample']))
+    else:
+        parsed = _load_biom(file_biom, cache=cache, sidecar=sidecar)
+    return parsed.observation_ids, parsed.sample_ids
+
+
+def biom2pandas(file_biom, withTaxonomy=False, astype=int, sparse=False,
+                cache=False, sidecar=False, samples=None, features=None,
+                ids_only=False):
     """ Converts a biom file into a Pandas.DataFrame
 
     Parameters
@@ -41,12 +399,39 @@ def biom2pandas(file_biom, withTaxonomy=False, astype=int):
         datatype into each value of the biom table is casted. Default: int.
         Use e.g. float if biom table contains relative abundances instead of
         raw reads.
+    sparse : bool
+        Default: False. If True, the DataFrame holds sparse columns, i.e.
+        pandas.SparseDtype with fill value 0, built from the biom file's
+        sparse matrix without ever creating a dense copy.
+    cache : bool
+        Default: False. If True, keep the parsed table in memory, such that
+        loading the same, unchanged file again does not parse it. The cache
+        is shared by the whole process and its memory budget is
+        settings.BIOM_CACHE_MB. Returned objects are never shared with the
+        cache.
+    sidecar : bool or str
+        Default: False. If True, store the parsed table in a binary file in
+        readwrite.DIR_CACHE, which is memory mapped by later loads, also of
+        other processes. A str names a different directory for the file.
+    samples : iterable
+        Default: None, i.e. all samples. Only return these samples, in the
+        order of the biom file. Samples that are not in the biom file are
+        ignored. For biom files in HDF5 format and cache=False, only the
+        counts of these samples are read from disk.
+    features : iterable
+        Default: None, i.e. all features. Only return these features, like
+        samples.
+    ids_only : bool
+        Default: False. If True, return the feature and sample IDs of the biom
+        file, but do not read counts or taxonomy.
 
     Returns
     -------
     A Pandas.DataFrame holding holding numerical values from the biom file.
     If withTaxonomy is TRUE then a second Pandas.DataFrame is returned, holding
     lineage information about each feature.
+    If ids_only is True, two Pandas.Index with feature and sample IDs, i.e.
+    index and columns of the DataFrame.
 
     Raises
     ------
@@ -56,32 +441,35 @@ def biom2pandas(file_biom, withTaxonomy=False, astype=int):
         If withTaxonomy=TRUE but biom file does not hold taxonomy information.
     """
     try:
-        table = biom.load_table(file_biom)
-        counts = pd.DataFrame(table.matrix_data.T.todense().astype(astype),
-                              index=table.ids(axis='sample'),
-                              columns=table.ids(axis='observation')).T
-        if withTaxonomy:
-            try:
-                md = table.metadata_to_dataframe('observation')
-                levels = [col
-                          for col in md.columns
-                          if col.startswith('taxonomy_')]
-                if levels == []:
-                    raise ValueError(('No taxonomy information found in '
-                                      'biom file.'))
-                else:
-                    taxonomy = md.apply(lambda row:
-                                        ";".join([row[l] for l in levels]),
-                                        axis=1)
-                    return counts, taxonomy
-            except KeyError:
-                raise ValueError(('Biom file does not have any '
-                                  'observation metadata!'))
-        else:
-            return counts
+        if ids_only:
+            ids = _load_biom_ids(file_biom, cache=cache, sidecar=sidecar)
+            result = []
+            for axis_ids, selection in zip(ids, [features, samples]):
+                if selection is not None:
+                    axis_ids = axis_ids[_positions(axis_ids, selection)]
+                result.append(pd.Index(axis_ids))
+            return tuple(result)
+        parsed = _load_biom(file_biom, cache=cache, sidecar=sidecar,
+                            features=features, samples=samples)
     except IOError:
         raise IOError('Cannot read file "%s"' % file_biom)
 
+    # astype copies the values, i.e. cached tables cannot be altered
+    data = parsed.data.astype(astype)
+    if sparse:
+        data.eliminate_zeros()
+        counts = pd.DataFrame.sparse.from_spmatrix(
+            data, index=parsed.observation_ids, columns=parsed.sample_ids)
+    else:
+        counts = pd.DataFrame(data.toarray(), index=parsed.observation_ids,
+                              columns=parsed.sample_ids)
+    if withTaxonomy:
+        if not isinstance(parsed.lineages, pd.Series):
+            raise ValueError(parsed.lineages)
+        return counts, parsed.lineages.copy()
+    else:
+        return counts
+
 
 def pandas2biom(file_biom, table, taxonomy=None, err=sys.stderr):
     """ Writes a Pandas.DataFrame into a biom file.
@@ -91,10 +479,15 @@ def pandas2biom(file_biom, table, taxonomy=None, err=sys.stderr):
     file_biom: str
         The filename of the BIOM file to be created.
     table: a Pandas.DataFrame
-        The table that should be written as BIOM.
+        The table that should be written as BIOM. Tables with sparse columns,
+        e.g. from biom2pandas(..., sparse=True), are written without
+        densifying them.
     taxonomy : pandas.Series
         Index is taxons corresponding to table, values are lineage strings like
-        'k__Bacteria; p__Actinobacteria'
+        'k__Bacteria; p__Actinobacteria'. Lineages are normalized to one
+        annotation per rank of settings.RANKS, see _normalize_lineages. Taxa
+        of table without lineage are stored with unknown ranks only. Taxa of
+        taxonomy that are not in table are reported to err, but not stored.
     err : StringIO
         Stream onto which errors / warnings should be printed.
         Default is sys.stderr
@@ -108,7 +501,11 @@ def pandas2biom(file_biom, table, taxonomy=None, err=sys.stderr):
         1) also store taxonomy information
     """
     try:
-        bt = biom.Table(table.values,
+        if _is_sparse(table):
+            data = table.sparse.to_coo().tocsr()
+        else:
+            data = table.values
+        bt = biom.Table(data,
                         observation_ids=table.index,
                         sample_ids=table.columns)
 
@@ -129,21 +526,10 @@ def pandas2biom(file_biom, table, taxonomy=None, err=sys.stderr):
                           len(idx_missing_intaxonomy),
                           ", ".join(idx_missing_intaxonomy)))
 
-            t = dict()
-            for taxon, linstr in taxonomy.iteritems():
-                # fill missing rank annotations with rank__
-                orig_lineage = {annot[0].lower(): annot
-                                for annot
-                                in (map(str.strip, linstr.split(';')))}
-                lineage = []
-                for rank in settings.RANKS:
-                    rank_char = rank[0].lower()
-                    if rank_char in orig_lineage:
-                        lineage.append(orig_lineage[rank_char])
-                    else:
-                        lineage.append(rank_char+'__')
-                t[taxon] = {'taxonomy': ";".join(lineage)}
-            bt.add_metadata(t, axis='observation')
+            lineages = _normalize_lineages(taxonomy.reindex(table.index))
+            bt.add_metadata({taxon: {'taxonomy': lineage}
+                             for taxon, lineage in lineages.items()},
+                            axis='observation')
 
         with biom_open(file_biom, 'w') as f:
             bt.to_hdf5(f, "example")
@@ -151,6 +537,155 @@ def pandas2biom(file_biom, table, taxonomy=None, err=sys.stderr):
         raise IOError('Cannot write to file "%s"' % file_biom)
 
 
+def _normalize_lineages(lineages):
+    """ Normalizes lineage strings to one annotation per rank.
+
+    Lineages are split on ';' and annotations are assigned to the rank of
+    settings.RANKS with the same first character, e.g. 'p__Firmicutes' to
+    Phylum. If a lineage holds several annotations for the same rank, the
+    last one wins. Missing ranks are filled with e.g. 'g__'. All steps are
+    vectorized string operations over all lineages at once.
+
+    Parameters
+    ----------
+    lineages : pandas.Series
+        Lineage strings like 'k__Bacteria; p__Actinobacteria'. Missing values
+        are treated as empty lineages.
+
+    Returns
+    -------
+    pandas.Series with the same index: ';' joined lineages with one
+    annotation for each rank, e.g. 'k__Bacteria;p__Actinobacteria;c__;...'
+    """
+    # string operations only run on distinct lineages and annotations, since
+    # many features share the same lineage
+    codes, uniques = pd.factorize(lineages.fillna('').astype(str))
+    parts = pd.Series(uniques, dtype=object).str.split(';').explode()
+    part_codes, part_uniques = pd.factorize(parts.values)
+    part_uniques = pd.Series(part_uniques, dtype=object).str.strip()
+    part_ranks = part_uniques.str.slice(0, 1).str.lower()
+
+    chars = [rank[0].lower() for rank in settings.RANKS]
+    columns = {char: i for i, char in enumerate(chars)}
+    annotations = pd.DataFrame({
+        'row': parts.index.values,
+        'annotation': part_uniques.values[part_codes],
+        'column': part_ranks.map(columns).values[part_codes]})
+    annotations = annotations[annotations['annotation'] != '']\
+        .dropna(subset=['column'])\
+        .drop_duplicates(subset=['row', 'column'], keep='last')
+
+    # fill a lineages x ranks table with unknown ranks and known annotations
+    ranks = np.array([[char + '__' for char in chars]] * len(uniques),
+                     dtype=object).reshape(len(uniques), len(chars))
+    ranks[annotations['row'].values,
+          annotations['column'].values.astype(int)] = \
+        annotations['annotation'].values
+    normalized = pd.Series(ranks[:, 0], dtype=object)
+    if len(chars) > 1:
+        normalized = normalized.str.cat(
+            [pd.Series(ranks[:, i], dtype=object)
+             for i in range(1, len(chars))], sep=';')
+    return pd.Series(normalized.values[codes], index=lineages.index,
+                     dtype=object)
+
+
+def _is_sparse(table):
+    """ True if all columns of a pandas.DataFrame are sparse."""
+    return (table.shape[1] > 0) and \
+        all(isinstance(dtype, pd.SparseDtype) for dtype in table.dtypes)
+
+
+def _encode_ranks(lineages, ranks):
+    """ Parses lineages once into integer coded taxa of several ranks.
+
+    Lineage strings are split on ';' and surrounding whitespaces are removed.
+    The i-th taxon of a lineage belongs to rank settings.RANKS[i]. Lineages
+    that are too short get the unknown taxon of the rank instead, e.g.
+    'f__'. Every distinct lineage string is parsed only once.
+
+    Parameters
+    ----------
+    lineages : pandas.Series
+        The lineage string of every feature.
+    ranks : [str]
+        Taxonomic ranks, all from settings.RANKS.
+
+    Returns
+    -------
+    dict of rank: (numpy.ndarray, numpy.ndarray). For each rank, the position
+    of every feature's taxon in the sorted taxa of this rank, or -1 if the
+    lineage of the feature is missing, together with the sorted taxa.
+    """
+    lineage_codes, uniques = pd.factorize(lineages)
+    is_str = np.array([isinstance(lineage, str) for lineage in uniques],
+                      dtype=bool)
+    parts = pd.Series(uniques[is_str], dtype=object).str.split(
+        ';', expand=True)
+
+    encoded = {}
+    for rank in ranks:
+        level = settings.RANKS.index(rank)
+        if level in parts.columns:
+            taxa = parts[level].str.strip()
+        else:
+            taxa = pd.Series(None, index=parts.index, dtype=object)
+        taxa = taxa.fillna(rank.lower()[0] + '__')
+        unique_codes, taxa = pd.factorize(taxa, sort=True)
+        # codes of all distinct lineages, followed by -1 for missing ones
+        codes = np.full(len(uniques) + 1, -1, dtype=np.int64)
+        codes[:-1][is_str] = unique_codes
+        encoded[rank] = (codes[lineage_codes], np.asarray(taxa, dtype=object))
+    return encoded
+
+
+def _collapse_ranks(counts, lineages, ranks):
+    """ Sums counts of features with the same taxon, for several ranks.
+
+    Lineages are parsed once for all ranks, see _encode_ranks. Counts are then
+    aggregated by multiplying a sparse indicator matrix of taxa with the
+    counts. Like DataFrame.groupby, features without lineage are dropped and
+    taxa are sorted.
+
+    Parameters
+    ----------
+    counts : pandas.DataFrame
+        Dense or sparse counts, features x samples.
+    lineages : pandas.Series
+        Lineage strings, indexed by features.
+    ranks : [str]
+        Taxonomic ranks, all from settings.RANKS.
+
+    Returns
+    -------
+    dict of rank: pandas.DataFrame, holding one row per taxon. Columns are
+    sparse, if they are in counts.
+    """
+    sparse = _is_sparse(counts)
+    if sparse:
+        data = counts.sparse.to_coo().tocsr()
+    else:
+        data = counts.values
+    features = np.arange(counts.shape[0])
+
+    collapsed = dict()
+    for rank, (codes, taxa) in _encode_ranks(
+            lineages.reindex(counts.index), ranks).items():
+        valid = codes >= 0
+        indicator = csr_matrix(
+            (np.ones(valid.sum(), dtype=data.dtype),
+             (codes[valid], features[valid])),
+            shape=(len(taxa), counts.shape[0]))
+        index = pd.Index(taxa, name=rank)
+        if sparse:
+            collapsed[rank] = pd.DataFrame.sparse.from_spmatrix(
+                indicator.dot(data), index=index, columns=counts.columns)
+        else:
+            collapsed[rank] = pd.DataFrame(
+                indicator.dot(data), index=index, columns=counts.columns)
+    return collapsed
+
+
 def parse_splitlibrarieslog(filename):
     """ Parse the log of a QIIME split_libraries_xxx.py run.
 
@@ -355,7 +890,8 @@ def _get_sample_numbers(num_samples, fields, names):
 
 def collapseCounts(file_otutable, rank,
                    file_taxonomy=None,
-                   verbose=True, out=sys.stdout, astype=int):
+                   verbose=True, out=sys.stdout, astype=int, sparse=False,
+                   cache=False, sidecar=False, samples=None):
     """Collapses features of an OTU table according to their taxonomic
        assignment and a given rank.
 
@@ -363,9 +899,10 @@ def collapseCounts(file_otutable, rank,
     ----------
     file_otutable : file
         Path to a biom OTU table
-    rank : str
+    rank : str or [str]
         Set taxonomic level to collapse abundances. Use 'raw' to de-activate
-        collapsing.
+        collapsing. A list of levels collapses to all of them in one pass,
+        i.e. the OTU table is read and lineages are parsed only once.
     file_taxonomy : file
         Taxonomy information is read from the biom file. Except you provide an
         alternative taxonomy in terms of a two column file. First column must
@@ -380,73 +917,73 @@ def collapseCounts(file_otutable, rank,
         datatype into each value of the biom table is casted. Default: int.
         Use e.g. float if biom table contains relative abundances instead of
         raw reads.
+    sparse : bool
+        Default: False. If True, read the OTU table as sparse DataFrame, see
+        biom2pandas, and sum counts of features via sparse matrix products,
+        i.e. without ever densifying the OTU table.
+    cache : bool
+        Default: False. Keep the OTU table in the in memory cache of the
+        process, see biom2pandas.
+    sidecar : bool or str
+        Default: False. Memory map the OTU table from a binary sidecar file,
+        see biom2pandas.
+    samples : iterable
+        Default: None, i.e. all samples. Only collapse counts of these
+        samples, see biom2pandas.
 
     Returns
     -------
-    Pandas.DataFrame: counts of collapsed taxa.
+    Pandas.DataFrame: counts of collapsed taxa. Columns are sparse, if sparse
+    is True. Features without lineage are dropped.
+    If rank is a list: a dict of rank: Pandas.DataFrame.
     """
+    ranks = [rank] if isinstance(rank, str) else list(rank)
     # check that rank is a valid taxonomic rank
-    if rank not in settings.RANKS + ['raw']:
-        raise ValueError('"%s" is not a valid taxonomic rank. Choose from %s' %
-                         (rank, ", ".join(settings.RANKS)))
+    for r in ranks:
+        if r not in settings.RANKS + ['raw']:
+            raise ValueError(
+                '"%s" is not a valid taxonomic rank. Choose from %s' %
+                (r, ", ".join(settings.RANKS)))
+    tax_ranks = [r for r in ranks if r != 'raw']
 
     # check that biom table can be read
     if not os.path.exists(file_otutable):
         raise IOError('OTU table file not found')
 
-    counts, taxonomy = None, None
+    counts, lineages = None, None
     if file_taxonomy is None:
-        counts, taxonomy = biom2pandas(file_otutable, withTaxonomy=True,
-                                       astype=astype)
-        taxonomy.name = 'taxonomy'
-        rank_counts = pd.merge(counts, taxonomy.to_frame(), how='left',
-                               left_index=True, right_index=True)
+        counts, lineages = biom2pandas(file_otutable, withTaxonomy=True,
+                                       astype=astype, sparse=sparse,
+                                       cache=cache, sidecar=sidecar,
+                                       samples=samples)
     else:
         # check that taxonomy file exists
-        if (not os.path.exists(file_taxonomy)) and (rank != 'raw'):
+        if (not os.path.exists(file_taxonomy)) and (tax_ranks != []):
             raise IOError('Taxonomy file not found!')
 
-        counts = biom2pandas(file_otutable, withTaxonomy=False, astype=astype)
-        if rank != 'raw':
+        counts = biom2pandas(file_otutable, withTaxonomy=False, astype=astype,
+                             sparse=sparse, cache=cache, sidecar=sidecar,
+                             samples=samples)
+        if tax_ranks != []:
             taxonomy = pd.read_csv(file_taxonomy, sep="\t", header=None,
                                    names=['otuID', 'taxonomy'],
                                    usecols=[0, 1])  # only parse 2 first cols
             taxonomy['otuID'] = taxonomy['otuID'].astype(str)
             taxonomy.set_index('otuID', inplace=True)
-            # add taxonomic lineage information to the counts as
-            # column "taxonomy"
-            rank_counts = pd.merge(counts, taxonomy, how='left',
-                                   left_index=True, right_index=True)
-
-    if rank != 'raw':
-        # split lineage string into individual taxa names on ';' and remove
-        # surrounding whitespaces. If rank does not exist return r+'__' instead
-        def _splitranks(x, rank):
-            try:
-                return [t.strip()
-                        for t
-                        in x.split(";")][settings.RANKS.index(rank)]
-            except AttributeError:
-                # e.g. if lineage string is missing
-                settings.RANKS[settings.RANKS.index(rank)].lower()[0] + "__"
-            except IndexError:
-                return settings.RANKS[
-                    settings.RANKS.index(rank)].lower()[0] + "__"
-        # add columns for each tax rank, such that we can groupby later on
-        rank_counts[rank] = rank_counts['taxonomy'].apply(lambda x:
-                                                          _splitranks(x, rank))
-        # sum counts according to the selected rank
-        rank_counts = rank_counts.reset_index().groupby(rank).sum()
-        # get rid of the old index, i.e. OTU ids, since we have grouped by some
-        # rank
+            lineages = taxonomy['taxonomy']
 
-        if verbose:
+    collapsed = {'raw': counts}
+    if tax_ranks != []:
+        # sum counts of features with the same taxon, for all ranks at once
+        collapsed.update(_collapse_ranks(counts, lineages, tax_ranks))
+    if verbose:
+        for r in tax_ranks:
             out.write('%i taxa left after collapsing to %s.\n' %
-                      (rank_counts.shape[0], rank))
-    else:
-        rank_counts = counts
+                      (collapsed[r].shape[0], r))
 
-    return rank_counts
+    if isinstance(rank, str):
+        return collapsed[rank]
+    return {r: collapsed[r] for r in ranks}
 
 
 def plotTaxonomy(file_otutable,
@@ -471,7 +1008,10 @@ def plotTaxonomy(file_otutable,
                  no_sample_numbers=False,
                  colors=None,
                  min_abundance_grayscale=0,
-                 ax=None):
+                 ax=None,
+                 sparse=False,
+                 cache=False,
+                 sidecar=False):
     """Plot taxonomy.
 
     Parameters
@@ -523,6 +1063,16 @@ def plotTaxonomy(file_otutable,
     ax : plt.axis
         Plot on this axis instead of creating a new figure. Only works if
         number of group levels is <= 2.
+    sparse : bool
+        Default is False. If True, the OTU table is read and collapsed as
+        sparse table, see collapseCounts, and only the collapsed counts of
+        samples with metadata are densified for plotting.
+    cache : bool
+        Default: False. Keep the OTU table in the in memory cache of the
+        process, see biom2pandas.
+    sidecar : bool or str
+        Default: False. Memory map the OTU table from a binary sidecar file,
+        see biom2pandas.
 
     Returns
     -------
@@ -545,13 +1095,17 @@ def plotTaxonomy(file_otutable,
     if taxonomy_from_biom:
         ft = None
     rawcounts = collapseCounts(file_otutable, rank, file_taxonomy=ft,
-                               verbose=verbose, out=out)
+                               verbose=verbose, out=out, sparse=sparse,
+                               cache=cache, sidecar=sidecar,
+                               samples=metadata.index)
 
     # restrict to those samples for which we have metadata AND counts
     meta = metadata.loc[[idx
                          for idx in metadata.index
                          if idx in rawcounts.columns], :]
     rank_counts = rawcounts.loc[:, meta.index]
+    if sparse:
+        rank_counts = rank_counts.sparse.to_dense()
     if verbose:
         out.write('%i samples left with metadata and counts.\n' %
                   meta.shape[0])
@@ -12,6 +12,7 @@ from tempfile import mkstemp
 
 from skbio.util import get_data_path
 import pandas as pd
+from pandas.testing import assert_frame_equal
 
 from ggmap.snippets import plotTaxonomy, pandas2biom
 from ggmap.imgdiff import compare_images
@@ -707,6 +708,12 @@ class TaxPlotTests(TestCase):
         plt.close(f)
         self.assertCountEqual(['p__fantasia', 'p__'], rank_counts.index)
 
+        f, rank_counts_sparse, _, _, _ = plotTaxonomy(
+            file_dummy, meta, rank='Phylum', file_taxonomy=file_lin,
+            minreadnr=0, out=out, sparse=True)
+        plt.close(f)
+        assert_frame_equal(rank_counts_sparse, rank_counts)
+
         remove(file_dummy)
         remove(file_lin)
 
@@ -1,6 +1,15 @@
 from unittest import TestCase, main
 import filecmp
 import tempfile
+import shutil
+import os
+import gzip
+import bz2
+import lzma
+import tarfile
+from unittest.mock import patch
+
+import numpy as np
 
 from skbio.util import get_data_path
 
@@ -8,7 +17,13 @@ from ggmap.readwrite import read_ncbi_nodes, read_metaphlan_markers_info, \
                             read_taxid_list, _read_ncbitaxonomy_file, \
                             read_ncbi_merged, read_gg_accessions, \
                             read_gg_otu_map, write_clade2otus_map, \
-                            read_clade2otus_map, read_metaphlan_profile
+                            read_clade2otus_map, read_metaphlan_profile, \
+                            TaxidMap, read_ncbi_ranks, \
+                            read_metaphlan_markers_table, \
+                            metaphlan_markers_to_dict, iter_gg_otu_map, \
+                            index_gg_accessions, read_metaphlan_profiles, \
+                            Clade2OTUsMap, TaxidStore, _open, \
+                            parse_parallel, _get_byte_ranges
 
 
 class ReadWriteTests(TestCase):
@@ -166,6 +181,160 @@ class ReadWriteTests(TestCase):
         with self.assertRaises(IOError):
             read_ncbi_nodes('/tmp/non')
 
+    def test_read_ncbi_nodes_cache(self):
+        dir_cache = tempfile.mkdtemp()
+        try:
+            nodes = read_ncbi_nodes(self.file_nodes, cache=True,
+                                    dir_cache=dir_cache)
+            self.assertEqual(len(os.listdir(dir_cache)), 1)
+            self.assertNotIsInstance(nodes.array, np.memmap)
+
+            cached = read_ncbi_nodes(self.file_nodes, cache=True,
+                                     dir_cache=dir_cache)
+            self.assertIsInstance(cached.array, np.memmap)
+            self.assertEqual(self.true_nodes, cached)
+
+            # caching is opt-in
+            nodes = read_ncbi_nodes(self.file_nodes, dir_cache=dir_cache)
+            self.assertNotIsInstance(nodes.array, np.memmap)
+            self.assertEqual(self.true_nodes, nodes)
+        finally:
+            shutil.rmtree(dir_cache)
+
+    def test_read_compressed(self):
+        dir_tmp = tempfile.mkdtemp()
+        try:
+            # compression is detected by content, not by file extension
+            files = {}
+            for name, opener in [('gz', gzip.open), ('bz2', bz2.open),
+                                 ('xz', lzma.open)]:
+                files[name] = os.path.join(dir_tmp, 'nodes_%s.dmp' % name)
+                with open(self.file_nodes, 'rb') as src, \
+                        opener(files[name], 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            file_tar = os.path.join(dir_tmp, 'taxdump.tar.gz')
+            with tarfile.open(file_tar, 'w:gz') as tar:
+                tar.add(self.file_names, arcname='names.dmp')
+                tar.add(self.file_nodes, arcname='./nodes.dmp')
+                tar.add(self.file_example_profile, arcname='sub/profile.txt')
+            files['tar'] = os.path.join(file_tar, 'nodes.dmp')
+
+            for filename in files.values():
+                self.assertEqual(self.true_nodes,
+                                 read_ncbi_nodes(filename, cache=False))
+            self.assertEqual(
+                read_ncbi_ranks(files['tar'], cache=False)[1],
+                read_ncbi_ranks(self.file_nodes, cache=False)[1])
+            self.assertEqual(
+                read_metaphlan_profile(os.path.join(file_tar,
+                                                    'sub/profile.txt')),
+                read_metaphlan_profile(self.file_example_profile))
+
+            # caches of archive members become stale with the archive
+            nodes = read_ncbi_nodes(files['tar'], cache=True,
+                                    dir_cache=dir_tmp)
+            cached = read_ncbi_nodes(files['tar'], cache=True,
+                                     dir_cache=dir_tmp)
+            self.assertIsInstance(cached.array, np.memmap)
+            self.assertEqual(nodes, cached)
+
+            with _open(files['tar'], 'rb') as f:
+                with open(self.file_nodes, 'rb') as g:
+                    self.assertEqual(f.read(), g.read())
+
+            with self.assertRaises(IOError):
+                read_ncbi_nodes(os.path.join(file_tar, 'merged.dmp'))
+            with self.assertRaises(IOError):
+                read_ncbi_nodes(os.path.join(files['gz'], 'nodes.dmp'))
+            with self.assertRaises(IOError):
+                read_metaphlan_profile(os.path.join(dir_tmp, 'no/file'))
+        finally:
+            shutil.rmtree(dir_tmp)
+
+    def test_parse_parallel(self):
+        ranges = _get_byte_ranges(self.file_mptaxids, 4, header=True)
+        self.assertEqual(len(ranges), 4)
+        with open(self.file_mptaxids, 'rb') as f:
+            header = f.readline()
+            content = f.read()
+        self.assertEqual(ranges[0][0], len(header))
+        self.assertEqual(ranges[-1][1], len(header) + len(content))
+        for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(content[end - len(header) - 1:
+                                     end - len(header)], b'\n')
+
+        with patch('ggmap.readwrite.PARALLEL_CHUNK_SIZE', 64):
+            chunks = parse_parallel(self.file_nodes, list, processes=3)
+            self.assertTrue(len(chunks) > 1)
+            with open(self.file_nodes, 'r') as f:
+                self.assertEqual(sum(chunks, []), f.readlines())
+
+            self.assertEqual(self.true_nodes,
+                             read_ncbi_nodes(self.file_nodes, cache=False,
+                                             processes=3))
+            self.assertEqual(self.true_mptaxids,
+                             read_taxid_list(self.file_mptaxids,
+                                             processes=3))
+            self.assertEqual(self.true_accessions,
+                             read_gg_accessions(self.file_accessions,
+                                                processes=3))
+            with self.assertRaises(ValueError):
+                read_taxid_list(self.file_names, processes=3)
+
+    def test_read_ncbi_ranks(self):
+        codes, names = read_ncbi_ranks(self.file_nodes, cache=False)
+        self.assertEqual({taxid: names[codes[taxid]]
+                          for taxid in self.true_nodes},
+                         {16: 'genus', 1: 'no rank', 2: 'superkingdom',
+                          6: 'genus', 7: 'species', 9: 'species',
+                          10: 'genus', 11: 'species', 13: 'genus',
+                          14: 'species'})
+        self.assertEqual(codes[3], -1)
+
+        with self.assertRaises(IOError):
+            read_ncbi_ranks('/tmp/non')
+
+    def test_TaxidMap(self):
+        taxids = TaxidMap(np.array([-1, 1, 1, -1, 2], dtype=np.int32))
+        self.assertEqual(len(taxids), 3)
+        self.assertEqual(list(taxids), [1, 2, 4])
+        self.assertEqual(taxids[4], 2)
+        self.assertIn(2, taxids)
+        self.assertNotIn(3, taxids)
+        self.assertNotIn(-1, taxids)
+        self.assertNotIn(99, taxids)
+        self.assertNotIn('1', taxids)
+        self.assertEqual(set(taxids.values()), {1, 2})
+        self.assertEqual(dict(taxids), {1: 1, 2: 1, 4: 2})
+        with self.assertRaises(KeyError):
+            taxids[3]
+        with self.assertRaises(KeyError):
+            taxids[-1]
+
+        # entries can be changed, added and deleted like in a dict
+        taxids[1] = 4
+        taxids[7] = 1
+        del taxids[2]
+        self.assertEqual(dict(taxids), {1: 4, 4: 2, 7: 1})
+        self.assertEqual(len(taxids), 3)
+        with self.assertRaises(KeyError):
+            del taxids[2]
+        with self.assertRaises(ValueError):
+            taxids[3] = -1
+        with self.assertRaises(ValueError):
+            taxids['3'] = 1
+        taxids[1] = 2**40
+        self.assertEqual(taxids[1], 2**40)
+
+        # read-only arrays, e.g. memory mapped caches, are copied
+        array = np.array([-1, 1, 1], dtype=np.int32)
+        array.flags.writeable = False
+        taxids = TaxidMap(array)
+        taxids[2] = 5
+        self.assertEqual(array.tolist(), [-1, 1, 1])
+        self.assertEqual(dict(taxids), {1: 1, 2: 5})
+
     def test_read_ncbi_merged(self):
         nodes = read_ncbi_merged(self.file_merged)
         self.assertEqual(self.true_merged, nodes)
@@ -185,6 +354,22 @@ class ReadWriteTests(TestCase):
 
         self.assertEqual({}, read_metaphlan_markers_info(self.file_nodes))
 
+    def test_read_metaphlan_markers_table(self):
+        markers = read_metaphlan_markers_table(self.file_mpmarkers)
+        self.assertEqual(markers.shape, (12, 3))
+        self.assertEqual(len(markers['clade'].cat.categories), 10)
+        self.assertCountEqual(markers['type'].cat.categories,
+                              ['gi', 'GeneID', 'NC'])
+        self.assertEqual(list(markers.iloc[3]),
+                         ['s__Cypovirus_15', 'NC', 'NC_002560.1'])
+        self.assertEqual(self.true_marker, metaphlan_markers_to_dict(markers))
+
+        self.assertEqual(read_metaphlan_markers_table(self.file_nodes).shape,
+                         (0, 3))
+
+        with self.assertRaises(IOError):
+            read_metaphlan_markers_table('/tmp/non')
+
     def test_read_taxid_list(self):
         self.assertEqual(self.true_mptaxids,
                          read_taxid_list(self.file_mptaxids))
@@ -197,6 +382,47 @@ class ReadWriteTests(TestCase):
         with self.assertRaises(ValueError):
             read_taxid_list(self.file_names)
 
+    def test_TaxidStore(self):
+        dir_tmp = tempfile.mkdtemp()
+        file_store = os.path.join(dir_tmp, 'taxids.sqlite')
+        store = TaxidStore(file_store)
+        self.assertTrue(store.add_file(self.file_mptaxids))
+        self.assertTrue(store.add_file(self.file_gg_taxids))
+        # unchanged files are not imported twice
+        self.assertFalse(store.add_file(self.file_mptaxids))
+        true_taxids = {**self.true_mptaxids, **self.true_gg_taxids}
+        self.assertEqual(store.to_dict(), true_taxids)
+        self.assertEqual(read_taxid_list(store), true_taxids)
+        self.assertEqual(len(store), sum(map(len, true_taxids.values())))
+
+        accessions = list(self.true_mptaxids['gi'])
+        self.assertEqual(store.lookup(accessions + ['unknown']),
+                         self.true_mptaxids['gi'])
+        self.assertEqual(store.lookup(accessions, type='NC'), {})
+
+        store.insert({'unknown': 5, accessions[0]: -1}, type='gi')
+        self.assertEqual(store.lookup(['unknown', accessions[0]]),
+                         {'unknown': 5, accessions[0]: -1})
+        store.close()
+
+        # export from the database file, merging into an existing dict
+        res = read_taxid_list(file_store, {'other': {'1': 2}})
+        self.assertEqual(res['other'], {'1': 2})
+        self.assertEqual(res['gi']['unknown'], 5)
+
+        file_log = os.path.join(dir_tmp, 'log.txt')
+        with open(file_log, 'w') as f:
+            f.write('#Accession\ttaxid\nX1\t7\nX2\t-1\n')
+        store = TaxidStore(file_store)
+        store.add_file(file_log, type='')
+        self.assertEqual(store.lookup(['X1', 'X2']), {'X1': 7, 'X2': -1})
+        with self.assertRaises(ValueError):
+            store.add_file(self.file_names)
+        with self.assertRaises(IOError):
+            store.add_file('/tmp/non')
+        store.close()
+        shutil.rmtree(dir_tmp)
+
     def test__read_ncbitaxonomy_file(self):
         self.assertEqual(self.true_nodes,
                          _read_ncbitaxonomy_file(self.file_nodes))
@@ -231,6 +457,22 @@ class ReadWriteTests(TestCase):
         with self.assertRaises(ValueError):
             read_gg_otu_map(self.file_names, gg_accessions)
 
+    def test_iter_gg_otu_map(self):
+        index = index_gg_accessions(read_gg_accessions(self.file_accessions))
+        self.assertEqual(index[13988], [('Genbank', 'X71860.1')])
+
+        otus = iter_gg_otu_map(self.file_gg_otumap, None, index=index)
+        self.assertEqual(next(otus), (11054, {'Genbank': {'ACDO01000013.1'}}))
+        self.assertEqual(dict(otus),
+                         {otu: members
+                          for otu, members in self.true_gg_otumap.items()
+                          if otu != 11054})
+        self.assertEqual(read_gg_otu_map(self.file_gg_otumap, None, index),
+                         self.true_gg_otumap)
+
+        with self.assertRaises(IOError):
+            next(iter_gg_otu_map('/tmp/non', None, index=index))
+
     def test_write_clade2otus_map(self):
         fh, filename = tempfile.mkstemp()
         write_clade2otus_map(filename, self.true_map)
@@ -246,6 +488,34 @@ class ReadWriteTests(TestCase):
         with self.assertRaises(IOError):
             read_clade2otus_map('/dev')
 
+    def test_clade2otus_map_binary(self):
+        true_map = read_clade2otus_map(self.file_true_map)
+        true_map['s__\u00e4_unicode'] = set()
+        fh, filename = tempfile.mkstemp()
+        os.close(fh)
+        write_clade2otus_map(filename, true_map, binary=True)
+        res = read_clade2otus_map(filename)
+        self.assertIsInstance(res, Clade2OTUsMap)
+        self.assertEqual(len(res), len(true_map))
+        self.assertEqual(list(res), sorted(true_map))
+        self.assertEqual(dict(res), true_map)
+        self.assertNotIn('s__missing', res)
+        self.assertNotIn(None, res)
+        with self.assertRaises(KeyError):
+            res['s__missing']
+
+        # a loaded map can be written again in both formats
+        fh, filename2 = tempfile.mkstemp()
+        os.close(fh)
+        write_clade2otus_map(filename2, res, binary=True)
+        self.assertTrue(filecmp.cmp(filename, filename2, shallow=False))
+        write_clade2otus_map(filename2, res)
+        self.assertEqual(read_clade2otus_map(filename2), true_map)
+        os.remove(filename)
+        os.remove(filename2)
+
+        self.assertEqual(dict(Clade2OTUsMap.from_dict({})), {})
+
     def test_read_metaphlan_profile(self):
         res = read_metaphlan_profile(self.file_example_profile)
         self.assertCountEqual(res, self.true_example_profile)
@@ -265,6 +535,19 @@ class ReadWriteTests(TestCase):
         with self.assertRaises(IOError):
             read_metaphlan_profile('/dev')
 
+    def test_read_metaphlan_profiles(self):
+        files = [self.file_mock_profile, self.file_example_profile]
+        for processes in [1, 2]:
+            res = read_metaphlan_profiles(files, processes=processes)
+            self.assertEqual(list(res.keys()), files)
+            self.assertEqual(res[self.file_mock_profile],
+                             self.true_mock_profile)
+            self.assertEqual(res[self.file_example_profile],
+                             self.true_example_profile)
+
+            with self.assertRaises(IOError):
+                read_metaphlan_profiles(files + ['/dev'], processes=processes)
+
 
 if __name__ == '__main__':
     main()
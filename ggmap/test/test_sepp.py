@@ -2,6 +2,9 @@ from unittest import TestCase, main
 from io import StringIO
 from tempfile import mkstemp
 from os import remove
+from unittest.mock import patch
+
+from pandas.testing import assert_series_equal
 
 from skbio.util import get_data_path
 
@@ -91,6 +94,12 @@ class SeppTests(TestCase):
         self.assertIn('2107103', obs.index)
         self.assertEqual(obs['2107103'], [])
 
+        with patch('ggmap.readwrite.PARALLEL_CHUNK_SIZE', 64):
+            res = read_otumap(self.file_otumap, processes=3)
+        exp = read_otumap(self.file_otumap)
+        assert_series_equal(res[0], exp[0])
+        assert_series_equal(res[1], exp[1])
+
     def test_load_sequences_pynast(self):
         out = StringIO()
         obs = load_sequences_pynast(self.file_pynast,
@@ -1,5 +1,7 @@
 from unittest import TestCase, main
+import numpy as np
 import pandas as pd
+from pandas.testing import assert_frame_equal
 import warnings
 import tempfile
 from io import StringIO
@@ -8,11 +10,15 @@ from biom.table import Table
 from biom.util import biom_open
 from tempfile import mkstemp
 from os import remove
+import os
+import shutil
 
 from skbio.util import get_data_path
 
 from ggmap.snippets import (biom2pandas, pandas2biom, parse_splitlibrarieslog,
-                            _repMiddleValues, _shiftLeft, collapseCounts)
+                            _repMiddleValues, _shiftLeft, collapseCounts,
+                            _normalize_lineages, _BIOM_CACHE, _encode_ranks)
+from ggmap import settings
 
 
 def get_metadata(file_biom):
@@ -160,6 +166,180 @@ class ReadWriteTests(TestCase):
         b = biom2pandas(self.filename_float, astype=float)
         self.assertAlmostEqual(b.sum().sum(), 2.69624884712, places=5)
 
+    def test_biom2pandas_sparse(self):
+        for filename, astype in [(self.filename_minibiom, int),
+                                 (self.filename_float, int),
+                                 (self.filename_float, float)]:
+            b = biom2pandas(filename, astype=astype, sparse=True)
+            self.assertTrue(all(isinstance(dtype, pd.SparseDtype)
+                                for dtype in b.dtypes))
+            assert_frame_equal(b.sparse.to_dense(),
+                               biom2pandas(filename, astype=astype))
+
+        b, t = biom2pandas(self.filename_withtax, withTaxonomy=True,
+                           sparse=True)
+        self.assertCountEqual(b.index, t.index)
+        self.assertEqual(b.sum().sum(), 100273)
+
+    def test_biom2pandas_cache(self):
+        _BIOM_CACHE.clear()
+        # caching is opt-in
+        exp_counts, exp_tax = biom2pandas(self.filename_withtax,
+                                          withTaxonomy=True)
+        self.assertEqual(len(_BIOM_CACHE), 0)
+
+        counts, tax = biom2pandas(self.filename_withtax, withTaxonomy=True,
+                                  cache=True)
+        self.assertEqual(len(_BIOM_CACHE), 1)
+        # returned objects are copies, i.e. altering them does not alter
+        # results of later loads
+        counts.iloc[0, 0] = -1
+        tax.name = 'taxonomy'
+        tax.iloc[0] = 'k__Altered'
+        counts, tax = biom2pandas(self.filename_withtax, withTaxonomy=True,
+                                  cache=True)
+        self.assertEqual(len(_BIOM_CACHE), 1)
+        assert_frame_equal(counts, exp_counts)
+        pd.testing.assert_series_equal(tax, exp_tax)
+        # one entry serves all datatypes
+        assert_frame_equal(biom2pandas(self.filename_withtax, astype=float,
+                                       cache=True),
+                           exp_counts.astype(float))
+        self.assertEqual(len(_BIOM_CACHE), 1)
+
+        # changing the file invalidates the cache
+        dir_tmp = tempfile.mkdtemp()
+        file_biom = os.path.join(dir_tmp, 'table.biom')
+        shutil.copy(self.filename_minibiom, file_biom)
+        biom2pandas(file_biom, cache=True)
+        shutil.copy(self.filename_float, file_biom)
+        os.utime(file_biom, ns=(0, 1))
+        assert_frame_equal(biom2pandas(file_biom, astype=float, cache=True),
+                           biom2pandas(self.filename_float, astype=float,
+                                       cache=False))
+        self.assertEqual(len([key for key in _BIOM_CACHE
+                              if key[0] == file_biom]), 1)
+        shutil.rmtree(dir_tmp)
+
+        # least recently used tables are evicted from a too small budget
+        budget = settings.BIOM_CACHE_MB
+        try:
+            settings.BIOM_CACHE_MB = 0
+            _BIOM_CACHE.clear()
+            biom2pandas(self.filename_minibiom, cache=True)
+            self.assertEqual(len(_BIOM_CACHE), 0)
+            settings.BIOM_CACHE_MB = 1
+            biom2pandas(self.filename_minibiom, cache=True)
+            biom2pandas(self.filename_withtax, cache=True)
+            self.assertEqual(len(_BIOM_CACHE), 2)
+            settings.BIOM_CACHE_MB = \
+                (_BIOM_CACHE[next(reversed(_BIOM_CACHE))].nbytes + 1) / \
+                (1 << 20)
+            biom2pandas(self.filename_float, cache=True)
+            self.assertEqual([os.path.basename(key[0])
+                              for key in _BIOM_CACHE], ['float.biom'])
+        finally:
+            settings.BIOM_CACHE_MB = budget
+            _BIOM_CACHE.clear()
+
+    def test_biom2pandas_sidecar(self):
+        dir_cache = tempfile.mkdtemp()
+        for filename in [self.filename_withtax, self.filename_minibiom]:
+            for astype, sparse in [(int, False), (float, True)]:
+                exp = biom2pandas(filename, astype=astype, sparse=sparse,
+                                  cache=False)
+                # first load writes the sidecar, second one maps it
+                for _ in range(2):
+                    assert_frame_equal(
+                        biom2pandas(filename, astype=astype, sparse=sparse,
+                                    cache=False, sidecar=dir_cache), exp)
+        self.assertEqual(len(os.listdir(dir_cache)), 2)
+
+        exp = biom2pandas(self.filename_withtax, withTaxonomy=True,
+                          cache=False)
+        obs = biom2pandas(self.filename_withtax, withTaxonomy=True,
+                          cache=False, sidecar=dir_cache)
+        assert_frame_equal(obs[0], exp[0])
+        pd.testing.assert_series_equal(obs[1], exp[1])
+        with self.assertRaisesRegex(ValueError,
+                                    'does not have any observation metadata'):
+            biom2pandas(self.filename_minibiom, withTaxonomy=True,
+                        cache=False, sidecar=dir_cache)
+        shutil.rmtree(dir_cache)
+
+    def test_biom2pandas_subset(self):
+        exp_counts, exp_tax = biom2pandas(self.filename_withtax,
+                                          withTaxonomy=True, cache=False)
+        samples = list(exp_counts.columns[[7, 2, 3]]) + ['notInTable']
+        features = list(exp_counts.index[[0, 5, 9]])
+        exp_samples = exp_counts.columns[[2, 3, 7]]
+        # read from the HDF5 file, and from the complete, cached table
+        for cache in [False, True]:
+            if cache:
+                biom2pandas(self.filename_withtax, cache=True)
+            obs = biom2pandas(self.filename_withtax, samples=samples,
+                              cache=cache)
+            assert_frame_equal(obs, exp_counts.loc[:, exp_samples])
+            obs, tax = biom2pandas(self.filename_withtax, withTaxonomy=True,
+                                   features=features, cache=cache)
+            assert_frame_equal(obs, exp_counts.loc[features, :])
+            pd.testing.assert_series_equal(tax, exp_tax.loc[features])
+            obs = biom2pandas(self.filename_withtax, samples=samples,
+                              features=features, sparse=True, cache=cache)
+            assert_frame_equal(obs.sparse.to_dense(),
+                               exp_counts.loc[features, exp_samples])
+            self.assertEqual(
+                biom2pandas(self.filename_withtax, samples=[],
+                            cache=cache).shape, (10, 0))
+
+            obs_features, obs_samples = biom2pandas(
+                self.filename_withtax, ids_only=True, cache=cache)
+            pd.testing.assert_index_equal(obs_features, exp_counts.index)
+            pd.testing.assert_index_equal(obs_samples, exp_counts.columns)
+            obs_features, obs_samples = biom2pandas(
+                self.filename_withtax, ids_only=True, samples=samples,
+                cache=cache)
+            pd.testing.assert_index_equal(obs_features, exp_counts.index)
+            pd.testing.assert_index_equal(obs_samples, exp_samples)
+        _BIOM_CACHE.clear()
+
+        # with cache, a selection loads and caches the complete table
+        biom2pandas(self.filename_withtax, samples=samples, cache=True)
+        self.assertEqual(len(_BIOM_CACHE), 1)
+        self.assertEqual(next(iter(_BIOM_CACHE.values())).data.shape,
+                         exp_counts.shape)
+        _BIOM_CACHE.clear()
+        biom2pandas(self.filename_withtax, samples=samples, cache=False)
+        self.assertEqual(len(_BIOM_CACHE), 0)
+
+        with self.assertRaisesRegex(ValueError,
+                                    'does not have any observation metadata'):
+            biom2pandas(self.filename_minibiom, withTaxonomy=True,
+                        samples=['weampp05E05'], cache=False)
+
+        # lineages with empty ranks are joined as in the complete table
+        table = Table(
+            np.array([[1, 2], [3, 4], [5, 6]]), ['o1', 'o2', 'o3'],
+            ['s1', 's2'], observation_metadata=[
+                {'taxonomy': ['k__A', 'p__B', 'c__']},
+                {'taxonomy': ['k__A', '', 'c__C']},
+                {'taxonomy': ['k__A', 'p__', '']}])
+        fh, file_biom = mkstemp(suffix='.biom')
+        os.close(fh)
+        try:
+            with biom_open(file_biom, 'w') as f:
+                table.to_hdf5(f, 'test')
+            exp_counts, exp_tax = biom2pandas(
+                file_biom, withTaxonomy=True, cache=False)
+            for features, samples in [(['o3', 'o1'], None),
+                                      (None, ['s2'])]:
+                obs, tax = biom2pandas(
+                    file_biom, withTaxonomy=True, features=features,
+                    samples=samples, cache=False)
+                pd.testing.assert_series_equal(tax, exp_tax.loc[obs.index])
+        finally:
+            remove(file_biom)
+
     def test_pandas2biom(self):
         fh, filename = tempfile.mkstemp()
         p = pd.read_csv(get_data_path('float.tsv'), sep='\t', index_col=0)
@@ -170,6 +350,12 @@ class ReadWriteTests(TestCase):
         self.assertCountEqual(b.ids(), p.columns)
         self.assertCountEqual(b.ids(axis='observation'), p.index)
 
+        # sparse tables are written without densifying them
+        sparse = biom2pandas(self.filename_minibiom, sparse=True)
+        pandas2biom(filename, sparse)
+        assert_frame_equal(biom2pandas(filename),
+                           biom2pandas(self.filename_minibiom))
+
     def test_parse_splitlibrarieslog(self):
         with self.assertRaisesRegex(IOError, 'Cannot read file'):
             parse_splitlibrarieslog('/dev/')
@@ -224,6 +410,8 @@ class ReadWriteTests(TestCase):
                       err.getvalue())
         for taxon in idx_missing:
             self.assertIn(taxon, err.getvalue())
+        # ... and not stored in the biom table
+        self.assertCountEqual(get_metadata(file_biom_out).index, idx_in)
 
         # check that missing taxa in taxonomy are reported.
         err = StringIO()
@@ -245,6 +433,35 @@ class ReadWriteTests(TestCase):
 
         remove(file_biom_out)
 
+    def test__normalize_lineages(self):
+        lineages = pd.Series(['k__Bacteria; p__Firmicutes; g__Bacillus',
+                              'k__Bacteria;p__A; p__B;;x__other',
+                              None,
+                              'k__Bacteria; p__Firmicutes; g__Bacillus'],
+                             index=['a', 'b', 'c', 'd'])
+        obs = _normalize_lineages(lineages)
+        self.assertEqual(obs.to_dict(), {
+            'a': 'k__Bacteria;p__Firmicutes;c__;o__;f__;g__Bacillus;s__',
+            'b': 'k__Bacteria;p__B;c__;o__;f__;g__;s__',
+            'c': 'k__;p__;c__;o__;f__;g__;s__',
+            'd': 'k__Bacteria;p__Firmicutes;c__;o__;f__;g__Bacillus;s__'})
+        self.assertEqual(len(_normalize_lineages(pd.Series([], dtype=object))),
+                         0)
+
+        # taxa without lineage are stored with unknown ranks
+        file_biom_out = mkstemp('.biom')[1]
+        counts = biom2pandas(self.file_biom_input, sparse=True)
+        taxonomy = pd.read_csv(self.file_tax_input, sep='\t',
+                               index_col=0)['taxonomy']
+        pandas2biom(file_biom_out, counts, taxonomy=taxonomy.iloc[1:],
+                    err=StringIO())
+        _, obs = biom2pandas(file_biom_out, withTaxonomy=True)
+        self.assertEqual(obs[taxonomy.index[0]],
+                         'k__;p__;c__;o__;f__;g__;s__')
+        self.assertEqual(obs[taxonomy.index[1]],
+                         _normalize_lineages(taxonomy.iloc[1:2]).iloc[0])
+        remove(file_biom_out)
+
     def test_biom2pandas_readtaxonomy(self):
         # check if reading without taxonomy succeeds
         biom2pandas(self.file_biom_tax, withTaxonomy=False)
@@ -290,6 +507,81 @@ class ReadWriteTests(TestCase):
             verbose=False)
         self.assertTrue(c.shape[0] <= 1)
 
+    def test_collapseCounts_sparse(self):
+        for file_taxonomy in [get_data_path('tax_mock_taxonomy.txt'),
+                              get_data_path('tax_mock_taxonomy_errors.txt')]:
+            for rank in ['Phylum', 'Family', 'raw']:
+                exp = collapseCounts(get_data_path('tax_mock_counts.biom'),
+                                     rank, file_taxonomy=file_taxonomy,
+                                     verbose=False)
+                obs = collapseCounts(get_data_path('tax_mock_counts.biom'),
+                                     rank, file_taxonomy=file_taxonomy,
+                                     verbose=False, sparse=True)
+                assert_frame_equal(obs.sparse.to_dense(), exp)
+
+        exp = collapseCounts(self.filename_withtax, 'Family', verbose=False)
+        obs = collapseCounts(self.filename_withtax, 'Family', verbose=False,
+                             sparse=True)
+        assert_frame_equal(obs.sparse.to_dense(), exp)
+
+    def test_collapseCounts_values(self):
+        # all taxa are in the same, unknown phylum, except taxonI, which has
+        # no lineage at all
+        obs = collapseCounts(
+            get_data_path('tax_mock_counts.biom'), 'Phylum',
+            file_taxonomy=get_data_path('tax_mock_taxonomy_errors.txt'),
+            verbose=False)
+        exp = pd.DataFrame(
+            [[9500, 9900, 9700, 9800, 9900, 11600, 10200, 9980, 9950, 9950]],
+            index=pd.Index(['p__'], name='Phylum'),
+            columns=['sample%02i' % i for i in range(1, 11)])
+        assert_frame_equal(obs, exp)
+
+        # sums of the features of each family, in order of family names
+        counts, lineages = biom2pandas(self.filename_withtax,
+                                       withTaxonomy=True)
+        families = lineages.str.split(';').str[4].str.strip()
+        exp = pd.DataFrame(
+            {family: counts.loc[families.index[families == family]].sum()
+             for family in sorted(set(self.families_withtax))}).T
+        exp.index.name = 'Family'
+        for sparse in [False, True]:
+            obs = collapseCounts(self.filename_withtax, 'Family',
+                                 verbose=False, sparse=sparse)
+            if sparse:
+                obs = obs.sparse.to_dense()
+            assert_frame_equal(obs, exp)
+
+    def test_collapseCounts_multirank(self):
+        ranks = ['Phylum', 'raw', 'Species', 'Kingdom']
+        for sparse in [False, True]:
+            out = StringIO()
+            obs = collapseCounts(self.filename_withtax, ranks, out=out,
+                                 sparse=sparse)
+            self.assertEqual(list(obs.keys()), ranks)
+            for rank in ranks:
+                assert_frame_equal(obs[rank], collapseCounts(
+                    self.filename_withtax, rank, verbose=False,
+                    sparse=sparse))
+            self.assertEqual(out.getvalue().count('taxa left'), 3)
+
+        with self.assertRaisesRegex(ValueError, 'not a valid taxonomic rank'):
+            collapseCounts(self.filename_withtax, ['Phylum', 'noRank'])
+
+    def test__encode_ranks(self):
+        lineages = pd.Series(['k__a; p__b; c__c', 'k__a;p__d', None,
+                              'k__a; p__b;c__e', 'k__a;p__d'])
+        obs = _encode_ranks(lineages, ['Phylum', 'Class', 'Genus'])
+        self.assertEqual(obs['Phylum'][0].tolist(), [0, 1, -1, 0, 1])
+        self.assertEqual(obs['Phylum'][1].tolist(), ['p__b', 'p__d'])
+        self.assertEqual(obs['Class'][0].tolist(), [1, 0, -1, 2, 0])
+        self.assertEqual(obs['Class'][1].tolist(), ['c__', 'c__c', 'c__e'])
+        self.assertEqual(obs['Genus'][0].tolist(), [0, 0, -1, 0, 0])
+        self.assertEqual(obs['Genus'][1].tolist(), ['g__'])
+        obs = _encode_ranks(pd.Series([None, None]), ['Phylum'])
+        self.assertEqual(obs['Phylum'][0].tolist(), [-1, -1])
+        self.assertEqual(len(obs['Phylum'][1]), 0)
+
 
 if __name__ == '__main__':
     main()
@@ -1,15 +1,22 @@
 from unittest import TestCase, main
 from io import StringIO
+from unittest.mock import patch
+import os
+import shutil
+import tempfile
 
 from skbio.util import get_data_path
-from skbio.tree import TreeNode
+from skbio.tree import TreeNode, MissingNodeError
+import numpy.testing as npt
 
 from ggmap.readwrite import read_ncbi_nodes, read_metaphlan_markers_info, \
                             read_taxid_list, read_gg_accessions, \
-                            read_gg_otu_map
+                            read_gg_otu_map, read_ncbi_ranks
 from ggmap.tree import get_lineage, build_ncbi_tree, map_onto_ncbi, \
                        match_metaphlan_greengenes, _get_otus_from_clade, \
-                       distance_seppinsertion
+                       distance_seppinsertion, Taxonomy, \
+                       _index_greengenes_tree, distance_seppinsertions, \
+                       FlatTree
 
 
 class TreeTests(TestCase):
@@ -69,6 +76,80 @@ class TreeTests(TestCase):
         with self.assertRaises(ValueError):
             get_lineage(3, self.taxonomy)
 
+        taxonomy = Taxonomy(self.taxonomy)
+        self.assertEqual(get_lineage(2, taxonomy), [1, 131567, 2])
+        self.assertEqual(get_lineage(1, taxonomy), [1])
+        with self.assertRaises(ValueError):
+            get_lineage(3, taxonomy)
+
+    def test_Taxonomy(self):
+        nodes = read_ncbi_nodes(self.file_nodes_mock)
+        taxonomy = Taxonomy(nodes, ranks=read_ncbi_ranks(self.file_nodes_mock))
+        self.assertEqual(len(taxonomy), len(nodes))
+        self.assertIn(1157633, taxonomy)
+        self.assertNotIn(3, taxonomy)
+        for taxid in nodes:
+            self.assertEqual(taxonomy.lineage(taxid),
+                             get_lineage(taxid, nodes))
+
+        self.assertEqual(list(taxonomy.depth([1, 2, 1157633])), [0, 2, 5])
+        self.assertEqual(taxonomy.lineages([2, 1157633]).tolist(),
+                         [[1, 131567, 2, -1, -1, -1],
+                          [1, 131567, 2, 101, 102, 1157633]])
+        self.assertEqual(list(taxonomy.ancestor([2, 1157633], 3)), [-1, 101])
+        self.assertEqual(list(taxonomy.is_ancestor([2, 2759, 1157633],
+                                                   1157633)),
+                         [True, False, True])
+
+        self.assertEqual(taxonomy.lca([1157633, 633697]), 101)
+        self.assertEqual(taxonomy.lca([1157633, 633697, 556267]), 2)
+        self.assertEqual(taxonomy.lca([1157633, 2157]), 131567)
+        self.assertEqual(taxonomy.lca([102]), 102)
+        # 11 is a second root in the mock taxonomy
+        self.assertEqual(list(taxonomy.lca_pairs([11, 7], [1, 14])), [-1, 1])
+        with self.assertRaises(ValueError):
+            taxonomy.lca([11, 1])
+        with self.assertRaises(ValueError):
+            taxonomy.lca([])
+
+        self.assertEqual(taxonomy.rank(2), 'superkingdom')
+        self.assertEqual(list(taxonomy.rank([7, 16])), ['species', 'genus'])
+
+        with self.assertRaises(ValueError):
+            taxonomy.depth([1, 3])
+        with self.assertRaises(ValueError):
+            Taxonomy(read_ncbi_nodes(self.file_nodes_head))
+        with self.assertRaises(ValueError):
+            Taxonomy({1: 2, 2: 1})
+
+    def test_Taxonomy_write(self):
+        nodes = read_ncbi_nodes(self.file_nodes_mock)
+        merged = {12: 74109, 80: 155892}
+        dir_tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(dir_tmp, 'taxonomy')
+            for taxonomy in [
+                    Taxonomy(nodes),
+                    Taxonomy(nodes, ranks=read_ncbi_ranks(
+                        self.file_nodes_mock), merged=merged)]:
+                taxonomy.write(filename)
+                obs = Taxonomy.read(filename)
+                npt.assert_equal(obs.parents, taxonomy.parents)
+                npt.assert_equal(obs.is_node, taxonomy.is_node)
+                self.assertEqual(len(obs._up), len(taxonomy._up))
+                for up_obs, up_exp in zip(obs._up, taxonomy._up):
+                    npt.assert_equal(up_obs, up_exp)
+                self.assertEqual(obs.lca([1157633, 633697]), 101)
+                self.assertEqual(obs.rank_names, taxonomy.rank_names)
+                if taxonomy.merged is None:
+                    self.assertIsNone(obs.merged)
+                else:
+                    self.assertEqual(dict(obs.merged), merged)
+            with self.assertRaisesRegex(ValueError, 'wrong file format'):
+                FlatTree.read(filename)
+        finally:
+            shutil.rmtree(dir_tmp)
+
     def test_build_ncbi_tree(self):
         tree = build_ncbi_tree(self.taxonomy)
         self.assertCountEqual(list(map(lambda node: node.name, tree.tips())),
@@ -84,6 +165,16 @@ class TreeTests(TestCase):
         with self.assertRaises(KeyError):
             build_ncbi_tree(read_ncbi_nodes(self.file_nodes_head))
 
+        nodes = read_ncbi_nodes(self.file_nodes_mock)
+        for tree in [build_ncbi_tree(nodes), build_ncbi_tree(dict(nodes)),
+                     build_ncbi_tree(Taxonomy(nodes))]:
+            self.assertIsNone(tree.name)
+            self.assertEqual([n.name for n in tree.children], [1])
+            self.assertEqual(tree.count(), 35)
+            for node in tree.non_tips():
+                for child in node.children:
+                    self.assertEqual(nodes[child.name], node.name)
+
     def test_map_onto_ncbi_mp(self):
         tree_ncbi = build_ncbi_tree(read_ncbi_nodes(self.file_nodes_mock))
         clades_metaphlan = read_metaphlan_markers_info(self.file_mpmarkers)
@@ -111,12 +202,30 @@ class TreeTests(TestCase):
         self.assertNotIn('s__Tomato_begomovirus_satellite_DNA_beta', clades)
         self.assertNotIn('s__Cypovirus_15', clades)
 
-        self.assertIn('Starting deep copy (might take 40 seconds): ... done.',
+        self.assertIn('subtree of used taxids has 19 nodes.',
                       out.getvalue().strip())
         self.assertIn(("Cannot find taxid 575918 in taxonomy for mp_clades "
                        "'s__Tomato_leaf_curl_Patna_betasatellite'"),
                       out.getvalue().strip())
 
+        # the taxonomy itself is not modified
+        self.assertFalse(any(hasattr(node, 'mp_clades') or
+                             hasattr(node, 'isUsed')
+                             for node in tree_ncbi.traverse(True, True)))
+
+        # a Taxonomy gives the same subtree, without traversing a TreeNode
+        out_taxonomy = StringIO()
+        tree_taxonomy = map_onto_ncbi(
+            Taxonomy(read_ncbi_nodes(self.file_nodes_mock)),
+            clades_metaphlan, taxids_metaphlan, attribute_name='mp_clades',
+            verbose=True, out=out_taxonomy)
+        self.assertEqual(out.getvalue(), out_taxonomy.getvalue())
+        self.assertEqual(
+            [(n.name, getattr(n, 'mp_clades', None))
+             for n in tree_mp.preorder()],
+            [(n.name, getattr(n, 'mp_clades', None))
+             for n in tree_taxonomy.preorder()])
+
     def test_map_onto_ncbi_gg(self):
         tree_ncbi = build_ncbi_tree(read_ncbi_nodes(self.file_nodes_mock))
 
@@ -136,7 +245,7 @@ class TreeTests(TestCase):
         self.assertCountEqual({11054, 13988, 243587}, otus)
         self.assertNotIn('2328237', otus)
 
-        self.assertIn('Starting deep copy (might take 40 seconds): ... done.',
+        self.assertIn('subtree of used taxids has 11 nodes.',
                       out.getvalue().strip())
         self.assertNotIn("Cannot find taxid", out.getvalue().strip())
 
@@ -167,10 +276,46 @@ class TreeTests(TestCase):
                                                    tree_gg, 'otus'),
                               {243587, 13988, 11054})
 
+        taxonomy = Taxonomy(read_ncbi_nodes(self.file_nodes_mock))
+        for clade in clades_metaphlan:
+            if clade in ['s__Cypovirus_15',
+                         's__Tomato_leaf_curl_Patna_betasatellite',
+                         's__Tomato_begomovirus_satellite_DNA_beta']:
+                continue
+            self.assertEqual(
+                _get_otus_from_clade(clade, tree_mp, 'mp_clades', tree_gg,
+                                     'otus'),
+                _get_otus_from_clade(clade, tree_mp, 'mp_clades', tree_gg,
+                                     'otus', taxonomy=taxonomy))
+
         with self.assertRaises(ValueError):
             clade = 's__Cypovirus_15'
             _get_otus_from_clade(clade, tree_mp, 'mp_clades', tree_gg, 'otus')
 
+        # no OTUs at all: the ascent stops at the root
+        tree_empty = map_onto_ncbi(tree_ncbi, {}, gg_taxids,
+                                   attribute_name='otus', verbose=False)
+        clade = 's__Mycobacterium_phage_Omega'
+        self.assertEqual(_get_otus_from_clade(clade, tree_mp, 'mp_clades',
+                                              tree_empty, 'otus'), set())
+        self.assertEqual(_get_otus_from_clade(clade, tree_mp, 'mp_clades',
+                                              tree_empty, 'otus',
+                                              taxonomy=taxonomy), set())
+
+    def test__index_greengenes_tree(self):
+        tree = self.tree_orig.copy()
+        for i, tip in enumerate(tree.tips()):
+            tip.otus = {i, 100 + i}
+        tree.find('n5').otus = {50}
+        ranges, otus = _index_greengenes_tree(tree, 'otus')
+        for node in tree.traverse(include_self=True):
+            exp = set()
+            for n in node.traverse(include_self=True):
+                exp |= getattr(n, 'otus', set())
+            start, end = ranges[node.name]
+            self.assertEqual(end - start, len(exp))
+            self.assertEqual(set(otus[start:end].tolist()), exp)
+
     def test_match_metaphlan_greengenes(self):
         tree_ncbi = build_ncbi_tree(read_ncbi_nodes(self.file_nodes_mock))
 
@@ -213,6 +358,20 @@ class TreeTests(TestCase):
         self.assertIn("Clade 's__Tomato_begomovirus_satellite_DNA_beta'",
                       err.getvalue())
 
+        # parallel matching gives the same results and messages in order
+        clades = sorted(clades_metaphlan) + ['s__not_in_tree']
+        outputs = []
+        for processes in [1, 3]:
+            err = StringIO()
+            with patch('sys.stderr', new_callable=StringIO) as stderr:
+                res = match_metaphlan_greengenes(clades, tree_mp, 'mp_clades',
+                                                 tree_gg, 'otus', err,
+                                                 processes=processes)
+            outputs.append((res, list(res), err.getvalue(),
+                            stderr.getvalue()))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("'s__not_in_tree' omitted", outputs[1][2])
+
     def test_distance_seppinsertion(self):
         self.assertAlmostEqual(distance_seppinsertion(self.tree_orig,
                                                       self.tree_alpha1,
@@ -245,6 +404,70 @@ class TreeTests(TestCase):
                                                             tree,
                                                             tip.name), 0.0)
 
+    def test_distance_seppinsertions(self):
+        trees = [self.tree_alpha1, self.tree_alpha2, self.tree_alpha3,
+                 self.tree_alpha4, self.tree_alpha5, self.tree_alpha6,
+                 self.tree_alpha7]
+        for tree, name, exp in zip(trees, 'ccccchc',
+                                   [0.6, 8.7, 16.2, 11.0, 5.5, 4.6, 12.5]):
+            names = [tip.name for tip in tree.tips()]
+            obs = distance_seppinsertions(self.tree_orig, tree, names)
+            npt.assert_almost_equal(
+                obs, [distance_seppinsertion(self.tree_orig, tree, n)
+                      for n in names])
+            self.assertAlmostEqual(obs[names.index(name)], exp)
+
+        self.assertEqual(len(distance_seppinsertions(self.tree_orig,
+                                                     self.tree_alpha1, [])),
+                         0)
+        with self.assertRaisesRegex(MissingNodeError, 'xyz'):
+            distance_seppinsertions(self.tree_orig, self.tree_alpha1,
+                                    ['c', 'xyz'])
+
+    def test_FlatTree(self):
+        def get_annotations(tree, attribute):
+            return [(node.name, node.length,
+                     None if node.is_root() else node.parent.name,
+                     getattr(node, attribute, None))
+                    for node in tree.preorder()]
+
+        tree_ncbi = build_ncbi_tree(read_ncbi_nodes(self.file_nodes_mock))
+        tree_gg = map_onto_ncbi(tree_ncbi, read_gg_otu_map(
+            self.file_gg_otumap, read_gg_accessions(self.file_gg_accessions)),
+            read_taxid_list(self.file_gg_taxids), 'otus')
+        tree_mp = map_onto_ncbi(
+            tree_ncbi, read_metaphlan_markers_info(self.file_mpmarkers),
+            read_taxid_list(self.file_mptaxids), 'mp_clades', out=StringIO())
+
+        dir_tmp = tempfile.mkdtemp()
+        filename = os.path.join(dir_tmp, 'tree.bin')
+        for tree, attribute in [(tree_gg, 'otus'), (tree_mp, 'mp_clades'),
+                                (self.tree_orig, 'otus')]:
+            flat = FlatTree.from_treenode(tree, [attribute])
+            self.assertEqual(len(flat), tree.count())
+            flat.write(filename)
+            loaded = FlatTree.read(filename)
+            self.assertFalse(loaded.parents.flags.writeable)
+            for obs in [flat.to_treenode(), loaded.to_treenode()]:
+                self.assertEqual(get_annotations(obs, attribute),
+                                 get_annotations(tree, attribute))
+                self.assertFalse(hasattr(obs, 'mp_clades'))
+
+        # deep trees neither recurse when flattened, stored or restored
+        tree = TreeNode(name='root')
+        for i in range(5000):
+            tree = TreeNode(name=i, length=1.0, children=[tree])
+        flat = FlatTree.from_treenode(tree)
+        flat.write(filename)
+        obs = FlatTree.read(filename).to_treenode()
+        self.assertEqual([node.name for node in obs.preorder()],
+                         list(range(4999, -1, -1)) + ['root'])
+        self.assertIsNone(list(obs.preorder())[-1].length)
+        shutil.rmtree(dir_tmp)
+
+        with self.assertRaisesRegex(ValueError, 'Cannot store label'):
+            FlatTree.from_treenode(TreeNode(name=1.5))
+
 
 if __name__ == '__main__':
     main()
@@ -1,21 +1,42 @@
 from unittest import TestCase, main
 from copy import deepcopy
 from io import StringIO
+from unittest.mock import patch
+import glob
+import os
+import re
+import shutil
+import tempfile
 
+import numpy.testing as npt
+import pandas as pd
+from pandas.testing import assert_frame_equal
 from skbio.util import get_data_path
 
 from ggmap.utils import update_taxids, \
                         _convert_metaphlan_profile_to_greengenes, \
-                        convert_profiles
+                        convert_profiles, compile_clade2otus_map, \
+                        convert_profiles_matrix, build_clade2otus_map, \
+                        update_clade2otus_map, compile_merged_taxids
 from ggmap.readwrite import read_taxid_list, read_ncbi_merged, \
-                            read_clade2otus_map, read_metaphlan_profile
+                            read_clade2otus_map, read_metaphlan_profile, \
+                            read_ncbi_nodes, Clade2OTUsMap, \
+                            read_metaphlan_markers_info, read_gg_otu_map, \
+                            read_gg_accessions
+from ggmap.tree import Taxonomy, map_onto_ncbi, \
+                       match_metaphlan_greengenes, diff_taxonomies
 
 
 class UtilsTests(TestCase):
     def setUp(self):
         self.file_merged = get_data_path('head_merged.dmp')
+        self.file_nodes_mock = get_data_path('mock_nodes.dmp')
         self.file_mpmarkers = get_data_path('subset_markers_info.txt')
         self.file_mptaxids = get_data_path('subset_taxids_metaphlan.txt')
+        self.file_gg_accessions = \
+            get_data_path('subset_gg_13_5_accessions.txt')
+        self.file_gg_taxids = get_data_path('subset_taxids_gg.txt')
+        self.file_gg_otumap = get_data_path('subset_97_otu_map.txt')
         self.true_old_mptaxids = {
             'NC': {
                  'NC_012493.1': 575918, 'NC_002560.1': 134606,
@@ -48,6 +69,31 @@ class UtilsTests(TestCase):
         # self.assertNotEqual(mod_mptaxids, self.true_old_mptaxids)
         self.assertEqual(mod_mptaxids, self.true_new_mptaxids)
 
+        taxonomy = Taxonomy(read_ncbi_nodes(self.file_nodes_mock),
+                            merged=read_ncbi_merged(self.file_merged))
+        self.assertEqual(update_taxids(read_taxid_list(self.file_mptaxids),
+                                       taxonomy),
+                         self.true_new_mptaxids)
+        with self.assertRaises(ValueError):
+            update_taxids(read_taxid_list(self.file_mptaxids),
+                          Taxonomy(read_ncbi_nodes(self.file_nodes_mock)))
+
+        # chains of merges are followed to their end
+        merged = {12: 74109, 74109: 5, 5: 7, 80: 155892}
+        taxids, stats = update_taxids(
+            {'a': {'x': 12, 'y': 74109, 'z': 3}, 'b': {'v': 80, 'w': -1}},
+            merged, return_stats=True)
+        self.assertEqual(taxids, {'a': {'x': 7, 'y': 7, 'z': 3},
+                                  'b': {'v': 155892, 'w': -1}})
+        self.assertEqual(stats.loc['a'].tolist(), [3, 2, 2])
+        self.assertEqual(stats.loc['b'].tolist(), [2, 1, 0])
+        self.assertEqual(update_taxids(
+            {'a': {'x': 12}}, compile_merged_taxids(merged)), {'a': {'x': 7}})
+        npt.assert_equal(compile_merged_taxids(read_ncbi_merged(
+            self.file_merged))[0][[12, 13, 80]], [74109, 13, 155892])
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            compile_merged_taxids({1: 2, 2: 3, 3: 1})
+
     def test__convert_metaphlan_profile_to_greengenes(self):
         mp2gg = read_clade2otus_map(self.file_mp_gg_map)
         mp_profile1 = read_metaphlan_profile(self.file_mock_mp_profile)
@@ -80,6 +126,235 @@ class UtilsTests(TestCase):
                                prefix='test_')
         self.assertCountEqual(['test_mock', 'test_example'], res.columns)
 
+    def test_convert_profiles_output(self):
+        mp2gg = read_clade2otus_map(self.file_mp_gg_map)
+        files = [self.file_mock_mp_profile, self.file_example_mp_profile]
+        err = StringIO()
+        exp = convert_profiles(files, mp2gg, out=err)
+        self.assertEqual(list(exp.index), [11054, 13988, 243587])
+        for otu, abundance in self.true_mock_mp_profile.items():
+            self.assertAlmostEqual(exp.loc[otu, 'mock'], abundance)
+
+        err_parallel = StringIO()
+        res = convert_profiles(files, mp2gg, out=err_parallel, processes=2)
+        assert_frame_equal(exp, res)
+        self.assertEqual(err.getvalue(), err_parallel.getvalue())
+
+        res = convert_profiles(files, mp2gg, out=StringIO(), output='sparse')
+        self.assertTrue(all(isinstance(dtype, pd.SparseDtype)
+                            for dtype in res.dtypes))
+        assert_frame_equal(exp, res.sparse.to_dense())
+
+        res = convert_profiles(files, mp2gg, out=StringIO(), output='biom')
+        self.assertEqual(list(res.ids(axis='sample')), ['mock', 'example'])
+        self.assertEqual(list(res.ids(axis='observation')),
+                         [11054, 13988, 243587])
+        self.assertAlmostEqual(res.sum(axis='sample')[0], 1.0)
+
+        with self.assertRaises(ValueError):
+            convert_profiles(files, mp2gg, output='json')
+
+    def test_compile_clade2otus_map(self):
+        index, otu_ids, weights = compile_clade2otus_map(
+            {'s__a': {3, 1}, 's__b': set(), 'g__c': {1, 2, 5, 7}})
+        self.assertEqual(index, {'s__a': 0, 's__b': 1, 'g__c': 2})
+        self.assertEqual(otu_ids.tolist(), [1, 2, 3, 5, 7])
+        self.assertEqual(weights.toarray().tolist(),
+                         [[0.5, 0, 0.5, 0, 0],
+                          [0, 0, 0, 0, 0],
+                          [0.25, 0.25, 0, 0.25, 0.25]])
+
+    def test_convert_profiles_matrix(self):
+        mp2gg = {'g__c': {1, 2}, 's__a': {3}, 's__b': set()}
+        profiles = [{'k__x|g__c|s__a': 20.0, 'k__x|g__c|s__z': 60.0,
+                     'k__x|g__y': 20.0},
+                    {'k__x|g__c|s__b': 10.0},
+                    {'k__x|g__y': 5.0}]
+        for m in [mp2gg, compile_clade2otus_map(mp2gg),
+                  Clade2OTUsMap.from_dict(mp2gg)]:
+            counts, otu_ids, missed = convert_profiles_matrix(profiles, m)
+            self.assertEqual(otu_ids, [1, 2, 3])
+            npt.assert_almost_equal(counts.toarray(),
+                                    [[0.375, 0, 0],
+                                     [0.375, 0, 0],
+                                     [0.25, 0, 0]])
+            self.assertEqual(missed['profile'].tolist(), [0, 2])
+            self.assertEqual(missed['lineage'].tolist(),
+                             ['k__x|g__y', 'k__x|g__y'])
+            npt.assert_almost_equal(missed['fraction'].tolist(), [0.2, 1.0])
+
+        res, missed = convert_profiles(
+            [self.file_mock_mp_profile, self.file_example_mp_profile],
+            read_clade2otus_map(self.file_mp_gg_map), out=None,
+            return_missed=True)
+        self.assertEqual(set(missed['profile']), {'example'})
+        npt.assert_almost_equal(
+            missed.groupby('profile')['fraction'].sum()['example'], 1.0)
+
+    def test_build_clade2otus_map(self):
+        dir_tmp = tempfile.mkdtemp()
+        file_markers = os.path.join(dir_tmp, 'markers_info.txt')
+        shutil.copyfile(self.file_mpmarkers, file_markers)
+        args = [self.file_nodes_mock, self.file_merged, file_markers,
+                self.file_mptaxids, self.file_gg_accessions,
+                self.file_gg_taxids, self.file_gg_otumap]
+        dir_cache = os.path.join(dir_tmp, 'cache')
+
+        def get_stages(out):
+            return re.findall(r"stage '(\w+)': (computed|loaded)",
+                              out.getvalue())
+
+        out = StringIO()
+        res = build_clade2otus_map(*args, dir_cache=dir_cache, out=out)
+        self.assertEqual(get_stages(out),
+                         [('taxonomy', 'computed'), ('gg_otus', 'computed'),
+                          ('gg_taxids', 'computed'), ('tree_gg', 'computed'),
+                          ('mp_clades', 'computed'), ('mp_taxids', 'computed'),
+                          ('tree_mp', 'computed'), ('match', 'computed')])
+        self.assertIn('peak memory', out.getvalue())
+
+        # the same as running each step by hand
+        taxonomy = Taxonomy(read_ncbi_nodes(self.file_nodes_mock),
+                            merged=read_ncbi_merged(self.file_merged))
+        tree_gg = map_onto_ncbi(
+            taxonomy,
+            read_gg_otu_map(self.file_gg_otumap,
+                            read_gg_accessions(self.file_gg_accessions)),
+            update_taxids(read_taxid_list(self.file_gg_taxids), taxonomy),
+            'otus', out=StringIO())
+        clades = read_metaphlan_markers_info(self.file_mpmarkers)
+        tree_mp = map_onto_ncbi(
+            taxonomy, clades,
+            update_taxids(read_taxid_list(self.file_mptaxids), taxonomy),
+            'mp_clades', out=StringIO())
+        self.assertEqual(res, match_metaphlan_greengenes(
+            list(clades), tree_mp, 'mp_clades', tree_gg, 'otus',
+            out=StringIO()))
+
+        # the taxonomy is stored without its lifting table, not pickled
+        self.assertEqual(len(glob.glob(os.path.join(dir_cache,
+                                                    'taxonomy.*.taxonomy'))),
+                         1)
+        self.assertEqual(glob.glob(os.path.join(dir_cache,
+                                                'taxonomy.*.pickle')), [])
+
+        # unchanged input files are neither hashed nor parsed again
+        out = StringIO()
+        with patch('ggmap.utils._open', side_effect=AssertionError):
+            self.assertEqual(res, build_clade2otus_map(
+                *args, dir_cache=dir_cache, out=out))
+        self.assertEqual({action for _, action in get_stages(out)},
+                         {'loaded'})
+
+        # a new cache format invalidates all stages
+        out = StringIO()
+        with patch('ggmap.utils.STAGE_FORMAT', 0):
+            self.assertEqual(res, build_clade2otus_map(
+                *args, dir_cache=dir_cache, out=out))
+        self.assertEqual({action for _, action in get_stages(out)},
+                         {'computed'})
+
+        # changed markers only rerun downstream stages
+        with open(file_markers, 'a') as f:
+            f.write('# a changed markers file\n')
+        out = StringIO()
+        self.assertEqual(res, build_clade2otus_map(*args, dir_cache=dir_cache,
+                                                   out=out))
+        self.assertEqual([name for name, action in get_stages(out)
+                          if action == 'computed'],
+                         ['mp_clades', 'tree_mp', 'match'])
+        shutil.rmtree(dir_tmp)
+
+    def test_update_clade2otus_map(self):
+        nodes = read_ncbi_nodes(self.file_nodes_mock)
+        merged = read_ncbi_merged(self.file_merged)
+        gg_otus = read_gg_otu_map(self.file_gg_otumap,
+                                  read_gg_accessions(self.file_gg_accessions))
+        gg_taxids = read_taxid_list(self.file_gg_taxids)
+        clades = read_metaphlan_markers_info(self.file_mpmarkers)
+        mp_taxids = read_taxid_list(self.file_mptaxids)
+
+        def match(taxonomy):
+            tree_gg = map_onto_ncbi(
+                taxonomy, gg_otus,
+                update_taxids(deepcopy(gg_taxids), taxonomy), 'otus',
+                out=StringIO())
+            tree_mp = map_onto_ncbi(
+                taxonomy, clades,
+                update_taxids(deepcopy(mp_taxids), taxonomy), 'mp_clades',
+                out=StringIO())
+            return match_metaphlan_greengenes(
+                list(clades), tree_mp, 'mp_clades', tree_gg, 'otus',
+                out=StringIO(), taxonomy=taxonomy)
+
+        taxonomy_old = Taxonomy(nodes, merged=merged)
+        map_old = match(taxonomy_old)
+
+        # move the node of OTU 13988 and merge a taxID of an omitted clade
+        nodes[633697] = 103
+        merged = {**merged, 575918: 1303518}
+        taxonomy_new = Taxonomy(nodes, merged=merged)
+        diff = diff_taxonomies(taxonomy_old, taxonomy_new)
+        self.assertEqual(diff['moved'].tolist(), [633697])
+        self.assertEqual(diff['merged'].tolist(), [575918])
+        self.assertEqual(diff['added'].tolist(), [])
+        self.assertEqual(diff['removed'].tolist(), [])
+
+        dir_tmp = tempfile.mkdtemp()
+        file_report = os.path.join(dir_tmp, 'report.txt')
+        res = update_clade2otus_map(
+            map_old, taxonomy_old, taxonomy_new, clades, mp_taxids, gg_otus,
+            gg_taxids, file_report=file_report, out=StringIO())
+        self.assertEqual(res, match(taxonomy_new))
+        self.assertNotEqual(res, map_old)
+
+        with open(file_report) as f:
+            report = f.readlines()
+        shutil.rmtree(dir_tmp)
+        self.assertIn('# nodes moved: 1\n', report)
+        self.assertIn('# clades recomputed: 4\n', report)
+        statuses = dict(line.split('\t')[:2] for line in report
+                        if not line.startswith('#'))
+        self.assertEqual(statuses,
+                         {'s__Escherichia_phage_vB_EcoP_G7C': 'unchanged',
+                          's__Streptomyces_sp_KhCrAH_244': 'changed',
+                          's__Eubacterium_cellulosolvens': 'unchanged',
+                          's__Tomato_leaf_curl_Patna_betasatellite': 'added'})
+
+        # nothing to recompute for an unchanged taxonomy
+        self.assertEqual(update_clade2otus_map(
+            map_old, taxonomy_old, taxonomy_old, clades, mp_taxids, gg_otus,
+            gg_taxids, out=StringIO()), map_old)
+
+    def test_update_clade2otus_map_many_clades(self):
+        nodes = read_ncbi_nodes(self.file_nodes_mock)
+        merged = read_ncbi_merged(self.file_merged)
+        gg_otus = read_gg_otu_map(self.file_gg_otumap,
+                                  read_gg_accessions(self.file_gg_accessions))
+        gg_taxids = read_taxid_list(self.file_gg_taxids)
+        taxonomy_old = Taxonomy(nodes, merged=merged)
+        nodes[633697] = 103
+        taxonomy_new = Taxonomy(nodes, merged=merged)
+
+        # copies of a clade that keeps its OTUs, each with 20 accessions, such
+        # that every copy is checked against the changed nodes
+        ((ctype, accessions),) = read_metaphlan_markers_info(
+            self.file_mpmarkers)['p__Armatimonadetes'].items()
+        taxid = read_taxid_list(self.file_mptaxids)[ctype][
+            next(iter(accessions))]
+
+        clades, mp_taxids = {}, {ctype: {}}
+        for i in range(2000):
+            clade = 'p__Armatimonadetes_%i' % i
+            clades[clade] = {ctype: {'%s_%i' % (clade, j) for j in range(20)}}
+            mp_taxids[ctype].update(
+                {accession: taxid for accession in clades[clade][ctype]})
+        map_old = {clade: {243587} for clade in clades}
+        res = update_clade2otus_map(
+            map_old, taxonomy_old, taxonomy_new, clades, mp_taxids, gg_otus,
+            gg_taxids, out=StringIO())
+        self.assertEqual(res, map_old)
+
 
 if __name__ == '__main__':
     main()
@@ -1,7 +1,571 @@
 import sys
+from array import array
+from io import StringIO
+from itertools import chain
+from multiprocessing import get_context, get_all_start_methods
 
+import numpy as np
 from skbio.tree import TreeNode, MissingNodeError
 
+from ggmap.readwrite import TaxidMap, _write_sections, _read_sections
+
+
+MAGIC_FLATTREE = b'GGMAPTRE'
+MAGIC_TAXONOMY = b'GGMAPTAX'
+
+
+class Taxonomy(object):
+    """ Array based NCBI taxonomy for bulk lineage and LCA queries.
+
+    Nodes are held in a dense parent array indexed by taxID. From it, we
+    precompute the depth of every node and a binary lifting table, i.e. the
+    2^k-th ancestor of every node for k = 0, 1, ... . With those, depth,
+    ancestor and lowest common ancestor queries cost O(log(depth)) vectorized
+    array operations for any number of taxIDs at once, instead of walking a
+    dict one parent at a time for each taxID.
+
+    Parameters
+    ----------
+    nodes : TaxidMap or dict(ID: parentID) or numpy.ndarray
+        The whole taxonomy, e.g. as returned by read_ncbi_nodes. Roots are
+        nodes that are their own parent.
+    ranks : (numpy.ndarray, [str])
+        Optional. Rank codes and names, as returned by read_ncbi_ranks.
+    merged : TaxidMap or dict(ID: mergedID)
+        Optional. Content of merged.dmp, e.g. as returned by
+        read_ncbi_merged.
+
+    Raises
+    ------
+    ValueError
+        If a node's parent is not in the taxonomy or parents form a cycle.
+    """
+    def __init__(self, nodes, ranks=None, merged=None):
+        if isinstance(nodes, TaxidMap):
+            nodes = nodes.array
+        elif isinstance(nodes, dict):
+            nodes = TaxidMap.from_dict(nodes).array
+        parents = np.asarray(nodes, dtype=np.int64)
+
+        self.is_node = parents >= 0
+        valid = self.is_node & (parents < len(parents))
+        valid[valid] = self.is_node[parents[valid]]
+        if np.any(self.is_node & ~valid):
+            raise ValueError("Parent of taxid %i is not in the taxonomy." %
+                             np.flatnonzero(self.is_node & ~valid)[0])
+
+        # non-nodes point to themselves, such that jumps never leave the array
+        self.parents = np.where(self.is_node, parents,
+                                np.arange(len(parents)))
+
+        # compute depth by pointer doubling: after step i, anc[n] is the
+        # 2^i-th ancestor of n, or its root, and dist[n] the distance to it.
+        anc = self.parents
+        dist = (anc != np.arange(len(anc))).astype(np.int32)
+        for _ in range(64):
+            jump = anc[anc]
+            if np.array_equal(jump, anc):
+                break
+            dist = dist + dist[anc]
+            anc = jump
+        if np.any(self.parents[anc] != anc):
+            raise ValueError("Parents of the taxonomy form a cycle.")
+        self.roots = anc
+        self._depth = np.where(self.is_node, dist, -1)
+
+        self._up = [self.parents]
+        for _ in range(max(1, int(self._depth.max(initial=0)).bit_length())
+                       - 1):
+            self._up.append(self._up[-1][self._up[-1]])
+
+        self.rank_codes, self.rank_names = None, None
+        if ranks is not None:
+            self.rank_codes, self.rank_names = ranks[0], list(ranks[1])
+        self.merged = merged
+
+    def __contains__(self, taxid):
+        try:
+            return bool(self.is_node[taxid]) if taxid >= 0 else False
+        except (IndexError, TypeError):
+            return False
+
+    def __len__(self):
+        return int(np.count_nonzero(self.is_node))
+
+    def write(self, filename):
+        """ Writes parents, ranks and merged taxIDs into one binary file.
+
+        The binary lifting table is not written, since it is cheaply rebuilt
+        from the parents on load and would be many times larger.
+
+        Raises
+        ------
+        IOError
+            If the file cannot be written.
+        """
+        sections = [('nodes', np.where(self.is_node, self.parents, -1))]
+        if self.rank_codes is not None:
+            names = _Labels.from_list(self.rank_names)
+            sections.extend([('ranks.codes', self.rank_codes),
+                             ('ranks.data', names.data),
+                             ('ranks.offsets', names.offsets),
+                             ('ranks.kinds', names.kinds)])
+        if self.merged is not None:
+            merged = self.merged
+            if not isinstance(merged, TaxidMap):
+                merged = TaxidMap.from_dict(dict(merged))
+            sections.append(('merged', merged.array))
+        _write_sections(filename, MAGIC_TAXONOMY, sections)
+
+    @classmethod
+    def read(cls, filename):
+        """ Reads a taxonomy written by Taxonomy.write.
+
+        Raises
+        ------
+        IOError
+            If the file cannot be read.
+        ValueError
+            If the file is not a Taxonomy.
+        """
+        sections = _read_sections(filename, MAGIC_TAXONOMY)
+        ranks = None
+        if 'ranks.codes' in sections:
+            ranks = (sections['ranks.codes'],
+                     _Labels(sections['ranks.data'], sections['ranks.offsets'],
+                             sections['ranks.kinds']).tolist())
+        merged = None
+        if 'merged' in sections:
+            merged = TaxidMap(sections['merged'])
+        return cls(sections['nodes'], ranks=ranks, merged=merged)
+
+    def _check(self, taxids):
+        """ Converts taxids into an int array and ensures all are nodes."""
+        taxids = np.asarray(taxids, dtype=np.int64)
+        flat = taxids.ravel()
+        valid = (flat >= 0) & (flat < len(self.is_node))
+        valid[valid] = self.is_node[flat[valid]]
+        if not np.all(valid):
+            raise ValueError('%s not in nodes' % flat[~valid][0])
+        return taxids
+
+    def _lift(self, taxids, steps):
+        """ Returns the ancestors 'steps' levels above taxids."""
+        for k in range(len(self._up)):
+            jump = (steps >> k) & 1 == 1
+            if np.any(jump):
+                taxids = np.where(jump, self._up[k][taxids], taxids)
+        return taxids
+
+    def depth(self, taxids):
+        """ Number of edges between taxids and their root.
+
+        Parameters
+        ----------
+        taxids : int or array of int
+
+        Returns
+        -------
+        int or numpy.ndarray of int, matching the shape of taxids.
+
+        Raises
+        ------
+        ValueError
+            If a taxid is not in the taxonomy.
+        """
+        return self._depth[self._check(taxids)]
+
+    def ancestor(self, taxids, depth):
+        """ Ancestors of taxids at the given depth.
+
+        Parameters
+        ----------
+        taxids : int or array of int
+        depth : int or array of int
+            Depth of the requested ancestor, 0 for the root.
+
+        Returns
+        -------
+        int or numpy.ndarray of int. -1 for taxids that are less deep than
+        requested.
+        """
+        taxids = self._check(taxids)
+        steps = self._depth[taxids] - np.asarray(depth)
+        res = self._lift(taxids, np.maximum(steps, 0))
+        return np.where(steps >= 0, res, -1)
+
+    def is_ancestor(self, ancestors, taxids):
+        """ Tests if ancestors are on the lineages of taxids.
+
+        Note that every node is on its own lineage, i.e.
+        is_ancestor(x, x) is True.
+
+        Parameters
+        ----------
+        ancestors : int or array of int
+        taxids : int or array of int
+
+        Returns
+        -------
+        bool or numpy.ndarray of bool.
+        """
+        ancestors = self._check(ancestors)
+        return self.ancestor(taxids, self._depth[ancestors]) == ancestors
+
+    def lineage(self, taxid):
+        """ Obtain whole lineage for a given taxID.
+
+        Parameters
+        ----------
+        taxid : int
+            taxID of the node for which the lineage should be obtained.
+
+        Returns
+        -------
+        A list of taxIDs starting at the root and ending with the given taxid.
+
+        Raises
+        ------
+        ValueError
+            If the taxid is not in the taxonomy.
+        """
+        return [int(t) for t in self.lineages([taxid])[0] if t >= 0]
+
+    def lineages(self, taxids):
+        """ Obtain lineages for many taxIDs at once.
+
+        Parameters
+        ----------
+        taxids : array of int
+
+        Returns
+        -------
+        numpy.ndarray of shape (len(taxids), max depth + 1). Row i holds the
+        lineage of taxids[i], starting at the root and padded with -1.
+
+        Raises
+        ------
+        ValueError
+            If a taxid is not in the taxonomy.
+        """
+        taxids = self._check(np.atleast_1d(taxids))
+        depths = self._depth[taxids]
+        res = np.full((len(taxids), depths.max(initial=-1) + 1), -1,
+                      dtype=np.int64)
+        rows = np.arange(len(taxids))
+        for step in range(res.shape[1]):
+            valid = depths >= step
+            res[rows[valid], (depths - step)[valid]] = taxids[valid]
+            taxids = self.parents[taxids]
+        return res
+
+    def lca_pairs(self, taxids_a, taxids_b):
+        """ Lowest common ancestors for pairs of taxIDs.
+
+        Parameters
+        ----------
+        taxids_a : int or array of int
+        taxids_b : int or array of int
+
+        Returns
+        -------
+        int or numpy.ndarray of int. -1 for pairs in different trees, i.e.
+        without common root.
+        """
+        a, b = np.broadcast_arrays(self._check(taxids_a),
+                                   self._check(taxids_b))
+        diff = self._depth[a] - self._depth[b]
+        a = self._lift(a, np.maximum(diff, 0))
+        b = self._lift(b, np.maximum(-diff, 0))
+        for up in reversed(self._up):
+            ua, ub = up[a], up[b]
+            differ = ua != ub
+            a = np.where(differ, ua, a)
+            b = np.where(differ, ub, b)
+        res = np.where(a == b, a, self.parents[a])
+        return np.where(self.roots[a] == self.roots[b], res, -1)
+
+    def lca(self, taxids):
+        """ Lowest common ancestor of a set of taxIDs.
+
+        Parameters
+        ----------
+        taxids : iterable of int
+
+        Returns
+        -------
+        int: the taxID of the lowest common ancestor.
+
+        Raises
+        ------
+        ValueError
+            If taxids is empty, a taxid is not in the taxonomy or taxids do
+            not share a common root.
+        """
+        taxids = self._check(np.unique(np.fromiter(taxids, dtype=np.int64)))
+        if len(taxids) == 0:
+            raise ValueError("Cannot compute LCA of an empty set.")
+        # reduce pairwise, halving the number of taxids in every step
+        while len(taxids) > 1:
+            half = len(taxids) // 2
+            lcas = self.lca_pairs(taxids[:half], taxids[half:2 * half])
+            if np.any(lcas < 0):
+                raise ValueError("taxids do not share a common root.")
+            taxids = np.concatenate([lcas, taxids[2 * half:]])
+        return int(taxids[0])
+
+    def rank(self, taxids):
+        """ Rank names of taxIDs.
+
+        Parameters
+        ----------
+        taxids : int or array of int
+
+        Returns
+        -------
+        str or numpy.ndarray of str.
+
+        Raises
+        ------
+        ValueError
+            If the taxonomy has no rank information or a taxid is not in the
+            taxonomy.
+        """
+        if self.rank_codes is None:
+            raise ValueError("Taxonomy has no rank information.")
+        names = np.array(self.rank_names + [''], dtype=object)
+        res = names[self.rank_codes[self._check(taxids)]]
+        return res if np.ndim(res) > 0 else str(res)
+
+
+class _Labels(object):
+    """ A compact table of node names or annotation values.
+
+    Labels are stored as one UTF-8 encoded string table, together with their
+    kind, such that None, str and int labels are restored as they were.
+
+    Parameters
+    ----------
+    data : numpy.ndarray of uint8
+        Concatenated, UTF-8 encoded labels.
+    offsets : numpy.ndarray of int64
+        Label i is data[offsets[i]:offsets[i+1]].
+    kinds : numpy.ndarray of int8
+        0 for None, 1 for str and 2 for int labels.
+    """
+    def __init__(self, data, offsets, kinds):
+        self.data = data
+        self.offsets = offsets
+        self.kinds = kinds
+
+    @classmethod
+    def from_list(cls, labels):
+        """ Encodes a list of None, str or int labels.
+
+        Raises
+        ------
+        ValueError
+            If a label is of another type.
+        """
+        kinds = np.zeros(len(labels), dtype=np.int8)
+        encoded = []
+        for i, label in enumerate(labels):
+            if label is None:
+                encoded.append(b'')
+            elif isinstance(label, str):
+                kinds[i] = 1
+                encoded.append(label.encode('utf-8'))
+            elif isinstance(label, (int, np.integer)) and \
+                    not isinstance(label, bool):
+                kinds[i] = 2
+                encoded.append(str(int(label)).encode('ascii'))
+            else:
+                raise ValueError("Cannot store label '%s' of type %s." %
+                                 (label, type(label).__name__))
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum([len(label) for label in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                   offsets, kinds)
+
+    def __getitem__(self, i):
+        kind = self.kinds[i]
+        if kind == 0:
+            return None
+        value = self.data[self.offsets[i]:self.offsets[i+1]].tobytes()
+        return value.decode('utf-8') if kind == 1 else int(value)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def tolist(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        return [None if kind == 0 else
+                data[offsets[i]:offsets[i+1]].decode('utf-8') if kind == 1
+                else int(data[offsets[i]:offsets[i+1]])
+                for i, kind in enumerate(self.kinds.tolist())]
+
+
+class FlatTree(object):
+    """ Array representation of a (annotated) tree.
+
+    Nodes are numbered in preorder, i.e. every parent precedes its children
+    and children keep their order. The tree consists of a parent index array,
+    branch lengths, a table of node names and, for every annotation
+    attribute, e.g. 'otus' of map_onto_ncbi, the sets of values of all nodes
+    in CSR form: values of node i are values[indices[indptr[i]:indptr[i+1]]].
+    Neither building nor storing a FlatTree recurses, and a stored FlatTree
+    is memory mapped when read.
+
+    Parameters
+    ----------
+    parents : numpy.ndarray of int64
+        Index of every node's parent, -1 for the root.
+    lengths : numpy.ndarray of float64
+        Branch length of every node, NaN for nodes without length.
+    names : _Labels
+        Node names.
+    annotations : dict of str: (numpy.ndarray, numpy.ndarray, _Labels)
+        Optional. Attribute name: indptr, indices and values of the
+        annotation sets.
+    """
+    def __init__(self, parents, lengths, names, annotations=None):
+        self.parents = parents
+        self.lengths = lengths
+        self.names = names
+        self.annotations = annotations if annotations is not None else {}
+
+    @classmethod
+    def from_treenode(cls, tree, attributes=()):
+        """ Flattens a TreeNode.
+
+        Parameters
+        ----------
+        tree : TreeNode
+            The tree.
+        attributes : list of str
+            Names of node attributes that hold sets of annotations, e.g.
+            'otus'. Nodes without the attribute have no annotations.
+
+        Returns
+        -------
+        FlatTree
+
+        Raises
+        ------
+        ValueError
+            If a name or annotation is neither None, str nor int.
+        """
+        nodes = list(tree.preorder(include_self=True))
+        index = {id(node): i for i, node in enumerate(nodes)}
+        parents = np.fromiter(
+            (index[id(node.parent)] if node is not tree else -1
+             for node in nodes), dtype=np.int64, count=len(nodes))
+        lengths = np.fromiter(
+            (np.nan if node.length is None else node.length
+             for node in nodes), dtype=np.float64, count=len(nodes))
+
+        annotations = {}
+        for attribute in attributes:
+            values = {}
+            indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+            indices = array('q')
+            for i, node in enumerate(nodes):
+                for value in sorted(getattr(node, attribute, ()), key=str):
+                    indices.append(values.setdefault(value, len(values)))
+                indptr[i + 1] = len(indices)
+            annotations[attribute] = (
+                indptr, np.frombuffer(indices, dtype=np.int64),
+                _Labels.from_list(list(values)))
+
+        return cls(parents, lengths,
+                   _Labels.from_list([node.name for node in nodes]),
+                   annotations)
+
+    def to_treenode(self):
+        """ Builds a TreeNode with annotations as sets of node attributes.
+
+        Returns
+        -------
+        TreeNode
+        """
+        names = self.names.tolist()
+        nodes = [TreeNode(name=name,
+                          length=None if np.isnan(length) else length)
+                 for name, length in zip(names, self.lengths.tolist())]
+        for i, parent in enumerate(self.parents[1:].tolist(), 1):
+            nodes[parent].children.append(nodes[i])
+            nodes[i].parent = nodes[parent]
+
+        for attribute, (indptr, indices, values) in self.annotations.items():
+            values = values.tolist()
+            indptr, indices = indptr.tolist(), indices.tolist()
+            for i, node in enumerate(nodes):
+                if indptr[i + 1] > indptr[i]:
+                    setattr(node, attribute,
+                            {values[j] for j in
+                             indices[indptr[i]:indptr[i + 1]]})
+        return nodes[0]
+
+    def write(self, filename):
+        """ Writes the tree into one binary file.
+
+        Raises
+        ------
+        IOError
+            If the file cannot be written.
+        ValueError
+            If an attribute name is longer than 20 characters.
+        """
+        sections = [('parents', self.parents), ('lengths', self.lengths),
+                    ('names.data', self.names.data),
+                    ('names.offsets', self.names.offsets),
+                    ('names.kinds', self.names.kinds)]
+        for attribute, (indptr, indices, values) in self.annotations.items():
+            if len(attribute.encode('ascii')) > 20:
+                raise ValueError("Attribute name '%s' is too long." %
+                                 attribute)
+            prefix = 'a.%s.' % attribute
+            sections.extend([(prefix + 'indptr', indptr),
+                             (prefix + 'indices', indices),
+                             (prefix + 'data', values.data),
+                             (prefix + 'offsets', values.offsets),
+                             (prefix + 'kinds', values.kinds)])
+        _write_sections(filename, MAGIC_FLATTREE, sections)
+
+    @classmethod
+    def read(cls, filename):
+        """ Memory maps a tree written by FlatTree.write.
+
+        Raises
+        ------
+        IOError
+            If the file cannot be read.
+        ValueError
+            If the file is not a FlatTree.
+        """
+        sections = _read_sections(filename, MAGIC_FLATTREE)
+        annotations = {}
+        for name in sections:
+            if name.startswith('a.') and name.endswith('.indptr'):
+                attribute = name[2:-len('.indptr')]
+                prefix = 'a.%s.' % attribute
+                annotations[attribute] = (
+                    sections[prefix + 'indptr'], sections[prefix + 'indices'],
+                    _Labels(sections[prefix + 'data'],
+                            sections[prefix + 'offsets'],
+                            sections[prefix + 'kinds']))
+        return cls(sections['parents'], sections['lengths'],
+                   _Labels(sections['names.data'], sections['names.offsets'],
+                           sections['names.kinds']),
+                   annotations)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __repr__(self):
+        return '%s(%i nodes)' % (self.__class__.__name__, len(self))
+
 
 def get_lineage(taxid, nodes):
     """ Obtain whole lineage for a given taxID.
@@ -10,7 +574,7 @@ def get_lineage(taxid, nodes):
     ----------
     taxid : int
         taxID of the node for which the lineage should be obtained.
-    nodes : dict(ID: parentID)
+    nodes : dict(ID: parentID) or Taxonomy
         Dictionary containing the whole taxonomy. Key is node taxID, value is
         parent taxID.
 
@@ -18,6 +582,9 @@ def get_lineage(taxid, nodes):
     -------
     A list of taxIDs ending with the given taxid.
     """
+    if isinstance(nodes, Taxonomy):
+        return nodes.lineage(taxid)
+
     lineage = [taxid]
     if taxid not in nodes:
         raise ValueError('%s not in nodes' % taxid)
@@ -27,12 +594,62 @@ def get_lineage(taxid, nodes):
         return list(reversed(lineage))
 
 
+def diff_taxonomies(taxonomy_old, taxonomy_new):
+    """ Finds nodes and merged taxIDs that differ between two taxonomies.
+
+    Parameters
+    ----------
+    taxonomy_old : Taxonomy
+        The previous taxonomy, e.g. from last month's taxdump.
+    taxonomy_new : Taxonomy
+        The current taxonomy.
+
+    Returns
+    -------
+    A dict of sorted numpy.ndarrays of taxIDs:
+    'added': nodes only in taxonomy_new,
+    'removed': nodes only in taxonomy_old,
+    'moved': nodes of both taxonomies with a different parent,
+    'merged': taxIDs whose entry in merged.dmp was added, removed or changed.
+    """
+    size = max(len(taxonomy_old.is_node), len(taxonomy_new.is_node))
+
+    def pad(values, fill):
+        res = np.full(size, fill, dtype=values.dtype)
+        res[:len(values)] = values
+        return res
+
+    def merged_array(taxonomy):
+        merged = taxonomy.merged
+        if merged is None or len(merged) == 0:
+            return np.full(size, -1, dtype=np.int64)
+        if not isinstance(merged, TaxidMap):
+            merged = TaxidMap.from_dict(dict(merged))
+        return pad(merged.array.astype(np.int64), -1)
+
+    is_old = pad(taxonomy_old.is_node, False)
+    is_new = pad(taxonomy_new.is_node, False)
+    parents_old = pad(taxonomy_old.parents.astype(np.int64), -1)
+    parents_new = pad(taxonomy_new.parents.astype(np.int64), -1)
+    return {
+        'added': np.flatnonzero(is_new & ~is_old),
+        'removed': np.flatnonzero(is_old & ~is_new),
+        'moved': np.flatnonzero(is_old & is_new &
+                                (parents_old != parents_new)),
+        'merged': np.flatnonzero(merged_array(taxonomy_old) !=
+                                 merged_array(taxonomy_new))}
+
+
 def build_ncbi_tree(nodes, verbose=False, out=sys.stdout):
     """ Build a TreeNode from a dict of nodes.
 
+    The tree is built top down from the children of every node, i.e. each
+    node is created exactly once. The root of the returned tree is an unnamed
+    node, whose children are the roots of the taxonomy, e.g. taxID 1.
+
     Parameters
     ----------
-    nodes : dict(ID: parentID)
+    nodes : dict(ID: parentID) or Taxonomy
         Dictionary containing the whole taxonomy. Key is node taxID, value is
         parent taxID.
     verbose : Boolean
@@ -43,22 +660,59 @@ def build_ncbi_tree(nodes, verbose=False, out=sys.stdout):
     Returns
     -------
     A skbio.tree.TreeNode object, holding the whole taxonomy.
+
+    Raises
+    ------
+    KeyError
+        If the parent of a node is not in the taxonomy.
     """
+    if isinstance(nodes, Taxonomy):
+        nodes = TaxidMap(np.where(nodes.is_node, nodes.parents, -1))
+    if isinstance(nodes, TaxidMap):
+        taxids = np.flatnonzero(nodes.array >= 0)
+        items = list(zip(taxids.tolist(), nodes.array[taxids].tolist()))
+    else:
+        items = list(nodes.items())
 
-    parents = set(nodes.values())
-    tips = set(nodes) - parents
+    # children adjacency list
+    roots = []
+    children = {}
+    for taxid, parent in items:
+        if taxid == parent:
+            roots.append(taxid)
+        elif parent in children:
+            children[parent].append(taxid)
+        else:
+            children[parent] = [taxid]
+    for parent, childs in children.items():
+        if parent not in nodes:
+            raise KeyError("Cannot obtain lineage for taxid %s" % childs[0])
+    num_tips = sum(1 for taxid, parent in items
+                   if (taxid not in children) and (taxid != parent))
 
     if verbose:
-        out.write("build ncbi tree for %i tips: " % len(list(tips)))
-    ls = {}
-    for c, tip in enumerate(list(tips)):
-        if verbose and (int(c % (len(tips) / 100)) == 0):
-            out.write(".")
-        try:
-            ls[tip] = get_lineage(tip, nodes)[:-1]
-        except KeyError:
-            raise KeyError("Cannot obtain lineage for taxid %s" % tip)
-    tree = TreeNode.from_taxonomy(ls.items())
+        out.write("build ncbi tree for %i tips: " % num_tips)
+    # link nodes directly, since TreeNode.append invalidates caches of the
+    # whole tree, which would make building quadratic
+    tree = TreeNode()
+    tree.children = [TreeNode(name=root) for root in roots
+                     if root in children]
+    stack = list(tree.children)
+    for node in stack:
+        node.parent = tree
+    c = 0
+    while stack:
+        node = stack.pop()
+        if node.name not in children:
+            if verbose and (int(c % (num_tips / 100)) == 0):
+                out.write(".")
+            c += 1
+            continue
+        node.children = [TreeNode(name=child)
+                         for child in children[node.name]]
+        for child in node.children:
+            child.parent = node
+        stack.extend(node.children)
     if verbose:
         out.write(" done.\n")
 
@@ -70,11 +724,16 @@ def map_onto_ncbi(taxonomy, clusters, cluster_taxids, attribute_name,
     """Subsets a given NCBI taxonomy to those taxIDs that are used by clusters.
 
     Clusters might be either OTUs from GreenGenes or Clades from MetaPhlAn.
+    Only the subtree induced by the used taxIDs and their ancestors is built,
+    i.e. taxonomy is neither copied nor modified. Ancestors are collected on
+    parent pointers and the walk towards the root stops at the first ancestor
+    that is already used.
 
     Parameters
     ----------
-    taxonomy : TreeNode
-        The NCBI taxonomy as TreeNode.
+    taxonomy : TreeNode or Taxonomy
+        The NCBI taxonomy as TreeNode, or as Taxonomy, which avoids a
+        traversal of the whole tree.
     clusters : Dict of dicts of sets
         cluster name: cluster type: accession.
     cluster_taxids : Dict of dicts of taxIDs
@@ -92,40 +751,92 @@ def map_onto_ncbi(taxonomy, clusters, cluster_taxids, attribute_name,
     A subtree of taxonomy, in which nodes are decorated with either MetaPhlAn
     clades or GreenGenes OTUs that match to those taxids.
     """
-    if verbose:
-        out.write("Starting deep copy (might take 40 seconds): ...")
-    tree = taxonomy.deepcopy()
-    if verbose:
-        out.write(" done.\n")
+    if isinstance(taxonomy, Taxonomy):
+        root_name = None
 
+        def get_parent(taxid):
+            parent = int(taxonomy.parents[taxid])
+            return None if parent == taxid else parent
+
+        is_node = taxonomy.__contains__
+        order = None
+    else:
+        # one traversal to obtain parent pointers and the order of children
+        root_name = taxonomy.name
+        parents = {}
+        order = {}
+        for node in taxonomy.preorder(include_self=False):
+            parents[node.name] = node.parent.name
+            order[node.name] = len(order)
+        get_parent = parents.__getitem__
+
+        def is_node(taxid):
+            return (taxid in parents) or \
+                ((taxid == root_name) and (taxid is not None))
+
+    # collect annotations as parallel arrays of taxIDs and cluster numbers
+    names = []
+    hit_taxids = []
+    hit_clusters = array('q')
     for cluster in clusters:
         for ctype in clusters[cluster]:
             taxids = set(map(lambda accession:
                              cluster_taxids[ctype][accession],
                              clusters[cluster][ctype]))
             for taxid in taxids:
-                try:
-                    node = tree.find(taxid)
-                    if not hasattr(node, attribute_name):
-                        setattr(node, attribute_name, set())
-                        node.isUsed = True
-                        for n in node.ancestors():
-                            n.isUsed = True
-                    attr_set = getattr(node, attribute_name)
-                    attr_set.add(cluster)
-                    setattr(node, attribute_name, attr_set)
-                except MissingNodeError:
+                if is_node(taxid):
+                    hit_taxids.append(taxid)
+                    hit_clusters.append(len(names))
+                else:
                     out.write(("Cannot find taxid %s in taxonomy for "
                                "%s '%s'\n") % (taxid, attribute_name, cluster))
+        names.append(cluster)
 
-    tree.remove_deleted(lambda node: not hasattr(node, 'isUsed'))
+    # build the induced subtree bottom up, stopping at used ancestors
+    tree = TreeNode(name=root_name)
+    used = {root_name: tree}
+    for taxid in hit_taxids:
+        child = None
+        while taxid not in used:
+            node = used[taxid] = TreeNode(name=taxid)
+            node.isUsed = True
+            if child is not None:
+                node.children.append(child)
+                child.parent = node
+            child = node
+            taxid = get_parent(taxid)
+        if child is not None:
+            used[taxid].children.append(child)
+            child.parent = used[taxid]
+    tree.isUsed = True
+    for node in used.values():
+        if len(node.children) > 1:
+            node.children.sort(key=(lambda n: n.name) if order is None else
+                               (lambda n: order[n.name]))
+
+    # attach annotations as sets of cluster names, grouped by node
+    index = {taxid: i for i, taxid in enumerate(used)}
+    hit_nodes = np.fromiter((index[taxid] for taxid in hit_taxids),
+                            dtype=np.int64, count=len(hit_taxids))
+    hit_clusters = np.frombuffer(hit_clusters, dtype=np.int64)
+    by_node = np.argsort(hit_nodes, kind='stable')
+    starts = np.flatnonzero(np.diff(hit_nodes[by_node], prepend=-1))
+    nodes = list(used.values())
+    for group in np.split(by_node, starts[1:]):
+        if len(group) > 0:
+            setattr(nodes[hit_nodes[group[0]]], attribute_name,
+                    {names[i] for i in hit_clusters[group].tolist()})
+
+    if verbose:
+        out.write("subtree of used taxids has %i nodes.\n" % len(used))
 
     return tree
 
 
 def match_metaphlan_greengenes(metaphlan_clades, tree_metaphlan,
                                attr_metaphlan, tree_greengenes,
-                               attr_greengenes, out=sys.stderr):
+                               attr_greengenes, out=sys.stderr,
+                               taxonomy=None, processes=1):
     """ Match all MetaPhlAn clades to GreenGenes OTUs.
 
     Parameters
@@ -147,18 +858,52 @@ def match_metaphlan_greengenes(metaphlan_clades, tree_metaphlan,
     out : filehandle
         File handle into verbosity information should be printed.
         Default = sys.stderr
+    taxonomy : Taxonomy
+        Optional. The NCBI taxonomy both trees are derived from. If given,
+        lowest common ancestors and lineages are computed on its arrays
+        instead of walking the trees.
+    processes : int
+        Default: 1. Number of worker processes matching shards of the clades.
+        Workers inherit the tree indices when forked, i.e. they are not
+        pickled per task. Results and messages do not depend on processes.
 
     Returns
     -------
     A dict with MetaPhlAn clades as keys and set of GreenGenes OTUs as values.
     """
+    mp_index = _index_metaphlan_tree(tree_metaphlan, attr_metaphlan)
+    gg_index = _index_greengenes_tree(tree_greengenes, attr_greengenes)
+
+    if processes > 1:
+        metaphlan_clades = list(metaphlan_clades)
+        num_shards = min(len(metaphlan_clades), processes * 4)
+        shards = [metaphlan_clades[i * len(metaphlan_clades) // num_shards:
+                                   (i + 1) * len(metaphlan_clades) //
+                                   num_shards]
+                  for i in range(num_shards)]
+        context = get_context('fork' if 'fork' in get_all_start_methods()
+                              else None)
+        with context.Pool(processes, initializer=_init_match_worker,
+                          initargs=(mp_index, gg_index, taxonomy)) as pool:
+            shard_results = pool.map(_match_clades_worker, shards)
+
+        # replay messages in clade order, as if matched sequentially
+        clade_to_otu = {}
+        for clade, otus, messages in chain.from_iterable(shard_results):
+            sys.stderr.write(messages)
+            if otus is None:
+                out.write(("Clade '%s' omitted, since it is not in "
+                           "tree_metaphlan.\n") % clade)
+            else:
+                clade_to_otu[clade] = otus
+        return clade_to_otu
+
     clade_to_otu = {}
     for clade in metaphlan_clades:
         try:
-            clade_to_otu[clade] = _get_otus_from_clade(clade, tree_metaphlan,
-                                                       attr_metaphlan,
-                                                       tree_greengenes,
-                                                       attr_greengenes)
+            clade_to_otu[clade] = _match_clade(clade, mp_index, gg_index,
+                                               out=sys.stderr,
+                                               taxonomy=taxonomy)
         except ValueError:
             out.write(("Clade '%s' omitted, since it is not in "
                        "tree_metaphlan.\n") % clade)
@@ -166,8 +911,144 @@ def match_metaphlan_greengenes(metaphlan_clades, tree_metaphlan,
     return clade_to_otu
 
 
+# tree indices of match_metaphlan_greengenes' worker processes
+_match_indices = None
+
+
+def _init_match_worker(mp_index, gg_index, taxonomy):
+    global _match_indices
+    _match_indices = (mp_index, gg_index, taxonomy)
+
+
+def _match_clades_worker(clades):
+    """ Matches a shard of clades, capturing messages per clade.
+
+    Returns
+    -------
+    A list of (clade, set of OTUs or None if the clade is not in the
+    MetaPhlAn tree, messages).
+    """
+    mp_index, gg_index, taxonomy = _match_indices
+    results = []
+    for clade in clades:
+        messages = StringIO()
+        try:
+            otus = _match_clade(clade, mp_index, gg_index, out=messages,
+                                taxonomy=taxonomy)
+        except ValueError:
+            otus = None
+        results.append((clade, otus, messages.getvalue()))
+    return results
+
+
+def _index_metaphlan_tree(tree_metaphlan, attr_metaphlan):
+    """ Indexes clade annotations, parents and depths of a MetaPhlAn tree.
+
+    Returns
+    -------
+    A tuple of three dicts: clade -> list of names of annotated nodes,
+    node name -> parent name and node name -> depth.
+    """
+    clade_nodes = {}
+    parents = {}
+    depths = {tree_metaphlan.name: 0}
+    for node in tree_metaphlan.preorder(include_self=True):
+        if not node.is_root():
+            parents[node.name] = node.parent.name
+            depths[node.name] = depths[node.parent.name] + 1
+        for clade in getattr(node, attr_metaphlan, []):
+            if clade in clade_nodes:
+                clade_nodes[clade].append(node.name)
+            else:
+                clade_nodes[clade] = [node.name]
+    return clade_nodes, parents, depths
+
+
+def _index_greengenes_tree(tree_greengenes, attr_greengenes):
+    """ Lays out OTU annotations of a GreenGenes tree in postorder.
+
+    In postorder, all nodes of a subtree are visited consecutively. Thus, the
+    OTUs of all nodes of the subtree rooted at a node form one contiguous
+    range of the flat array.
+
+    Returns
+    -------
+    A tuple (dict, numpy.ndarray): node name -> (start, end) of the range of
+    its subtree's OTUs and the flat array of OTUs.
+    """
+    ranges = {}
+    otus = []
+    for node in tree_greengenes.postorder(include_self=True):
+        if node.children:
+            start = ranges[node.children[0].name][0]
+        else:
+            start = len(otus)
+        otus.extend(getattr(node, attr_greengenes, []))
+        ranges[node.name] = (start, len(otus))
+    return ranges, np.array(otus)
+
+
+def _match_clade(metaphlan_clade, mp_index, gg_index, out=sys.stderr,
+                 taxonomy=None):
+    """ Finds OTUs of one clade on indices of both trees.
+
+    See _get_otus_from_clade for the matching rules and
+    _index_metaphlan_tree, _index_greengenes_tree for the indices.
+    """
+    clade_nodes, parents, depths = mp_index
+    ranges, otus = gg_index
+
+    if metaphlan_clade not in clade_nodes:
+        raise ValueError("Clade '%s' is not in MetaPhlAn tree." %
+                         metaphlan_clade)
+    mp_clade_names = clade_nodes[metaphlan_clade]
+    if taxonomy is not None:
+        lca = taxonomy.lca(mp_clade_names)
+        is_cellular = (lca != 131567) and (131567 in taxonomy) and \
+            taxonomy.is_ancestor(131567, lca)
+    else:
+        lca = mp_clade_names[0]
+        for name in mp_clade_names[1:]:
+            while depths[name] > depths[lca]:
+                name = parents[name]
+            while depths[lca] > depths[name]:
+                lca = parents[lca]
+            while lca != name:
+                lca, name = parents[lca], parents[name]
+        is_cellular = False
+        ancestor = lca
+        while ancestor in parents:
+            ancestor = parents[ancestor]
+            if ancestor == 131567:
+                is_cellular = True
+                break
+
+    if not is_cellular:
+        out.write("'%s' not a cellular organism.\n" % metaphlan_clade)
+        return set()
+
+    # ascend from the lca until a node with OTUs in GreenGenes is found,
+    # giving up at the root
+    c = lca
+    while True:
+        if c in ranges:
+            start, end = ranges[c]
+            if end > start:
+                return set(otus[start:end].tolist())
+        if taxonomy is not None:
+            parent = int(taxonomy.parents[c])
+            if parent == c:
+                return set()
+            c = parent
+        elif c in parents:
+            c = parents[c]
+        else:
+            return set()
+
+
 def _get_otus_from_clade(metaphlan_clade, tree_metaphlan, attr_metaphlan,
-                         tree_greengenes, attr_greengenes, out=sys.stderr):
+                         tree_greengenes, attr_greengenes, out=sys.stderr,
+                         taxonomy=None):
     """ Find all GreenGenes OTUs that 'match' to one MetaPhlAn clade.
 
     The connection between GreenGenes and MetaPhlAn is NCBI taxonomy IDs.
@@ -208,6 +1089,10 @@ def _get_otus_from_clade(metaphlan_clade, tree_metaphlan, attr_metaphlan,
     out : filehandle
         File handle into verbosity information should be printed.
         Default = sys.stderr
+    taxonomy : Taxonomy
+        Optional. The NCBI taxonomy both trees are derived from. If given,
+        lowest common ancestors and lineages are computed on its arrays
+        instead of walking the trees.
 
     Returns
     -------
@@ -219,38 +1104,10 @@ def _get_otus_from_clade(metaphlan_clade, tree_metaphlan, attr_metaphlan,
         If metaphlan_clade is not in the according tree_metaphlan at all. Thus,
         a mapping to GreenGenes OTUs cannot be done.
     """
-    def _has_matching_clade(node):
-        return hasattr(node, attr_metaphlan) and \
-               (metaphlan_clade in getattr(node, attr_metaphlan))
-
-    def _hasOTUs(node):
-        return hasattr(node, attr_greengenes)
-
-    mp_nodes_clade = list(tree_metaphlan.find_by_func(_has_matching_clade))
-    if len(mp_nodes_clade) > 0:
-        mp_clade_names = list(map(lambda node: node.name, mp_nodes_clade))
-        mp_lca = tree_metaphlan.lowest_common_ancestor(mp_clade_names)
-
-        otus = []
-        if 131567 in map(lambda node: node.name, mp_lca.ancestors()):
-            c = mp_lca
-            while len(otus) <= 0:
-                otus = []
-                try:
-                    gg_lca_match = tree_greengenes.find(c.name)
-                    for node in gg_lca_match.find_by_func(_hasOTUs):
-                        otus.extend(getattr(node, attr_greengenes))
-                    otus = set(otus)
-                except MissingNodeError:
-                    c = c.ancestors()[0]
-
-            return set(otus)
-        else:
-            out.write("'%s' not a cellular organism.\n" % metaphlan_clade)
-            return set()
-    else:
-        raise ValueError("Clade '%s' is not in MetaPhlAn tree." %
-                         metaphlan_clade)
+    mp_index = _index_metaphlan_tree(tree_metaphlan, attr_metaphlan)
+    gg_index = _index_greengenes_tree(tree_greengenes, attr_greengenes)
+    return _match_clade(metaphlan_clade, mp_index, gg_index, out=out,
+                        taxonomy=taxonomy)
 
 
 def distance_seppinsertion(tree_orig, tree_changed,
@@ -304,3 +1161,151 @@ def distance_seppinsertion(tree_orig, tree_changed,
         return dist_pp + abs(dist_sub_orig - dist_sub_changed)
     else:
         return dist_pp + dist_sub_orig + dist_sub_changed
+
+
+def _index_sepp_tree(tree):
+    """ Indexes a tree for batch insertion distances in one traversal.
+
+    Returns
+    -------
+    A dict with the node index of every name, preferring tips as
+    TreeNode.find does, and arrays indexed by node in preorder: 'parents'
+    (the root is its own parent), 'names', 'named', 'root_dists', i.e. the
+    sum of branch lengths to the root, 'is_tip' and 'sizes', i.e. the number
+    of nodes of a node's subtree, which spans positions i to i + sizes[i] - 1
+    in preorder.
+    """
+    nodes = list(tree.preorder(include_self=True))
+    index = {id(node): i for i, node in enumerate(nodes)}
+    parents = np.arange(len(nodes))
+    root_dists = np.zeros(len(nodes))
+    for i, node in enumerate(nodes[1:], 1):
+        parents[i] = index[id(node.parent)]
+        root_dists[i] = root_dists[parents[i]] + (node.length or 0.0)
+
+    names = [node.name for node in nodes]
+    sizes = np.ones(len(nodes), dtype=np.int64)
+    for i in range(len(nodes) - 1, 0, -1):
+        sizes[parents[i]] += sizes[i]
+
+    name_index = {}
+    for i, name in enumerate(names):
+        if (name not in name_index) or \
+           (nodes[name_index[name]].children and not nodes[i].children):
+            name_index[name] = i
+    name_index.pop(None, None)
+
+    return {'index': name_index, 'parents': parents, 'names': names,
+            'named': np.array([name is not None for name in names]),
+            'root_dists': root_dists,
+            'is_tip': np.array([not node.children for node in nodes]),
+            'sizes': sizes, 'tree': Taxonomy(parents)}
+
+
+def distance_seppinsertions(tree_orig, tree_changed, nodenames_orig,
+                            nodenames_changed=None):
+    """ Insertion distances of many nodes, see distance_seppinsertion.
+
+    Instead of searching nodes and collecting tips for every node, both trees
+    are traversed once to index names, distances to the root and the extent
+    of all subtrees in preorder. Distances between nodes then follow from
+    root distances and their lowest common ancestor, and tip sets are
+    compared as sets of integer tip IDs, which are shared by both trees.
+
+    Parameters
+    ----------
+    tree_orig : TreeNode
+        The original tree.
+    tree_changed : TreeNode
+        The tree in which SEPP re-inserted nodes.
+    nodenames_orig : list of str
+        Names of the nodes in tree_orig.
+    nodenames_changed : list of str
+        Optional. Names of the nodes in tree_changed, if different from
+        nodenames_orig.
+
+    Returns
+    -------
+    numpy.ndarray of float: the insertion distance of every node.
+
+    Raises
+    ------
+    MissingNodeError
+        If a node name is not in its tree.
+    """
+    if nodenames_changed is None:
+        nodenames_changed = nodenames_orig
+    orig = _index_sepp_tree(tree_orig)
+    changed = _index_sepp_tree(tree_changed)
+
+    def lookup(idx, names):
+        res = np.empty(len(names), dtype=np.int64)
+        for i, name in enumerate(names):
+            if name not in idx['index']:
+                raise MissingNodeError("Node %s is not in self" % name)
+            res[i] = idx['index'][name]
+        return res
+
+    node_orig = lookup(orig, nodenames_orig)
+    node_changed = lookup(changed, nodenames_changed)
+    dists = np.zeros(len(node_orig))
+
+    # nodes whose parent still has a name have not been re-inserted
+    moved = ~changed['named'][changed['parents'][node_changed]]
+    node_orig, node_changed = node_orig[moved], node_changed[moved]
+
+    # ascend unnamed nodes, created by SEPP, to the first named ancestor
+    parent_changed = changed['parents'][node_changed]
+    gparent_changed = changed['parents'][parent_changed]
+    while True:
+        unnamed = ~changed['named'][gparent_changed] & \
+            (changed['parents'][gparent_changed] != gparent_changed)
+        if not np.any(unnamed):
+            break
+        parent_changed = np.where(unnamed, gparent_changed, parent_changed)
+        gparent_changed = np.where(unnamed,
+                                   changed['parents'][gparent_changed],
+                                   gparent_changed)
+    gparent_orig = orig['parents'][orig['parents'][node_orig]]
+    gparent_both = lookup(orig, [changed['names'][i]
+                                 for i in gparent_changed])
+
+    rd_orig, rd_changed = orig['root_dists'], changed['root_dists']
+    dist_pp = rd_orig[gparent_orig] + rd_orig[gparent_both] - \
+        2 * rd_orig[orig['tree'].lca_pairs(gparent_orig, gparent_both)]
+    dist_sub_orig = rd_orig[node_orig] - rd_orig[gparent_orig]
+    dist_sub_changed = rd_changed[node_changed] - rd_changed[gparent_changed]
+
+    # ascend to the original edge, whose upper node is in tree_changed
+    in_changed = np.array([name in changed['index']
+                           for name in orig['names']])
+    parent_orig = orig['parents'][node_orig]
+    while True:
+        above = orig['parents'][parent_orig]
+        missing = ~in_changed[above] & (above != parent_orig)
+        if not np.any(missing):
+            break
+        parent_orig = np.where(missing, above, parent_orig)
+
+    tip_ids = {}
+
+    def tipsets(idx, nodes):
+        tips = np.array([tip_ids.setdefault(name, len(tip_ids))
+                         if is_tip else -1
+                         for name, is_tip in zip(idx['names'],
+                                                 idx['is_tip'])])
+        sets = {}
+        for node in set(nodes.tolist()):
+            subtree = tips[node:node + idx['sizes'][node]]
+            sets[node] = frozenset(subtree[subtree >= 0].tolist())
+        return [sets[node] for node in nodes]
+
+    same_tips = np.array(
+        [tips_orig == tips_changed
+         for tips_orig, tips_changed in zip(tipsets(orig, parent_orig),
+                                            tipsets(changed, parent_changed))],
+        dtype=bool)
+    dists[moved] = dist_pp + np.where(
+        same_tips, np.abs(dist_sub_orig - dist_sub_changed),
+        dist_sub_orig + dist_sub_changed)
+    return dists
@@ -1,18 +1,95 @@
 import pandas as pd
+import numpy as np
+import biom
 import os
 from os.path import commonprefix
 import sys
+import hashlib
+import pickle
+import tempfile
+import time
+from array import array
+from itertools import chain
+from multiprocessing import Pool
+from scipy.sparse import coo_matrix, csr_matrix, diags
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 
-from ggmap.readwrite import read_metaphlan_profile
+from ggmap import __version__
+from ggmap.readwrite import read_metaphlan_profile, Clade2OTUsMap, \
+                            TaxidMap, read_ncbi_nodes, read_ncbi_merged, \
+                            read_taxid_list, read_metaphlan_markers_info, \
+                            read_gg_accessions, read_gg_otu_map, \
+                            read_clade2otus_map, _open, BUFFER_SIZE, \
+                            DIR_CACHE, _load_cache, _store_cache
+from ggmap.tree import Taxonomy, map_onto_ncbi, match_metaphlan_greengenes, \
+                       diff_taxonomies, FlatTree
 
 
-def update_taxids(input, updatedTaxids):
+def compile_merged_taxids(merged):
+    """ Compiles merged.dmp into a lookup array that resolves merge chains.
+
+    A taxID might have been merged into a taxID that got merged itself later
+    on. Following merges by pointer doubling, i.e. path compression, every
+    taxID points to the end of its chain after O(log(chain length))
+    vectorized steps.
+
+    Parameters
+    ----------
+    merged : dict or TaxidMap or Taxonomy
+        Content of merged.dmp in form of a dict where key is current taxID and
+        value the new taxID, or a Taxonomy that holds merged.dmp.
+
+    Returns
+    -------
+    A tuple of two numpy.ndarrays (remap, hops), indexed by taxID: the final
+    taxID of every taxID, which is the taxID itself if it was never merged,
+    and the number of merges on the way there.
+
+    Raises
+    ------
+    ValueError
+        If the Taxonomy holds no merged taxIDs or merges form a cycle.
+    """
+    if isinstance(merged, Taxonomy):
+        if merged.merged is None:
+            raise ValueError("Taxonomy has no information about merged "
+                             "taxIDs.")
+        merged = merged.merged
+    if isinstance(merged, TaxidMap):
+        olds = np.flatnonzero(merged.array >= 0)
+        news = merged.array[olds].astype(np.int64)
+    else:
+        olds = np.fromiter(merged.keys(), dtype=np.int64, count=len(merged))
+        news = np.fromiter(merged.values(), dtype=np.int64,
+                           count=len(merged))
+
+    size = int(max(olds.max(initial=-1), news.max(initial=-1))) + 1
+    remap = np.arange(size, dtype=np.int64)
+    remap[olds] = news
+    hops = (remap != np.arange(size)).astype(np.int32)
+    for _ in range(64):
+        jump = remap[remap]
+        if np.array_equal(jump, remap):
+            break
+        hops = hops + hops[remap]
+        remap = jump
+    if np.any(remap[remap] != remap):
+        raise ValueError("Merged taxIDs form a cycle.")
+    return remap, hops
+
+
+def update_taxids(input, updatedTaxids, return_stats=False):
     """ Updates a map of sequenceIDs to taxIDs with information from merged.dmp
 
     Some of NCBI's taxonomy IDs might get merged into others. Older sequences
     can still point to the old taxID. The new taxID must be looked up in the
     merged.dmp file in order to be able to find the right node in the taxonomy
-    tree.
+    tree. TaxIDs that were merged several times in a row are updated to the
+    end of their chain of merges.
 
     Parameters
     ----------
@@ -20,50 +97,97 @@ def update_taxids(input, updatedTaxids):
         The keys of the outer dicts are the sequence types, e.g. NC, GeneID or
         gi. Keys of the inner dict are OTUs or clades. Values of the inner
         dict are sets of taxIDs.
-    updatedTaxids : dict
+    updatedTaxids : dict or Taxonomy or (numpy.ndarray, numpy.ndarray)
         Content of merged.dmp in form of a dict where key is current taxID and
-        value the new taxID
+        value the new taxID, or a Taxonomy that holds merged.dmp, or the
+        result of compile_merged_taxids.
+    return_stats : bool
+        Default: False. If True, also return statistics about the update.
 
     Returns
     -------
     The original map, but some taxIDs might have been updated.
+    If return_stats is True, a tuple of the map and a pandas.DataFrame with
+    one row per sequence type and the number of 'entries', 'updated'
+    entries and entries updated through a chain of merges, i.e. 'chained'.
     """
+    if isinstance(updatedTaxids, tuple):
+        remap, hops = updatedTaxids
+    else:
+        remap, hops = compile_merged_taxids(updatedTaxids)
+
+    stats = []
     for seqType in input:
-        for seqID in input[seqType]:
-            cur_taxid = input[seqType][seqID]
-            if cur_taxid in updatedTaxids:
-                input[seqType][seqID] = updatedTaxids[cur_taxid]
+        seqIDs = input[seqType]
+        taxids = np.fromiter(seqIDs.values(), dtype=np.int64,
+                             count=len(seqIDs))
+        known = (taxids >= 0) & (taxids < len(remap))
+        num_hops = np.zeros(len(taxids), dtype=np.int32)
+        num_hops[known] = hops[taxids[known]]
+        updated = np.flatnonzero(num_hops > 0)
+        if len(updated) > 0:
+            keys = list(seqIDs.keys())
+            seqIDs.update(zip([keys[i] for i in updated],
+                              remap[taxids[updated]].tolist()))
+        stats.append((seqType, len(taxids), len(updated),
+                      int(np.count_nonzero(num_hops > 1))))
+
+    if return_stats:
+        return input, pd.DataFrame(
+            [row[1:] for row in stats], index=[row[0] for row in stats],
+            columns=['entries', 'updated', 'chained'])
     return input
 
 
 def convert_profiles(profile_filenames, map_clade_otu, prefix="",
-                     out=sys.stderr):
+                     out=sys.stderr, processes=1, output='dense',
+                     return_missed=False):
     """
     Converts a list of MetaPhlAn profiles into one GreenGenes OTU table.
 
+    Profiles are streamed, optionally from a pool of worker processes, into
+    one sparse lineage x profile matrix, which is converted into OTUs by a
+    single sparse matrix product, see convert_profiles_matrix.
+
     Parameters
     ----------
     profile_filenames : list of str
         A list of filenames of MetaPhlAn profiles that should be converted.
     map_clade_otu : dict clades -> set(OTUs)
         A dict with MetaPhlAn clades as keys and set of GreenGenes OTUs as
-        values.
+        values, or its compiled form as returned by compile_clade2otus_map.
     prefix : str
         Optional. We try to come up with speaking names for the table columns
         by substracting the common pre- and suffix. You might want to add a
         descriptive prefix to the name. Default = "".
     out : filehandle
-        Filehandle onto which error messages should be written.
+        Filehandle onto which error messages should be written. None to
+        suppress messages.
+    processes : int
+        Default: 1. Number of worker processes reading profiles in parallel.
+    output : str
+        Default: 'dense'. Type of the returned table: 'dense' for a
+        pandas.DataFrame, 'sparse' for a pandas.DataFrame with sparse columns
+        or 'biom' for a biom.Table.
+    return_missed : bool
+        Default: False. If True, additionally return the DataFrame of
+        unmatched lineages, see convert_profiles_matrix. Its column 'profile'
+        holds the column names of the OTU table.
 
     Returns
     -------
-    A pandas DataFrame for the converted OTU table.
+    The converted OTU table, with OTUs as rows and profiles as columns.
 
     Raises
     ------
     IOError
         If one of the given file does not exist.
+    ValueError
+        If output is not one of 'dense', 'sparse' or 'biom'.
     """
+    if output not in ['dense', 'sparse', 'biom']:
+        raise ValueError('Unknown output type "%s".' % output)
+
     # check if all files exist
     for filename in profile_filenames:
         if not os.path.exists(filename):
@@ -74,19 +198,163 @@ def convert_profiles(profile_filenames, map_clade_otu, prefix="",
     common_prefix = commonprefix(profile_filenames)
     common_suffix = commonprefix(list(map(lambda n: n[::-1],
                                  profile_filenames)))[::-1]
+    names = [prefix + filename[len(common_prefix):-len(common_suffix)]
+             for filename in profile_filenames]
+
+    if processes > 1:
+        with Pool(processes) as pool:
+            profiles = pool.imap(read_metaphlan_profile, profile_filenames,
+                                 chunksize=max(1, len(profile_filenames) //
+                                               (processes * 4)))
+            counts, otu_ids, missed = convert_profiles_matrix(profiles,
+                                                              map_clade_otu)
+    else:
+        counts, otu_ids, missed = convert_profiles_matrix(
+            map(read_metaphlan_profile, profile_filenames), map_clade_otu)
+    missed['profile'] = [names[i] for i in missed['profile']]
+
+    if out is not None:
+        for name, missed_profile in missed.groupby('profile', sort=False):
+            out.write(("Due to %i unmatched MetaPhlAn lineages, we missed "
+                       "%.2f of the relative abundance! Those clades are:\n")
+                      % (missed_profile.shape[0],
+                         missed_profile['fraction'].sum()))
+            for _, row in missed_profile.sort_values('lineage').iterrows():
+                out.write("\t%s\t%f\n" % (row['lineage'], row['abundance']))
+
+    if output == 'biom':
+        table = biom.Table(counts, observation_ids=otu_ids, sample_ids=names)
+    elif output == 'sparse':
+        table = pd.DataFrame.sparse.from_spmatrix(counts, index=otu_ids,
+                                                  columns=names)
+    else:
+        table = pd.DataFrame(counts.toarray(), index=otu_ids, columns=names)
+
+    if return_missed:
+        return table, missed
+    return table
 
-    otu_profiles = []
-    for filename in profile_filenames:
-        name = prefix + filename[len(common_prefix):-len(common_suffix)]
-        x = _convert_metaphlan_profile_to_greengenes(
-            read_metaphlan_profile(filename),
-            map_clade_otu,
-            out=out)
-        otu_profiles.append(pd.Series(x,
-                                      index=x.keys(),
-                                      name=name))
 
-    return pd.concat(otu_profiles, axis=1).fillna(0.0)
+def compile_clade2otus_map(map_clade_otu):
+    """ Compiles a clade to OTU map into a sparse weight matrix.
+
+    Each clade distributes its abundance equally across its OTUs, i.e. row c
+    of the weight matrix holds 1/|OTUs(c)| for every OTU of clade c.
+
+    Parameters
+    ----------
+    map_clade_otu : dict clades -> set(OTUs)
+        A dict with MetaPhlAn clades as keys and set of GreenGenes OTUs as
+        values, or a Clade2OTUsMap, whose arrays are used without decoding
+        the OTU sets.
+
+    Returns
+    -------
+    A tuple (dict, numpy.ndarray, scipy.sparse.csr_matrix) of clade names
+    with their row numbers, OTU IDs in column order and the clade x OTU weight
+    matrix.
+    """
+    clades = list(map_clade_otu)
+    if isinstance(map_clade_otu, Clade2OTUsMap):
+        sizes = np.diff(map_clade_otu.indptr)
+        otus = np.asarray(map_clade_otu.otus, dtype=np.int64)
+    else:
+        sizes = np.fromiter((len(map_clade_otu[clade]) for clade in clades),
+                            dtype=np.int64, count=len(clades))
+        otus = np.fromiter(chain.from_iterable(map_clade_otu[clade]
+                                               for clade in clades),
+                           dtype=np.int64, count=sizes.sum())
+    otu_ids = np.unique(otus)
+    weights = csr_matrix(
+        (np.repeat(1.0 / np.maximum(sizes, 1), sizes),
+         np.searchsorted(otu_ids, otus),
+         np.concatenate([[0], np.cumsum(sizes)])),
+        shape=(len(clades), len(otu_ids)))
+    return {clade: i for i, clade in enumerate(clades)}, otu_ids, weights
+
+
+def convert_profiles_matrix(profiles, map_clade_otu):
+    """ Converts MetaPhlAn profiles into GreenGenes OTU profiles.
+
+    Profiles are collected into a sparse lineage x profile matrix P. Each
+    lineage is resolved to its lowest clade contained in the map, giving a
+    clade x lineage resolution matrix R. With the clade x OTU weight matrix W
+    of compile_clade2otus_map, the OTU profiles are W^T * R * P, normalized to
+    sum up to 1.0 per profile.
+
+    Parameters
+    ----------
+    profiles : iterable of dicts lineage -> relative abundance
+        MetaPhlAn profiles, as returned by read_metaphlan_profile.
+    map_clade_otu : dict clades -> set(OTUs)
+        A dict with MetaPhlAn clades as keys and set of GreenGenes OTUs as
+        values, or its compiled form as returned by compile_clade2otus_map.
+
+    Returns
+    -------
+    A tuple (scipy.sparse.csr_matrix, list, pandas.DataFrame). The matrix
+    holds relative OTU abundances with OTUs as rows and profiles as columns.
+    The list holds the OTU IDs of the rows. The DataFrame lists all lineages
+    that could not be resolved to a clade with the columns 'profile' (column
+    number of the profile), 'lineage', 'abundance' and 'fraction', which is
+    the share of the profile's total abundance that got lost.
+    """
+    if isinstance(map_clade_otu, tuple):
+        clade_index, otu_ids, weights = map_clade_otu
+    else:
+        clade_index, otu_ids, weights = compile_clade2otus_map(map_clade_otu)
+
+    # resolve each distinct lineage only once across all profiles
+    lineage_index = {}
+    lineage_clades = array('q')
+    rows, cols, data = array('q'), array('q'), array('d')
+    num_profiles = 0
+    for col, profile in enumerate(profiles):
+        num_profiles += 1
+        for lineage, abundance in profile.items():
+            row = lineage_index.get(lineage)
+            if row is None:
+                row = lineage_index[lineage] = len(lineage_index)
+                clade = -1
+                for c in reversed(lineage.split("|")):
+                    if c in clade_index:
+                        clade = clade_index[c]
+                        break
+                lineage_clades.append(clade)
+            rows.append(row)
+            cols.append(col)
+            data.append(abundance)
+
+    abundances = coo_matrix((np.frombuffer(data, dtype=np.float64),
+                             (np.frombuffer(rows, dtype=np.int64),
+                              np.frombuffer(cols, dtype=np.int64))),
+                            shape=(len(lineage_index), num_profiles)).tocsr()
+    lineage_clades = np.frombuffer(lineage_clades, dtype=np.int64)
+    resolved = np.flatnonzero(lineage_clades >= 0)
+    resolution = csr_matrix((np.ones(len(resolved)),
+                             (lineage_clades[resolved], resolved)),
+                            shape=(weights.shape[0], len(lineage_index)))
+
+    counts = (weights.T.tocsr() @ (resolution @ abundances)).tocsr()
+    used = np.flatnonzero(counts.getnnz(axis=1) > 0)
+    counts = counts[used, :]
+    sums = np.asarray(counts.sum(axis=0)).ravel()
+    counts = (counts @ diags(np.divide(1.0, sums, out=np.zeros_like(sums),
+                                       where=sums != 0))).tocsr()
+
+    # collect statistics about lineages that are not in the map
+    totals = np.asarray(abundances.sum(axis=0)).ravel()
+    missed = abundances[lineage_clades < 0, :].tocoo()
+    lineages = np.array(list(lineage_index), dtype=object)
+    missed = pd.DataFrame({
+        'profile': missed.col,
+        'lineage': lineages[lineage_clades < 0][missed.row],
+        'abundance': missed.data,
+        'fraction': missed.data / totals[missed.col]},
+        columns=['profile', 'lineage', 'abundance', 'fraction'])
+    missed = missed.sort_values(['profile', 'lineage']).reset_index(drop=True)
+
+    return counts, otu_ids[used].tolist(), missed
 
 
 def _convert_metaphlan_profile_to_greengenes(profile, map_clade_otu,
@@ -145,37 +413,456 @@ def _convert_metaphlan_profile_to_greengenes(profile, map_clade_otu,
     return result
 
 
-# WHAT MUST BE DONE TO CREATE A MAP FROM MP TO GG!
-# def generate_clade2otus_map():
-#     nodes = read_ncbi_nodes(('/home/sjanssen/GreenGenes/'
-#                              'NCBItaxonomy/nodes.dmp'))
-#     merged = read_ncbi_merged(('/home/sjanssen/GreenGenes/NCBItaxonomy/'
-#                                'merged.dmp'))
-#     tax = build_ncbi_tree(nodes, True)
-#
-#     taxids_metaphlan = read_taxid_list(('/home/sjanssen/GreenGenes/Cache/'
-#                                         'taxids_metaphlan.txt'))
-#     taxids_metaphlan = update_taxids(taxids_metaphlan, merged)
-#     clades_metaphlan = read_metaphlan_markers_info(('/home/sjanssen/'
-#                                                     'GreenGenes'
-#                                                     '/Metaphlan/markers_info'
-#                                                     '.txt'))
-#
-#     gg_ids_accessions = read_gg_accessions(('/home/sjanssen/GreenGenes/'
-#                                             'gg_13_5_accessions.txt'))
-#     gg_taxids = read_taxid_list(('/home/sjanssen/GreenGenes/Cache/'
-#                                  'taxids_greengenes13_5.txt'))
-#     gg_taxids = update_taxids(gg_taxids, merged)
-#     gg_otumap_97_orig = read_gg_otu_map(('/home/sjanssen/GreenGenes/gg_13_5_'
-#                                          'otus/otus/97_otu_map.txt'),
-#                                         gg_ids_accessions)
-#
-#     tree_gg = map_onto_ncbi(tax, gg_otumap_97_orig, gg_taxids,
-#                             'otus', verbose=True)
-#     tree_mp = map_onto_ncbi(tax, clades_metaphlan, taxids_metaphlan,
-#                             'mp_clades', verbose=True)
-#
-#     resmap = match_metaphlan_greengenes(clades_metaphlan.keys(), tree_mp,
-#                                         'mp_clades', tree_gg, 'otus')
-#
-#     return resmap
+# version of the cache files of pipeline stages. Increase it whenever the
+# results of a stage change for the same inputs and parameters.
+STAGE_FORMAT = 1
+
+
+def _hash_file(filename, dir_cache=None):
+    """ Returns the SHA1 hex digest of the (decompressed) content of a file.
+
+    If dir_cache is given, the digest is cached there under size and
+    modification time of the file, such that an unchanged file is not read
+    again, see readwrite._get_cache_filename.
+    """
+    if dir_cache is not None:
+        cached = _load_cache(filename, 'sha1', dir_cache)
+        if cached is not None:
+            return str(cached[0])
+    sha = hashlib.sha1()
+    with _open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+            sha.update(block)
+    if dir_cache is not None:
+        _store_cache(filename, 'sha1', np.array([sha.hexdigest()]),
+                     dir_cache)
+    return sha.hexdigest()
+
+
+def _get_peak_memory():
+    """ Returns the peak resident set sizes, in MB, of this process and of
+    its terminated child processes, e.g. matching workers.
+
+    Peaks are high-water marks since process start, i.e. not per stage.
+    Obtaining them costs nothing while stages run, unlike tracing each
+    allocation. Both are NaN where the resource module is unavailable.
+    """
+    if resource is None:
+        return float('nan'), float('nan')
+    # ru_maxrss is given in bytes on macOS, but in kilobytes elsewhere
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return tuple(resource.getrusage(who).ru_maxrss / scale
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+# results of these types are cached in their own binary format instead of
+# being pickled, as (file suffix, class)
+_STAGE_BINARY_TYPES = [('tree', FlatTree), ('taxonomy', Taxonomy)]
+
+
+def _run_stage(name, inputs, func, dir_cache, out, params=None):
+    """ Runs one stage of a pipeline, or loads its result from the cache.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    inputs : list of str
+        Content hashes of all inputs, i.e. of input files or results of
+        upstream stages.
+    func : function
+        Computes the stage's result without arguments. FlatTree and Taxonomy
+        results are cached in their own binary formats, all other results are
+        pickled.
+    dir_cache : str
+        Directory of the cache files.
+    out : filehandle
+        Runtime of the stage and peak memory of the process, and its child
+        processes, after the stage are reported to out.
+    params : dict
+        Optional. Parameters of func that affect its result. Together with
+        STAGE_FORMAT and the ggmap version, they are part of the key.
+
+    Returns
+    -------
+    A tuple (result, key), where key is the content hash of the result, which
+    is derived from the stage's name, parameters, format, ggmap version and
+    its inputs.
+    """
+    params = params or {}
+    key = hashlib.sha1('\t'.join(
+        [name, 'format=%i' % STAGE_FORMAT, 'version=%s' % __version__] +
+        ['%s=%r' % (param, params[param]) for param in sorted(params)] +
+        inputs).encode('utf-8')).hexdigest()
+    file_cache = os.path.join(dir_cache, '%s.%s.pickle' % (name, key))
+
+    start = time.time()
+    try:
+        for suffix, cls in _STAGE_BINARY_TYPES:
+            file_binary = os.path.join(dir_cache,
+                                       '%s.%s.%s' % (name, key, suffix))
+            if os.path.exists(file_binary):
+                result = cls.read(file_binary)
+                break
+        else:
+            with open(file_cache, 'rb') as f:
+                result = pickle.load(f)
+        action = 'loaded from cache'
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        result = func()
+        action = 'computed'
+        os.makedirs(dir_cache, exist_ok=True)
+        # write to a temporary file first, such that an interrupted run never
+        # leaves a partial cache file
+        fh, file_tmp = tempfile.mkstemp(dir=dir_cache, suffix='.tmp')
+        for suffix, cls in _STAGE_BINARY_TYPES:
+            if isinstance(result, cls):
+                os.close(fh)
+                result.write(file_tmp)
+                os.replace(file_tmp, os.path.join(
+                    dir_cache, '%s.%s.%s' % (name, key, suffix)))
+                break
+        else:
+            with os.fdopen(fh, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(file_tmp, file_cache)
+    runtime = time.time() - start
+    peak_self, peak_children = _get_peak_memory()
+
+    out.write(("stage '%s': %s in %.2f seconds, peak memory %.1f MB, "
+               "child processes %.1f MB.\n") %
+              (name, action, runtime, peak_self, peak_children))
+    return result, key
+
+
+def build_clade2otus_map(file_nodes, file_merged, file_markers_info,
+                         file_metaphlan_taxids, file_gg_accessions,
+                         file_gg_taxids, file_gg_otumap, dir_cache=None,
+                         processes=1, out=sys.stderr):
+    """ Builds the map of MetaPhlAn clades to GreenGenes OTUs.
+
+    The build is a pipeline of stages: reading the NCBI taxonomy, reading and
+    updating taxIDs of MetaPhlAn markers and GreenGenes accessions, mapping
+    both onto the taxonomy and matching clades to OTUs. The result of each
+    stage is cached under a hash of the content of its input files and
+    upstream stages, its parameters, the cache format and ggmap version.
+    Thus, only stages whose inputs changed are rerun, e.g. new MetaPhlAn
+    markers only rerun the MetaPhlAn and matching stages. Digests of input
+    files are cached as well and only recomputed if size or modification time
+    of a file changes. processes does not change results and is therefore not
+    part of the keys.
+
+    Parameters
+    ----------
+    file_nodes : str
+        Path to NCBI's nodes.dmp.
+    file_merged : str
+        Path to NCBI's merged.dmp.
+    file_markers_info : str
+        Path to MetaPhlAn's markers_info.txt.
+    file_metaphlan_taxids : str
+        Path to the taxID list of MetaPhlAn marker accessions.
+    file_gg_accessions : str
+        Path to the GreenGenes accession list.
+    file_gg_taxids : str
+        Path to the taxID list of GreenGenes accessions.
+    file_gg_otumap : str
+        Path to the GreenGenes OTU map, e.g. 97_otu_map.txt.
+    dir_cache : str
+        Directory for the stages' cache files. Default: a sub-directory
+        'clade2otus' of DIR_CACHE.
+    processes : int
+        Default: 1. Number of processes for parsing and matching.
+    out : filehandle
+        Runtime and peak memory of every stage, as well as taxIDs missing in
+        the taxonomy, are reported to out.
+
+    Returns
+    -------
+    A dict with MetaPhlAn clades as keys and set of GreenGenes OTUs as values,
+    as e.g. written by write_clade2otus_map.
+
+    Raises
+    ------
+    IOError
+        If an input file cannot be read.
+    """
+    if dir_cache is None:
+        dir_cache = os.path.join(DIR_CACHE, 'clade2otus')
+
+    files = {'nodes': file_nodes, 'merged': file_merged,
+             'markers_info': file_markers_info,
+             'metaphlan_taxids': file_metaphlan_taxids,
+             'gg_accessions': file_gg_accessions,
+             'gg_taxids': file_gg_taxids, 'gg_otumap': file_gg_otumap}
+    hashes = {name: _hash_file(filename, dir_cache)
+              for name, filename in files.items()}
+
+    def stage(name, inputs, func, params=None):
+        return _run_stage(name, inputs, func, dir_cache, out, params)
+
+    taxonomy, key_taxonomy = stage(
+        'taxonomy', [hashes['nodes'], hashes['merged']],
+        lambda: Taxonomy(read_ncbi_nodes(file_nodes, cache=False,
+                                         processes=processes),
+                         merged=read_ncbi_merged(file_merged, cache=False,
+                                                 processes=processes)))
+
+    gg_otus, key_gg_otus = stage(
+        'gg_otus', [hashes['gg_accessions'], hashes['gg_otumap']],
+        lambda: read_gg_otu_map(file_gg_otumap,
+                                read_gg_accessions(file_gg_accessions,
+                                                   processes=processes)))
+    gg_taxids, key_gg_taxids = stage(
+        'gg_taxids', [hashes['gg_taxids'], key_taxonomy],
+        lambda: update_taxids(read_taxid_list(file_gg_taxids,
+                                              processes=processes),
+                              taxonomy))
+    tree_gg, key_tree_gg = stage(
+        'tree_gg', [key_taxonomy, key_gg_otus, key_gg_taxids],
+        lambda: FlatTree.from_treenode(
+            map_onto_ncbi(taxonomy, gg_otus, gg_taxids, 'otus', out=out),
+            ['otus']),
+        {'attribute_name': 'otus'})
+
+    mp_clades, key_mp_clades = stage(
+        'mp_clades', [hashes['markers_info']],
+        lambda: read_metaphlan_markers_info(file_markers_info))
+    mp_taxids, key_mp_taxids = stage(
+        'mp_taxids', [hashes['metaphlan_taxids'], key_taxonomy],
+        lambda: update_taxids(read_taxid_list(file_metaphlan_taxids,
+                                              processes=processes),
+                              taxonomy))
+    tree_mp, key_tree_mp = stage(
+        'tree_mp', [key_taxonomy, key_mp_clades, key_mp_taxids],
+        lambda: FlatTree.from_treenode(
+            map_onto_ncbi(taxonomy, mp_clades, mp_taxids, 'mp_clades',
+                          out=out),
+            ['mp_clades']),
+        {'attribute_name': 'mp_clades'})
+
+    map_clade2otus, _ = stage(
+        'match', [key_mp_clades, key_tree_mp, key_tree_gg],
+        lambda: match_metaphlan_greengenes(list(mp_clades.keys()),
+                                           tree_mp.to_treenode(), 'mp_clades',
+                                           tree_gg.to_treenode(), 'otus',
+                                           out=out, processes=processes))
+
+    return map_clade2otus
+
+
+def _get_cluster_taxids(clusters, cluster_taxids_old, cluster_taxids_new):
+    """ Lays out the taxIDs of all accessions of clusters as flat arrays.
+
+    Returns
+    -------
+    A tuple (names, cluster, old, new): the list of cluster names and three
+    parallel arrays with one entry per accession, holding the index of its
+    cluster in names and its taxID in the old and new taxonomy. Accessions
+    are grouped by cluster, i.e. cluster is sorted.
+    """
+    names = []
+    index, old, new = array('q'), array('q'), array('q')
+    for cluster in clusters:
+        for ctype in clusters[cluster]:
+            for accession in clusters[cluster][ctype]:
+                index.append(len(names))
+                old.append(cluster_taxids_old[ctype][accession])
+                new.append(cluster_taxids_new[ctype][accession])
+        names.append(cluster)
+    return (names, np.frombuffer(index, dtype=np.int64),
+            np.frombuffer(old, dtype=np.int64),
+            np.frombuffer(new, dtype=np.int64))
+
+
+def _get_lineage_mask(taxonomy, taxids, size):
+    """ Boolean array of length size, True for all nodes of the lineages of
+    those taxids that are in the taxonomy."""
+    mask = np.zeros(size, dtype=bool)
+    taxids = np.unique(taxids)
+    taxids = taxids[(taxids >= 0) & (taxids < len(taxonomy.is_node))]
+    lineages = taxonomy.lineages(taxids[taxonomy.is_node[taxids]])
+    mask[lineages[lineages >= 0]] = True
+    return mask
+
+
+def update_clade2otus_map(map_clade2otus, taxonomy_old, taxonomy_new,
+                          mp_clades, mp_taxids, gg_otus, gg_taxids,
+                          file_report=None, processes=1, out=sys.stderr):
+    """ Updates a map of MetaPhlAn clades to GreenGenes OTUs to a new taxonomy.
+
+    Instead of matching all clades again, only clades whose result might
+    differ between both taxonomies are recomputed. Nodes that have been added,
+    removed or got a new parent are 'changed'. An accession is affected if its
+    taxID got merged differently or the lineage of its taxID contains a
+    changed node, in either taxonomy. A clade is recomputed if
+    1) one of its accessions is affected,
+    2) its OTUs contain an OTU with an affected accession, which might have
+       moved away, or
+    3) an OTU with an affected accession now sits at or below the node, from
+       which the clade took its OTUs, i.e. the lowest ancestor of the clade's
+       lowest common ancestor that holds OTUs.
+    All other clades keep their entry of map_clade2otus.
+
+    Parameters
+    ----------
+    map_clade2otus : dict or Clade2OTUsMap or str
+        The map computed for taxonomy_old, or the name of its file, as read by
+        read_clade2otus_map.
+    taxonomy_old : Taxonomy
+        The taxonomy, incl. merged taxIDs, that map_clade2otus was built on.
+    taxonomy_new : Taxonomy
+        The new taxonomy, incl. merged taxIDs.
+    mp_clades : dict of dicts of sets
+        MetaPhlAn clades, as returned by read_metaphlan_markers_info.
+    mp_taxids : dict of dicts of taxIDs
+        TaxIDs of MetaPhlAn accessions, as returned by read_taxid_list, i.e.
+        not yet updated with merged taxIDs.
+    gg_otus : dict of dicts of sets
+        GreenGenes OTUs, as returned by read_gg_otu_map.
+    gg_taxids : dict of dicts of taxIDs
+        TaxIDs of GreenGenes accessions, as returned by read_taxid_list, i.e.
+        not yet updated with merged taxIDs.
+    file_report : str
+        Optional. Name of a file into which the report of changes is written:
+        summary counts as comment lines and one tab separated line per
+        recomputed clade with its status 'changed', 'unchanged', 'added' or
+        'omitted' and its number of OTUs before, after, gained and lost.
+    processes : int
+        Default: 1. Number of processes for matching.
+    out : filehandle
+        Messages of mapping and matching are reported to out.
+
+    Returns
+    -------
+    A dict with MetaPhlAn clades as keys and set of GreenGenes OTUs as values,
+    equal to matching all clades on taxonomy_new.
+    """
+    if isinstance(map_clade2otus, str):
+        map_clade2otus = read_clade2otus_map(map_clade2otus)
+
+    def updated(taxids, taxonomy):
+        taxids = {ctype: dict(taxids[ctype]) for ctype in taxids}
+        if taxonomy.merged is None:
+            return taxids
+        return update_taxids(taxids, taxonomy)
+
+    mp_taxids_new = updated(mp_taxids, taxonomy_new)
+    gg_taxids_new = updated(gg_taxids, taxonomy_new)
+
+    diff = diff_taxonomies(taxonomy_old, taxonomy_new)
+    size = max(len(taxonomy_old.is_node), len(taxonomy_new.is_node))
+    changed = np.zeros(size, dtype=bool)
+    changed[np.concatenate([diff['added'], diff['removed'],
+                            diff['moved']])] = True
+
+    def get_affected(taxids_old, taxids_new):
+        affected = taxids_old != taxids_new
+        for taxonomy, taxids in [(taxonomy_old, taxids_old),
+                                 (taxonomy_new, taxids_new)]:
+            uniq, inverse = np.unique(taxids, return_inverse=True)
+            touched = np.zeros(len(uniq), dtype=bool)
+            inside = (uniq >= 0) & (uniq < size)
+            touched[inside] = changed[uniq[inside]]
+            present = inside & (uniq < len(taxonomy.is_node))
+            present[present] = taxonomy.is_node[uniq[present]]
+            lineages = taxonomy.lineages(uniq[present])
+            touched[present] |= np.any(
+                changed[np.maximum(lineages, 0)] & (lineages >= 0), axis=1)
+            affected |= touched[inverse]
+        return affected
+
+    otu_names, otu_index, otu_old, otu_new = _get_cluster_taxids(
+        gg_otus, updated(gg_taxids, taxonomy_old), gg_taxids_new)
+    otu_affected = get_affected(otu_old, otu_new)
+    affected_otus = {otu_names[i] for i in np.unique(otu_index[otu_affected])}
+
+    clade_names, clade_index, clade_old, clade_new = _get_cluster_taxids(
+        mp_clades, updated(mp_taxids, taxonomy_old), mp_taxids_new)
+    recompute = np.zeros(len(clade_names), dtype=bool)
+    recompute[clade_index[get_affected(clade_old, clade_new)]] = True
+
+    # deepest node on the lineage of each remaining clade's lca that is an
+    # ancestor of any OTU before the update, and of any affected OTU after it
+    mask_all_old = _get_lineage_mask(taxonomy_old, otu_old, size)
+    mask_affected_new = _get_lineage_mask(taxonomy_new,
+                                          otu_new[otu_affected], size)
+    candidates, lcas = [], []
+    present = (clade_new >= 0) & (clade_new < len(taxonomy_new.is_node))
+    present[present] = taxonomy_new.is_node[clade_new[present]]
+    # accessions of clade i are clade_new[indptr[i]:indptr[i + 1]]
+    indptr = np.zeros(len(clade_names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(clade_index, minlength=len(clade_names)),
+              out=indptr[1:])
+    for i in np.flatnonzero(~recompute):
+        clade = clade_names[i]
+        otus = map_clade2otus.get(clade)
+        if not otus:
+            # omitted or not a cellular organism, unless affected itself
+            continue
+        if not affected_otus.isdisjoint(otus):
+            recompute[i] = True
+            continue
+        candidates.append(i)
+        start, end = indptr[i], indptr[i + 1]
+        lcas.append(taxonomy_new.lca(
+            clade_new[start:end][present[start:end]]))
+    if len(candidates) > 0:
+        lineages = taxonomy_new.lineages(lcas)
+        steps = np.arange(lineages.shape[1])
+        valid = lineages >= 0
+        nodes = np.maximum(lineages, 0)
+        depth_source = np.where(valid & mask_all_old[nodes], steps, -1)
+        depth_gain = np.where(valid & mask_affected_new[nodes], steps, -1)
+        recompute[np.array(candidates)[
+            depth_gain.max(axis=1) >= depth_source.max(axis=1)]] = True
+
+    clades = [clade_names[i] for i in np.flatnonzero(recompute)]
+    result = dict(map_clade2otus.items())
+    if len(clades) > 0:
+        tree_gg = map_onto_ncbi(taxonomy_new, gg_otus, gg_taxids_new, 'otus',
+                                out=out)
+        tree_mp = map_onto_ncbi(taxonomy_new,
+                                {clade: mp_clades[clade] for clade in clades},
+                                mp_taxids_new, 'mp_clades', out=out)
+        recomputed = match_metaphlan_greengenes(
+            clades, tree_mp, 'mp_clades', tree_gg, 'otus', out=out,
+            taxonomy=taxonomy_new, processes=processes)
+    else:
+        recomputed = {}
+
+    lines = []
+    num_changed = 0
+    for clade in clades:
+        before = set(map_clade2otus.get(clade, set()))
+        after = recomputed.get(clade, set())
+        if clade not in map_clade2otus and clade not in recomputed:
+            continue
+        elif clade not in map_clade2otus:
+            status = 'added'
+        elif clade not in recomputed:
+            status = 'omitted'
+            del result[clade]
+        else:
+            status = 'changed' if before != after else 'unchanged'
+        if clade in recomputed:
+            result[clade] = after
+        if status != 'unchanged':
+            num_changed += 1
+        lines.append('%s\t%s\t%i\t%i\t%i\t%i\n' % (
+            clade, status, len(before), len(after), len(after - before),
+            len(before - after)))
+
+    if file_report is not None:
+        with open(file_report, 'w') as f:
+            for name in ['added', 'removed', 'moved']:
+                f.write('# nodes %s: %i\n' % (name, len(diff[name])))
+            f.write('# merged taxIDs changed: %i\n' % len(diff['merged']))
+            f.write('# OTUs affected: %i\n' % len(affected_otus))
+            f.write('# clades recomputed: %i\n' % len(clades))
+            f.write('# clades changed: %i\n' % num_changed)
+            f.write('#clade\tstatus\tOTUs before\tOTUs after\tOTUs gained\t'
+                    'OTUs lost\n')
+            f.writelines(lines)
+
+    return result